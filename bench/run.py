@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# run.py
+#
+# Copyright (c) 2014
+# Author: Claudio Driussi <claudio.driussi@gmail.com>
+#
+"""Benchmarks of DynaQ on synthetic schemas
+
+Each phase is timed and, unless --no-memory is given, the peak of memory
+allocated by the phase is measured with tracemalloc (which slows down the
+phases, compare results taken with the same setting). The results are
+written as json and can be compared with the results of another version.
+Usage:
+     python bench/run.py --tables 200 --output new.json
+     python bench/run.py --tables 200 --compare old.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import decimal
+import datetime
+import argparse
+import platform
+import tempfile
+import warnings
+import tracemalloc
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sqlalchemy as sa
+import dynaq as dq
+import synth
+
+
+class Bench(object):
+    """
+    Collect the timings of the phases.
+
+    results: dict with the options, the environment, the phases
+      {name: {"seconds": s, "peak_kb": kb}} and the throughput
+      {name: operations per second}
+    """
+    def __init__(self, memory=True):
+        """init the results
+
+        :param memory: if True the peak memory of phases is measured
+        :return: None
+        """
+        self.memory = memory
+        self.results = {
+            'python': platform.python_version(),
+            'sqlalchemy': sa.__version__,
+            'tracemalloc': memory,
+            'phases': {},
+            'throughput': {},
+        }
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a phase, usage: with bench.phase('name'):
+
+        The memory of phases nested into another phase is not measured.
+        """
+        memory = self.memory and not tracemalloc.is_tracing()
+        if memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            result = {'seconds': round(seconds, 6)}
+            if memory:
+                result['peak_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+                tracemalloc.stop()
+            self.results['phases'][name] = result
+
+    def throughput(self, name, count):
+        """Set the operations per second of a timed phase"""
+        seconds = self.results['phases'][name]['seconds']
+        self.results['throughput'][name] = round(count / seconds, 1) if seconds else None
+
+
+class TimedDatabase(dq.Database):
+    """Database which records the time of calc_types and calc_tables"""
+    __slots__ = ()
+
+    def calc_types(self):
+        with BENCH.phase('calc_types'):
+            dq.Database.calc_types(self)
+
+    def calc_tables(self):
+        with BENCH.phase('calc_tables'):
+            dq.Database.calc_tables(self)
+
+
+BENCH = None
+
+
+def value(column, i):
+    """Return a value of a column for the row i"""
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return None
+    if python_type is bool:
+        return bool(i % 2)
+    if python_type is int:
+        return i
+    if python_type is decimal.Decimal:
+        return decimal.Decimal(i % 1000)
+    if python_type is float:
+        return float(i)
+    if python_type is datetime.date:
+        return datetime.date(2000, 1, 1) + datetime.timedelta(days=i % 3650)
+    if python_type is datetime.datetime:
+        return datetime.datetime(2000, 1, 1) + datetime.timedelta(seconds=i)
+    if python_type is str:
+        length = getattr(column.type, 'length', None) or 32
+        return ('v%d' % i)[:length]
+    return None
+
+
+def rows(ws, alias, start, count):
+    """Generate count rows of a table starting from the primary key start"""
+    columns = [c for c in ws.tables[alias].__table__.c if not c.foreign_keys]
+    for i in range(start, start + count):
+        yield dict((c.name, value(c, i)) for c in columns)
+
+
+def run(options, path, url, count, loader=None, workers=0, memory=True):
+    """Run all phases
+
+    :param options: synth.Options object
+    :param path: directory of the yaml files
+    :param url: database url, the database must be empty
+    :param count: number of rows of CRUD and bulk phases
+    :param loader: yaml loader class
+    :param workers: number of processes of the yaml loader
+    :param memory: if True the peak memory is measured
+    :return: the results dict
+    """
+    global BENCH
+    bench = BENCH = Bench(memory)
+    dq.stats.STATS.reset()
+    bench.results['options'] = options.as_dict()
+    bench.results['rows'] = count
+
+    with bench.phase('generate_yaml'):
+        main = synth.generate(path, options)
+    with bench.phase('yaml_load'):
+        data = dq.utils.load_yaml(main, [path], loader=loader, workers=workers)
+    db = TimedDatabase()
+    with bench.phase('load_yaml'):
+        db.load_yaml(data)
+    bench.results['schema'] = {'types': len(db.types), 'tables': len(db.tables),
+                               'fields': sum(len(t.fields) for t in db.tables.values())}
+
+    ws = dq.WorkSpace(db, sa.create_engine(url))
+    with bench.phase('generate_orm'):
+        ws.generate_orm()
+    with bench.phase('create_all'):
+        ws.create_all()
+
+    alias = 'tb0000'
+    cls = ws.tables[alias]
+    with bench.phase('orm_insert'):
+        s = ws.session()
+        for r in rows(ws, alias, 1, count):
+            s.add(cls(**r))
+        s.commit()
+    bench.throughput('orm_insert', count)
+    with bench.phase('orm_get'):
+        s = ws.session()
+        for i in range(1, count + 1):
+            s.query(cls).get(i)
+    bench.throughput('orm_get', count)
+    with bench.phase('orm_update'):
+        for x in s.query(cls):
+            x.f000 = value(cls.__table__.c.f000, x.id + 1)
+        s.commit()
+    bench.throughput('orm_update', count)
+    with bench.phase('orm_delete'):
+        s.query(cls).delete()
+        s.commit()
+    bench.throughput('orm_delete', count)
+
+    with bench.phase('bulk_load'):
+        ws.bulk_load(alias, rows(ws, alias, 1, count))
+    bench.throughput('bulk_load', count)
+    with bench.phase('stream'):
+        n = sum(len(b) for b in ws.stream(alias))
+    bench.throughput('stream', n)
+    q = ws.query(alias, ['id', 'f000'], ['id'])
+    with bench.phase('query'):
+        for i in range(1, count + 1):
+            q.first(id=i)
+    bench.throughput('query', count)
+    bench.results['stats'] = ws.stats()
+    return bench.results
+
+
+def compare(new, old):
+    """Print the ratio new / old of the seconds of each phase"""
+    print('%-16s %12s %12s %8s' % ('phase', 'old s', 'new s', 'ratio'))
+    for name, r in new['phases'].items():
+        o = old['phases'].get(name)
+        if o is None:
+            continue
+        ratio = r['seconds'] / o['seconds'] if o['seconds'] else 0
+        print('%-16s %12.4f %12.4f %8.2f' % (name, o['seconds'], r['seconds'], ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='DynaQ benchmarks')
+    defaults = synth.Options()
+    for k, v in sorted(defaults.as_dict().items()):
+        parser.add_argument('--' + k.replace('_', '-'), type=type(v), default=v,
+                            dest=k, help='schema option, default %s' % v)
+    parser.add_argument('--rows', type=int, default=1000, help='rows of CRUD phases')
+    parser.add_argument('--url', help='database url, default a sqlite file')
+    parser.add_argument('--loader', choices=['py', 'c'], default='py', help='yaml loader')
+    parser.add_argument('--workers', type=int, default=0, help='yaml loader processes')
+    parser.add_argument('--no-memory', action='store_true', help="don't measure memory")
+    parser.add_argument('--output', help='json file of results, default stdout')
+    parser.add_argument('--compare', help='json file of results to compare')
+    args = parser.parse_args(argv)
+    # sqlite Decimal warnings
+    warnings.filterwarnings('ignore', category=sa.exc.SAWarning)
+
+    options = synth.Options(**dict((k, getattr(args, k)) for k in defaults.as_dict()))
+    loader = dq.utils.CYamlLoader if args.loader == 'c' else None
+    if args.loader == 'c' and loader is None:
+        parser.error('libyaml is not available')
+    tmp = tempfile.mkdtemp()
+    try:
+        url = args.url or 'sqlite:///%s' % os.path.join(tmp, 'bench.db')
+        results = run(options, tmp, url, args.rows, loader, args.workers,
+                      not args.no_memory)
+    finally:
+        shutil.rmtree(tmp)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    elif not args.compare:
+        json.dump(results, sys.stdout, indent=1, sort_keys=True)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
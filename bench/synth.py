@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# synth.py
+#
+# Copyright (c) 2014
+# Author: Claudio Driussi <claudio.driussi@gmail.com>
+#
+"""Generator of synthetic DynaQ yaml schemas used by the benchmarks"""
+import os
+import random
+import yaml
+
+# base types and the types derived from them, used as roots of the
+# inheritance chains, idint and idname are used by user fields tables
+BASE_TYPES = ['integer', 'autoinc', 'bool', 'char', 'varchar', 'blob', 'text',
+              'date', 'datetime', 'numeric', 'float']
+ROOTS = [
+    ['idint', 'integer'],
+    ['number', 'integer'],
+    ['code', 'char', 10],
+    ['idname', 'char', 20],
+    ['label', 'varchar', 64],
+    ['amount', 'numeric', 9, 2],
+    ['day', 'date'],
+    ['memo', 'text'],
+]
+
+
+class Options(object):
+    """
+    Size of a synthetic schema.
+
+    types: number of derived types, grouped into inheritance chains
+    depth: length of the inheritance chains of types
+    tables: number of tables
+    fields: number of simple fields of each table
+    arrays, compounds: number of array and compound fields of each table
+    array_size: number of elements of array types
+    relations: max number of "=table" fields of each table, the first one is
+      a child relation for a quarter of tables
+    inherit: fraction of tables which inherit from a previous table
+    usrfld: fraction of tables with user fields
+    seed: seed of the random generator
+    """
+    def __init__(self, **kwargs):
+        """init the options, kwargs are the attributes to change"""
+        self.types = 1000
+        self.depth = 10
+        self.tables = 100
+        self.fields = 20
+        self.arrays = 2
+        self.compounds = 1
+        self.array_size = 5
+        self.relations = 3
+        self.inherit = 0.1
+        self.usrfld = 0.1
+        self.seed = 0
+        for k, v in kwargs.items():
+            if not hasattr(self, k):
+                raise Exception('Unknown option: %s' % k)
+            setattr(self, k, v)
+
+    def as_dict(self):
+        """Return the options as a dict"""
+        return dict(self.__dict__)
+
+
+def generate(path, options=None):
+    """Write the yaml files of a synthetic schema
+
+    The files are: db.yml, the main file, types.yml and a file for each
+    table, included by db.yml.
+
+    :param path: directory where the files are written, it must exist
+    :param options: Options object, by default the default sizes
+    :return: the name of the main file
+    """
+    o = options or Options()
+    rnd = random.Random(o.seed)
+
+    types = [[t] for t in BASE_TYPES] + [list(r) for r in ROOTS]
+    leaves = []
+    for c in range(max(o.types // max(o.depth, 1), 1)):
+        parent = ROOTS[c % len(ROOTS)][0]
+        for d in range(o.depth):
+            name = 't%04d_%02d' % (c, d)
+            entry = [name, parent]
+            if d % 3 == 2:
+                entry.append({'description': 'chain %d level %d' % (c, d)})
+            types.append(entry)
+            parent = name
+        leaves.append(parent)
+    numeric = [l for i, l in enumerate(leaves) if ROOTS[i % len(ROOTS)][1] in
+               ('integer', 'numeric')] or ['number']
+    arrays = []
+    compounds = []
+    for i in range(max(o.arrays, 1) * 4):
+        arrays.append('arr%03d' % i)
+        types.append([arrays[-1], rnd.choice(numeric), {'array': o.array_size}])
+        compounds.append('cmp%03d' % i)
+        types.append([compounds[-1], {'fields': [
+            ['a', rnd.choice(leaves), 'Member a'],
+            ['b', rnd.choice(leaves), 'Member b'],
+            ['c', rnd.choice(leaves), 'Member c']]}])
+    _write(path, 'types.yml', {'type': 'types', 'types': types})
+
+    tables = []
+    for i in range(o.tables):
+        alias = 'tb%04d' % i
+        doc = {'type': 'table', 'name': 'table_%04d' % i, 'alias': alias,
+               'kind': 'anag', 'title': 'Table %d' % i}
+        fields = []
+        if i and rnd.random() < o.inherit:
+            doc['inherit'] = 'tb%04d' % rnd.randrange(i)
+        else:
+            fields.append(['id', 'idint', 'ID'])
+        for n in range(o.fields):
+            fields.append(['f%03d' % n, rnd.choice(leaves), 'Field %d' % n])
+        for n in range(o.arrays):
+            fields.append(['a%02d' % n, rnd.choice(arrays), 'Array %d' % n])
+        for n in range(o.compounds):
+            fields.append(['c%02d_' % n, rnd.choice(compounds), 'Compound %d' % n])
+        for n in range(min(o.relations, i)):
+            field = ['r%02d' % n, '=tb%04d' % rnd.randrange(i), 'Relation %d' % n]
+            if n == 0 and i % 4 == 0:
+                field.append({'child': True})
+            fields.append(field)
+        doc['fields'] = fields
+        if 'inherit' not in doc:
+            doc['indexes'] = [['primary', 'id', 'ID']]
+            if o.fields > 1:
+                doc['indexes'].append(['f000', ['f000', 'f001'], 'First fields'])
+        if rnd.random() < o.usrfld:
+            doc['usrfld'] = True
+        _write(path, '%s.yml' % alias, doc)
+        tables.append(alias)
+
+    with open(os.path.join(path, 'db.yml'), 'w') as f:
+        f.write('---\ntype: db\nname: SYNTH\ntitle: Synthetic schema\n')
+        f.write('types:\n - !include types.yml\n')
+        f.write('tables:\n')
+        for alias in tables:
+            f.write(' - !include %s.yml\n' % alias)
+    return 'db.yml'
+
+
+def _write(path, name, doc):
+    """Write a yaml document"""
+    with open(os.path.join(path, name), 'w') as f:
+        f.write('---\n')
+        yaml.safe_dump(doc, f, default_flow_style=None)
@@ -11,4 +11,15 @@
 from .db import *
 from .workspace import *
 from . import utils
-
+from . import cache
+from . import reload
+from . import codegen
+from . import bulk
+from . import usrfld
+from . import query
+from . import lookup
+from . import aio
+from . import restructure
+from . import stats
+from . import tenant
+from . import planner
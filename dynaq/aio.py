@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# aio.py
+#
+# Copyright (c) 2014
+# Author: Claudio Driussi <claudio.driussi@gmail.com>
+#
+from .db import *
+from .workspace import WorkSpace, pool_options, task_scope, watch_task
+from . import bulk
+from . import usrfld
+
+# sqlalchemy.ext.asyncio is available from SQLAlchemy 1.4
+try:
+    from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, \
+        async_scoped_session
+except ImportError:
+    AsyncSession = None
+
+
+class AsyncWorkSpace(WorkSpace):
+    """
+    WorkSpace on a SQLAlchemy asyncio engine.
+
+    The orm classes are generated as in WorkSpace, the sessions are
+    AsyncSession objects and the bulk, stream, user fields and query
+    functions are coroutines which run on the async connections, so they
+    don't block the event loop.
+    The orm classes are shared with the sync engine of the async engine,
+    self.engine, which must not be used from the event loop.
+    Usage:
+         ws = AsyncWorkSpace(db, 'sqlite+aiosqlite:///orders.db')
+         o = ws.generate_orm()
+         await ws.create_all()
+         async with ws.session() as s:
+             x = await ws.get(s, 'ord', 1, ['row'])
+         await ws.dispose()
+    The workspace must be disposed before the event loop is closed, the
+    connections of drivers such as aiosqlite run into threads which keep
+    the process alive, or it can be used as async context manager:
+         async with AsyncWorkSpace(db, 'sqlite+aiosqlite://') as ws:
+    Relationships can't be lazy loaded by async sessions, load them with
+    get() or with the "lazy: selectin" field property.
+    """
+    def __init__(self, db, engine, scopefunc=None):
+        """init the workspace
+
+        :param db: DynaQ db definition object
+        :param engine: SQLAlchemy AsyncEngine or engine string, the "pool"
+         property of the database is used as in WorkSpace
+        :param scopefunc: function which return the scope of sessions
+         returned by current_session(), by default the asyncio task
+        :return: None
+        """
+        if AsyncSession is None:
+            raise Exception('AsyncWorkSpace requires SQLAlchemy 1.4 or later')
+        if isinstance(engine, str):
+            options = pool_options(db)
+            # the async engines use their own queue pool class
+            options.pop('poolclass', None)
+            engine = create_async_engine(engine, **options)
+        self.async_engine = engine
+        WorkSpace.__init__(self, db, engine.sync_engine, scopefunc)
+        self.session_factory = sa.orm.sessionmaker(
+            bind=engine, class_=AsyncSession, expire_on_commit=False)
+        self.scoped_session = async_scoped_session(self.session_factory,
+                                                   scopefunc or task_scope)
+
+    async def create_all(self):
+        """Generate all classes and create the tables into the database
+
+        :return: None
+        """
+        self.warm_up()
+        async with self.async_engine.begin() as conn:
+            await conn.run_sync(self.metadata.create_all)
+
+    async def run_sync(self, fn, *args, begin=False):
+        """Run a function which takes a sync connection on an async
+        connection
+
+        :param fn: function called as fn(connection, *args)
+        :param args: other arguments of fn
+        :param begin: if True the function runs into a transaction
+        :return: the value returned by fn
+        """
+        if begin:
+            async with self.async_engine.begin() as conn:
+                return await conn.run_sync(fn, *args)
+        async with self.async_engine.connect() as conn:
+            return await conn.run_sync(fn, *args)
+
+    async def bulk_load(self, alias, rows, batch_size=1000, columns=None):
+        """Insert rows into a table and its children bypassing the orm, each
+        batch in its own transaction, see bulk.load()
+
+        :return: the number of rows inserted into the table
+        """
+        count = 0
+        for batch in bulk.batches(self, alias, rows, batch_size, columns):
+            count += await self.run_sync(
+                lambda conn: bulk.insert(self, conn, alias, batch), begin=True)
+        return count
+
+    async def bulk_delete(self, alias, where=None):
+        """Delete rows of a table and their children, see bulk.delete()
+
+        :return: the number of rows deleted from the table
+        """
+        return await self.run_sync(
+            lambda conn: bulk.delete(self, alias, where, conn), begin=True)
+
+    async def stream(self, alias, fields=None, where=None, batch_size=1000,
+                     related=None, prop=None):
+        """Read a whole table in batches of dicts with a server side cursor,
+        see bulk.stream(), usage:
+        async for batch in ws.stream('row'):
+
+        :return: an async generator of lists of dicts
+        """
+        query, key = bulk.select(self, alias, fields, where, related, prop)
+        async with self.async_engine.connect() as conn:
+            result = await conn.stream(query)
+            keys = result.keys()
+            while True:
+                rows = await result.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield [dict(zip(keys, r)) for r in rows]
+
+    async def load_usrfld(self, alias, keys):
+        """Load the user fields of many records, see usrfld.load()
+
+        :return: a dict {key: {name: value}}
+        """
+        return await self.run_sync(
+            lambda conn: usrfld.load(self, alias, keys, conn))
+
+    async def save_usrfld(self, alias, values):
+        """Upsert the user fields of many records, see usrfld.save()
+
+        :return: a tuple (inserted, updated, deleted) number of rows
+        """
+        return await self.run_sync(
+            lambda conn: usrfld.save(self, alias, values, conn), begin=True)
+
+    async def fetch(self, query, **params):
+        """Execute a query of self.query() and return all rows
+
+        :param query: the Query object
+        :param params: values of the parameters of where conditions
+        :return: the list of dicts keyed by field paths
+        """
+        return await self.run_sync(lambda conn: query.all(conn, **params))
+
+    async def load_lookups(self):
+        """Load the tables of self.lookup_cache, then the cache is used
+        without I/O until ttl, ie by lookup_cache.prefill(s.sync_session)
+
+        :return: None
+        """
+        await self.run_sync(self.lookup_cache.load_all)
+
+    async def get(self, session, alias, key, related=()):
+        """Get an object by primary key with its relationships loaded
+
+        :param session: the AsyncSession
+        :param alias: alias name of the table
+        :param key: value of the primary key
+        :param related: names of relationships loaded with "selectin"
+        :return: the object or None
+        """
+        cls = self.map_table(alias)
+        options = [sa.orm.selectinload(getattr(cls, name)) for name in related]
+        return await session.get(cls, key, options=options)
+
+    def session(self):
+        """Return a new AsyncSession, usable as async context manager"""
+        return self.session_factory()
+
+    def current_session(self):
+        """Return the AsyncSession of the current scope, by default the
+        current asyncio task"""
+        watch_task(self.scoped_session)
+        return self.scoped_session()
+
+    async def remove_session(self):
+        """Close and discard the session of the current scope"""
+        await self.scoped_session.remove()
+
+    async def dispose(self):
+        """Close the session of the current scope, remove the listeners of
+        the workspace and close all the connections of the async engine
+
+        :return: None
+        """
+        await self.scoped_session.remove()
+        self._unlisten()
+        await self.async_engine.dispose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.dispose()
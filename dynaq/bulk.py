@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# bulk.py
+#
+# Copyright (c) 2014
+# Author: Claudio Driussi <claudio.driussi@gmail.com>
+#
+import csv
+import datetime
+import decimal
+import itertools
+from .db import *
+from . import workspace
+
+
+def load(ws, alias, rows, batch_size=1000, columns=None):
+    """Insert rows into a table bypassing the orm unit of work
+
+    Rows are inserted in chunks of batch_size rows with Core executemany,
+    each chunk in its own transaction. A row can be a dict or a tuple, for
+    tuples columns is the list of names of values, by default the fields of
+    the table.
+
+    The keys of dict rows can be:
+    - field names
+    - names of array fields with a list of values, ie: {'discount': [5, 10]}
+    - names of compound fields with a dict of values, ie:
+      {'add_': {'street': 'Main St', 'city': 'Boston'}}
+    - names of elements of packed fields, ie: {'discount01': 5}
+    - aliases of child tables with a list of child rows, ie: {'row': [...]}
+      the foreign key of the child rows is filled with the parent key
+    - "usrfld" with a dict of user fields, ie: {'usrfld': {'var1': 1}}
+
+    Parent rows with children and without primary key are inserted one at
+    a time to get the generated key.
+
+    :param ws: the WorkSpace
+    :param alias: alias name of the table
+    :param rows: iterable of rows
+    :param batch_size: number of rows for each chunk
+    :param columns: names of the values of tuple rows
+    :return: the number of rows inserted into the table, children excluded
+    """
+    count = 0
+    for batch in batches(ws, alias, rows, batch_size, columns):
+        with ws.engine.begin() as conn:
+            count += insert(ws, conn, alias, batch)
+    return count
+
+
+def batches(ws, alias, rows, batch_size=1000, columns=None):
+    """Split rows into lists of dict rows, see load()
+
+    :param ws: the WorkSpace
+    :param alias: alias name of the table
+    :param rows: iterable of rows
+    :param batch_size: number of rows for each list
+    :param columns: names of the values of tuple rows
+    :return: a generator of lists of dicts
+    """
+    if columns is None:
+        columns = [f.name for f in ws.db.tables[alias].fields]
+    rows = iter(rows)
+    while True:
+        batch = [r if isinstance(r, dict) else dict(zip(columns, r))
+                 for r in itertools.islice(rows, batch_size)]
+        if not batch:
+            break
+        yield batch
+
+
+def load_csv(ws, alias, filename, batch_size=1000, **kwargs):
+    """Insert the rows of a csv file into a table, see load()
+
+    The first line of the file contains the names of the fields, empty values
+    are stored as NULL and values are converted to the type of columns.
+
+    :param ws: the WorkSpace
+    :param alias: alias name of the table
+    :param filename: name of the csv file
+    :param batch_size: number of rows for each chunk
+    :param kwargs: optional arguments for csv.DictReader
+    :return: the number of rows inserted
+    """
+    columns = ws.map_table(alias).__table__.c
+    with open(filename, 'r', newline='') as f:
+        reader = csv.DictReader(f, **kwargs)
+        converters = dict((k, _converter(columns[k].type))
+                          for k in reader.fieldnames if k in columns)
+        rows = (dict((k, converters[k](v) if k in converters and v != '' else None)
+                     for k, v in r.items()) for r in reader)
+        return load(ws, alias, rows, batch_size)
+
+
+def insert(ws, conn, alias, rows):
+    """Insert a list of rows and their children using a connection
+
+    :param ws: the WorkSpace
+    :param conn: SQLAlchemy connection, the caller handles the transaction
+    :param alias: alias name of the table
+    :param rows: list of dict rows, see load()
+    :return: the number of rows inserted into the table
+    """
+    table = ws.db.tables[alias]
+    sa_table = ws.map_table(alias).__table__
+    key = table.key.name
+    split = [split_row(ws, table, r) for r in rows]
+    executemany(conn, sa_table, [rec for rec, children in split
+                                 if not children or rec.get(key) is not None])
+    children_rows = {}
+    for rec, children in split:
+        if not children:
+            continue
+        if rec.get(key) is None:
+            rec[key] = conn.execute(sa_table.insert(), rec).inserted_primary_key[0]
+        for child, (fk, crows) in children.items():
+            for r in crows:
+                r = dict(r)
+                r[fk] = rec[key]
+                children_rows.setdefault(child, []).append(r)
+    for child, crows in children_rows.items():
+        insert(ws, conn, child, crows)
+    return len(split)
+
+
+def executemany(conn, sa_table, records):
+    """Insert records with executemany, grouped by the set of keys
+
+    :param conn: SQLAlchemy connection
+    :param sa_table: SQLAlchemy Table object
+    :param records: list of dicts of column values
+    :return: None
+    """
+    groups = {}
+    for rec in records:
+        groups.setdefault(tuple(sorted(rec)), []).append(rec)
+    for recs in groups.values():
+        conn.execute(sa_table.insert(), recs)
+
+
+def split_row(ws, table, row):
+    """Split a row into the record of the table and the children rows
+
+    :param ws: the WorkSpace
+    :param table: DynaQ table
+    :param row: dict row, see load()
+    :return: a tuple (record, {child alias: (foreign key name, rows)})
+    """
+    rec = {}
+    children = {}
+    for k, v in row.items():
+        if k in table.fnames:
+            rec[k] = v
+        elif k in table.groups:
+            if v is None:
+                continue
+            for i, name in table.groups[k]:
+                if isinstance(v, dict):
+                    if i in v:
+                        rec[name] = v[i]
+                elif i < len(v):
+                    rec[name] = v[i]
+        elif k in table.packed:
+            fname, i, t = table.packed[k]
+            if isinstance(i, int):
+                value = list(rec.get(fname) or [])
+                value.extend([None] * (i + 1 - len(value)))
+            else:
+                value = dict(rec.get(fname) or {})
+            value[i] = v
+            rec[fname] = value
+        elif k == USRFLD_KEY and table.get(USRFLD_KEY):
+            uf = '%s%s' % (table.alias, USRFLD_SUFFIX)
+            children[uf] = ('id_%s' % table.alias,
+                            [{'name': n, 'value': x} for n, x in v.items()])
+        elif k in ws.children.get(table.alias, []):
+            children[k] = (child_key(ws.db.tables[k], table).name, v)
+        else:
+            raise Exception('Field "%s" not defined in table "%s"' % (k, table.alias))
+    return rec, children
+
+
+def child_key(child, parent):
+    """Return the child field of a table which points to the parent table
+
+    :param child: DynaQ child table
+    :param parent: DynaQ parent table
+    :return: the Field object
+    """
+    for f in child.fields:
+        if f.type is parent and f.get('child'):
+            return f
+    raise Exception('Table "%s" is not child of "%s"' % (child.alias, parent.alias))
+
+
+def stream(ws, alias, fields=None, where=None, batch_size=1000, related=None,
+           prop=None, keyset=False):
+    """Read a whole table in batches without the orm identity map
+
+    The rows are read with a server side cursor, or with keyset pagination
+    on the primary key if keyset is True, so the memory used does not depend
+    on the size of the table. Rows are dicts keyed by field names, related
+    fields are keyed by "field.related_field", ie: "id_prd.description".
+    Example:
+    #>>> for batch in dq.bulk.stream(ws, 'row', related={'id_prd': ['description']}):
+    #>>>     send(batch)
+
+    :param ws: the WorkSpace
+    :param alias: alias name of the table
+    :param fields: list of field names, array and compound fields are
+     expanded, elements of packed fields are read from the JSON column, by
+     default all fields
+    :param where: a dict {field name: value} or a SQLAlchemy clause
+    :param batch_size: number of rows for each batch
+    :param related: dict {related field name: list of field names of the
+     related table}, the related tables are joined in the same query
+    :param prop: if given, only the fields which have this property are read
+    :param keyset: if True read chunks with separate queries ordered by the
+     primary key instead of keeping a cursor open
+    :return: a generator of lists of dicts
+    """
+    query, key = select(ws, alias, fields, where, related, prop)
+    if keyset:
+        last = None
+        while True:
+            q = query if last is None else query.where(key > last)
+            with ws.engine.connect() as conn:
+                result = conn.execute(q.limit(batch_size))
+                keys = result.keys()
+                batch = [dict(zip(keys, r)) for r in result.fetchall()]
+            if not batch:
+                break
+            last = batch[-1][key.key]
+            yield batch
+            if len(batch) < batch_size:
+                break
+        return
+    with ws.engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+        keys = result.keys()
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [dict(zip(keys, r)) for r in rows]
+
+
+def select(ws, alias, fields=None, where=None, related=None, prop=None):
+    """Build the select statement used by stream()
+
+    :return: a tuple (select statement ordered by primary key, key column)
+    """
+    table = ws.db.tables[alias]
+    sa_table = ws.map_table(alias).__table__
+    names = []
+    for name in fields or [f.name for f in table.fields]:
+        if name in table.groups:
+            names.extend(n for i, n in table.groups[name])
+        elif name in table.fnames or name in table.packed:
+            names.append(name)
+        else:
+            raise Exception('Field "%s" not defined in table "%s"' % (name, alias))
+    if prop:
+        names = [n for n in names
+                 if table.fnames[table.packed[n][0] if n in table.packed else n].get(prop)]
+    key = sa_table.c[table.key.name]
+    if key.name not in names:
+        # the key is needed to order and paginate the rows
+        names.insert(0, key.name)
+    columns = [column_expression(sa_table, table, n) for n in names]
+    source = sa_table
+    for fname, rfields in (related or {}).items():
+        f = table.fnames[fname]
+        if not isinstance(f.type, Table):
+            raise Exception('Field "%s" of table "%s" is not related' % (fname, alias))
+        rt = ws.map_table(f.type.alias).__table__.alias('%s_%s' % (f.type.alias, fname))
+        source = source.outerjoin(rt, sa_table.c[fname] == rt.c[f.type.key.name])
+        columns.extend(rt.c[n].label('%s.%s' % (fname, n)) for n in rfields)
+    query = sa.select(columns).select_from(source).order_by(key)
+    return query.where(condition(sa_table, where)), key
+
+
+def column_expression(sa_table, table, name):
+    """Return the column of a field or the expression of a packed element"""
+    if name in table.packed:
+        fname, i, t = table.packed[name]
+        return workspace.packed_expression(sa_table.c[fname], i,
+                                           workspace.packed_cast(t)).label(name)
+    return sa_table.c[name]
+
+
+def delete(ws, alias, where=None, conn=None):
+    """Delete rows of a table and their children with set based statements
+
+    The rows are deleted with one statement, the rows of child tables are
+    deleted before with one statement for each child table, ie:
+    DELETE FROM ord_rows WHERE id_ord IN (SELECT id FROM orders WHERE ...)
+    unless the child foreign key is cascaded by the database, see
+    workspace.cascade_deletes(). The orm objects already loaded into
+    sessions are not updated.
+    Example:
+    #>>> dq.bulk.delete(ws, 'ord', ws.tables['ord'].d_doc < datetime.date(2000, 1, 1))
+
+    :param ws: the WorkSpace
+    :param alias: alias name of the table
+    :param where: a dict {field name: value} or a SQLAlchemy clause, if None
+     all rows are deleted
+    :param conn: SQLAlchemy connection, by default the rows are deleted in a
+     new transaction
+    :return: the number of rows deleted from the table
+    """
+    sa_table = ws.map_table(alias).__table__
+    if conn is None:
+        with ws.engine.begin() as conn:
+            return _delete(ws, conn, alias, condition(sa_table, where))
+    return _delete(ws, conn, alias, condition(sa_table, where))
+
+
+def _delete(ws, conn, alias, cond):
+    """Delete the rows matching cond and the rows of child tables"""
+    table = ws.db.tables[alias]
+    sa_table = ws.map_table(alias).__table__
+    for child in ws.children.get(alias, []):
+        fk = child_key(ws.db.tables[child], table)
+        if workspace.cascade_deletes(ws.db, fk):
+            continue
+        keys = sa.select([sa_table.c[table.key.name]]).where(cond)
+        _delete(ws, conn, child,
+                ws.map_table(child).__table__.c[fk.name].in_(keys))
+    return conn.execute(sa_table.delete().where(cond)).rowcount
+
+
+def condition(sa_table, where):
+    """Return the SQLAlchemy clause of a where argument
+
+    :param sa_table: SQLAlchemy Table object
+    :param where: a dict {field name: value}, a SQLAlchemy clause or None
+    :return: the clause, an empty clause if where is None
+    """
+    if isinstance(where, dict):
+        return sa.and_(*[sa_table.c[k] == v for k, v in where.items()])
+    if where is None:
+        return sa.and_()
+    return where
+
+
+def _converter(sa_type):
+    """Return the function which converts csv strings for a column type"""
+    try:
+        python_type = sa_type.python_type
+    except NotImplementedError:
+        return lambda v: v
+    if python_type is datetime.date:
+        return lambda v: datetime.date.fromisoformat(v)
+    if python_type is datetime.datetime:
+        return lambda v: datetime.datetime.fromisoformat(v)
+    if python_type is bool:
+        return lambda v: v.strip().lower() in ('1', 'true', 'yes', 'y')
+    if python_type is decimal.Decimal:
+        return decimal.Decimal
+    return python_type
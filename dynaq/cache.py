@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# cache.py
+#
+# Copyright (c) 2014
+# Author: Claudio Driussi <claudio.driussi@gmail.com>
+#
+import os
+import pickle
+from .db import Database
+from . import utils
+
+# bump this number when the pickled structure of Database changes
+CACHE_VERSION = 11
+
+
+def load_database(fname, paths=".", cache_file=None):
+    """Load a Database from yaml files using a compiled schema cache
+
+    The first time the yaml files are loaded with utils.YamlLoader and the
+    Database is built as usual, then the resolved Database is saved into
+    cache_file. The cache is keyed by the content hash of every file touched
+    by the loader along the paths search list, so if nothing changed the next
+    calls load the snapshot directly without parsing yaml files.
+    Example:
+    #>>> db = dq.cache.load_database('db.yml', YPATH, 'db.cache')
+
+    :param fname: name of the main yaml file, searched along paths
+    :param paths: list of paths where search the main and included files
+    :param cache_file: file used to store the compiled Database, if None the
+     cache is not used
+    :return: the Database object
+    """
+    if cache_file:
+        db = load_cache(cache_file, paths)
+        if db is not None:
+            return db
+    files = {}
+    db = Database()
+    db.load_yaml(utils.load_yaml(fname, paths, files))
+    if cache_file:
+        save_cache(cache_file, db, files, paths)
+    return db
+
+
+def load_cache(cache_file, paths="."):
+    """Load a compiled Database if the cache is still valid
+
+    :param cache_file: file containing the compiled Database
+    :param paths: list of paths used to load the Database
+    :return: the Database object or None if the cache is missing or stale
+    """
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with open(cache_file, 'rb') as f:
+            data = pickle.load(f)
+    except Exception:
+        return None
+    if data.get('version') != CACHE_VERSION:
+        return None
+    if data['key'] is None or data['key'] != utils.files_key(data['files'], paths):
+        return None
+    return data['db']
+
+
+def save_cache(cache_file, db, files, paths="."):
+    """Save a compiled Database into the cache file
+
+    The file is written in a temporary file and then renamed so concurrent
+    processes never read a partial cache.
+
+    :param cache_file: destination file
+    :param db: the resolved Database
+    :param files: dict {name: filename} filled by utils.YamlLoader
+    :param paths: list of paths used to load the Database
+    :return: None
+    """
+    data = {'version': CACHE_VERSION,
+            'key': utils.files_key(files, paths),
+            'files': files,
+            'db': db}
+    tmp = '%s.%d.tmp' % (cache_file, os.getpid())
+    with open(tmp, 'wb') as f:
+        pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, cache_file)
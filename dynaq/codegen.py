@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# codegen.py
+#
+# Copyright (c) 2014
+# Author: Claudio Driussi <claudio.driussi@gmail.com>
+#
+import os
+import keyword
+import py_compile
+from .db import *
+from .workspace import table_name, column_type, relations, class_name, \
+    cascade_deletes, packed_cast
+from .planner import table_indexes
+from . import utils
+
+HEADER = '''# -*- coding: UTF-8 -*-
+#
+# SQLAlchemy orm classes of the "%(name)s" database.
+# Generated by dynaq.codegen, do not edit: regenerate it from yaml files.
+#
+import sqlalchemy as sa
+from sqlalchemy import orm
+from sqlalchemy.ext.declarative import declarative_base
+from dynaq.workspace import packed_property
+
+SCHEMA_HASH = %(hash)r
+SCHEMA_FILES = %(files)r
+OPTIONS = %(options)r
+
+metadata = sa.MetaData()
+Base = declarative_base(metadata=metadata)
+'''
+
+FOOTER = '''
+
+def attach(db):
+    """Attach the DynaQ Database to the classes
+
+    Set the __dqt__ class variable to the DynaQ table and the __dqf__
+    variable of each column to the DynaQ field, as WorkSpace.generate_orm()
+    does.
+
+    :param db: the DynaQ Database used to generate this module
+    :return: None
+    """
+    for alias, cls in tables.items():
+        table = db.tables[alias]
+        cls.__dqt__ = table
+        for f in table.fields:
+            cls.__table__.c[f.name].__dqf__ = f
+'''
+
+
+def generate_module(db, prefix='', pref_tabels={}, files=None, paths="."):
+    """Generate the source of a python module with the orm classes
+
+    The module contains the same classes, indexes and relationships built
+    by WorkSpace.generate_orm(), the attach(db) function which set the
+    __dqt__ and __dqf__ hooks, and the hash of the yaml files used to check
+    if the module is stale. Default values functions are not handled.
+
+    :param db: the resolved DynaQ Database
+    :param prefix: same of WorkSpace.generate_orm
+    :param pref_tabels: same of WorkSpace.generate_orm
+    :param files: dict {name: filename} of yaml files filled by the loader
+    :param paths: list of paths used to load the yaml files
+    :return: the source of the module
+    """
+    files = files or {}
+    lines = [HEADER % {'name': db.name,
+                       'hash': utils.files_key(files, paths) if files else None,
+                       'files': files,
+                       'options': {'prefix': prefix, 'pref_tabels': pref_tabels}}]
+    names = {}
+    for alias, table in db.tables.items():
+        names[alias] = _identifier(class_name(table))
+        lines.append('\n\nclass %s(Base):' % names[alias])
+        lines.append('    __tablename__ = %r' % table_name(table.name, prefix, pref_tabels))
+        for f in table.fields:
+            sa_type = column_type(f)
+            if isinstance(sa_type, type):
+                sa_type = sa_type()
+            args = ['sa.%r' % sa_type]
+            if isinstance(f.type, Table):
+                args.append('sa.ForeignKey(%r%s)' % ('%s.%s' % (
+                    table_name(f.type.name, prefix, pref_tabels), f.type.key.name),
+                    ", ondelete='CASCADE'" if cascade_deletes(db, f) else ''))
+            elif f == table.key:
+                args.append('primary_key=True')
+            lines.append('    %s = sa.Column(%s)' % (_identifier(f.name), ', '.join(args)))
+        for name, (fname, key, t) in table.packed.items():
+            lines.append('    %s = packed_property(%r, %r, %r)' % (
+                _identifier(name), fname, key, packed_cast(t)))
+        ii = ['        sa.Index(%s),' % ', '.join(
+                  [repr('idx_%s_%s' % (alias, name))] +
+                  ['%s.desc()' % _identifier(x) if descending else repr(x) for x in fields] +
+                  (['unique=True'] if unique else []))
+              for name, fields, unique, descending in table_indexes(db, table)]
+        if ii:
+            lines.append('    __table_args__ = (')
+            lines.extend(ii)
+            lines.append('    )')
+    lines.append('\n\n# relationships')
+    for alias in db.tables:
+        for owner, name, target, kwargs in relations(db, alias, prefix, pref_tabels):
+            lines.append('%s.%s = orm.relationship(%s, %s)' % (
+                names[owner], _identifier(name), names[target],
+                ', '.join('%s=%r' % (k, v) for k, v in sorted(kwargs.items()))))
+    lines.append('\ntables = {')
+    for alias in db.tables:
+        lines.append('    %r: %s,' % (alias, names[alias]))
+    lines.append('}')
+    lines.append(FOOTER)
+    return '\n'.join(lines)
+
+
+def write_module(filename, db, prefix='', pref_tabels={}, files=None, paths="."):
+    """Write the module generated by generate_module() and compile it
+
+    :param filename: name of the python file to write
+    :return: None
+    """
+    source = generate_module(db, prefix, pref_tabels, files, paths)
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(source)
+    os.replace(tmp, filename)
+    py_compile.compile(filename, doraise=True)
+
+
+def is_stale(module, paths=".", prefix=None, pref_tabels=None):
+    """Check if a generated module must be generated again
+
+    :param module: the imported generated module
+    :param paths: list of paths used to load the yaml files
+    :param prefix: if not None, the module is stale if generated with
+     another prefix
+    :param pref_tabels: if not None, the module is stale if generated with
+     other pref_tabels
+    :return: True if yaml files or options are changed
+    """
+    if module.SCHEMA_HASH is None or \
+            module.SCHEMA_HASH != utils.files_key(module.SCHEMA_FILES, paths):
+        return True
+    if prefix is not None and prefix != module.OPTIONS['prefix']:
+        return True
+    if pref_tabels is not None and pref_tabels != module.OPTIONS['pref_tabels']:
+        return True
+    return False
+
+
+def _identifier(name):
+    """Check that a name can be used as python identifier"""
+    if not name.isidentifier() or keyword.iskeyword(name):
+        raise Exception('"%s" is not a valid python identifier' % name)
+    return name
@@ -8,6 +8,9 @@
 #
 import sqlalchemy as sa
 import copy
+import sys
+from types import MappingProxyType
+from .stats import STATS
 
 # sqlalchemy recognized types
 base_types = {
@@ -35,16 +38,148 @@ USRFLD_KEY = 'usrfld'
 USRFLD_SUFFIX = '_uf'
 
 
+# generation of the properties of the objects not yet attached to a
+# Database, see PropContainer.attach()
+_DETACHED = [0]
+
+
+class Properties(dict):
+    """
+    The properties dict of a PropContainer, its changes increment the
+    generation of the Database of the object, which invalidates the cached
+    views of the objects of the Database.
+    """
+    __slots__ = ('generation',)
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.generation = _DETACHED
+
+    def _touch(self):
+        self.generation[0] += 1
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._touch()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._touch()
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._touch()
+
+    def setdefault(self, key, default=None):
+        self._touch()
+        return dict.setdefault(self, key, default)
+
+    def pop(self, *args):
+        self._touch()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._touch()
+        return dict.popitem(self)
+
+    def clear(self):
+        dict.clear(self)
+        self._touch()
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
+
+
+class FrozenProperties(Properties):
+    """
+    A read only properties dict, shared by the objects with equal properties,
+    see Database.intern_properties(). Use PropContainer.set_property() or
+    assign a new dict to change the properties of an object.
+    """
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('Shared properties can\'t be changed, assign a new dict')
+
+    __setitem__ = __delitem__ = update = setdefault = pop = popitem = clear = _readonly
+
+
 class PropContainer():
     """
     PropContainer is the base class for all DynaQ db objects and is used to
     handle properties.
-    It has a single method which return a value from self.properties dict.
-    If the property is not found search in the instance variables too.
+    The get() method return a value from self.properties dict, if the
+    property is not found search in the instance variables too.
+    The merged view of properties and instance variables is calculated once
+    and cached in self.view. Any change of properties, in place or by
+    assignment, increments the generation of the Database of the object and
+    invalidates the cached views of its objects, they are rebuilt on
+    demand. The objects are attached to the Database by calc_types() and
+    calc_tables(), before they share a generation with the other detached
+    objects. Instance variables changed at runtime need
+    Database.invalidate_views().
+
+    Metadata objects use __slots__ to keep them compact, with the database
+    property "intern_properties" the properties dicts are interned by
+    Database.intern_properties() and shared between objects, they are read
+    only and must be copied before changing them, see set_property().
     """
+    __slots__ = ('_properties', 'view', 'stamp', 'generation')
+
     def __init__(self):
         """init the properties dict"""
-        self.properties = {}
+        self.generation = _DETACHED
+        self._properties = Properties()
+        self.view = None
+
+    @property
+    def properties(self):
+        """the properties dict, a Properties object"""
+        return self._properties
+
+    @properties.setter
+    def properties(self, value):
+        if not isinstance(value, Properties):
+            value = Properties(value)
+        value.generation = self.generation
+        self._properties = value
+        self.generation[0] += 1
+
+    def attach(self, generation):
+        """Attach the object to the generation of the views of a Database
+
+        :param generation: the generation of the Database
+        :return: None
+        """
+        self.generation = generation
+        self._properties.generation = generation
+
+    def __getstate__(self):
+        """views are not pickled, they are rebuilt when needed"""
+        state = self.instance_vars()
+        state['generation'] = self.generation
+        state['properties'] = self.properties
+        return state
+
+    def __setstate__(self, state):
+        self.view = None
+        self.generation = state.pop('generation', _DETACHED)
+        properties = state.pop('properties')
+        for k, v in state.items():
+            setattr(self, k, v)
+        self._properties = properties
+        properties.generation = self.generation
+
+    def instance_vars(self):
+        """Return the dict of instance variables, slots included, except
+        properties and the cached view
+
+        :return: the dict of variables
+        """
+        d = dict((k, getattr(self, k)) for k in _slot_names(type(self))
+                 if hasattr(self, k))
+        d.update(getattr(self, '__dict__', {}))
+        return d
 
     def get(self, key, default=None):
         """Get the value of a property
@@ -56,9 +191,61 @@ class PropContainer():
         :param default: default value if not found
         :return: the found value or default
         """
-        if key in self.properties:
-            return self.properties[key]
-        return self.__dict__.get(key, default)
+        view = self.view
+        if view is None or self.stamp != self.generation[0]:
+            view = self._build_view()
+        return view.get(key, default)
+
+    def props(self):
+        """Return the read only merged view of properties
+
+        :return: a mapping with all properties of the object
+        """
+        view = self.view
+        if view is None or self.stamp != self.generation[0]:
+            view = self._build_view()
+        return MappingProxyType(view)
+
+    def set_property(self, key, value):
+        """Set a property into a copy of the properties dict, which may be
+        shared with other objects
+
+        :param key: name of the property
+        :param value: value of the property
+        :return: None
+        """
+        properties = dict(self.properties)
+        properties[key] = value
+        self.properties = properties
+
+    def _build_view(self):
+        """Build and cache the view of the current generation"""
+        stamp = self.generation[0]
+        view = self.view = self.calc_view()
+        self.stamp = stamp
+        return view
+
+    def calc_view(self):
+        """Calc the merged view of instance variables and properties
+
+        :return: the merged dict, properties override instance variables
+        """
+        view = self.instance_vars()
+        view.update(self.properties)
+        return view
+
+
+def _slot_names(cls, _cache={}):
+    """Return the names of the slots of a class and of its bases, except
+    properties and the cached view"""
+    if cls not in _cache:
+        names = []
+        for c in reversed(cls.__mro__):
+            for k in c.__dict__.get('__slots__', ()):
+                if k not in ('_properties', 'view', 'stamp', 'generation') and k not in names:
+                    names.append(k)
+        _cache[cls] = tuple(names)
+    return _cache[cls]
 
 
 class Database(PropContainer):
@@ -84,8 +271,11 @@ class Database(PropContainer):
         self.name = ''
         self.types = {}
         self.tables = {}
+        self.interned = {}
+        # generation of the views of the objects of the database
+        self.attach([0])
 
-    def load_yaml(self, data):
+    def load_yaml(self, data, sources=None):
         """ Build Database structure from a dict loaded from yaml files
 
         data is a dict loaded from a yaml files following the defined rules.
@@ -101,8 +291,15 @@ class Database(PropContainer):
         #>>> db.load_yaml(yaml)
 
         :param data: dict loaded from yaml files
+        :param sources: optional dict {id(document): filename} used to track
+         the file which defines each type and table, see
+         utils.IncludeResolver.sources()
         :return: None
+
+        The timings of the phases and the number of types, tables and fields
+        are recorded into stats.STATS.
         """
+        sources = sources or {}
         if data['type'] != 'db':
             raise Exception('Incorrect database script: %s' % data['type'])
         if not self.name:
@@ -114,35 +311,44 @@ class Database(PropContainer):
             self.properties[k] = v
 
         if 'types' in data:
-            for t in data['types']:
-                self.add_types(t)
+            with STATS.phase('add_types'):
+                for t in data['types']:
+                    self.add_types(t, sources.get(id(t)))
             self.calc_types()
 
         if 'tables' in data:
-            for t in data['tables']:
-                self.add_table(t)
-            # properties of tables at database level
-            for i in add_properties(data, 'tables', ):
-                self.tables[i[0]].properties[i[1]] = i[2]
+            with STATS.phase('add_tables'):
+                for t in data['tables']:
+                    self.add_table(t, sources.get(id(t)))
+                # properties of tables at database level
+                for i in add_properties(data, 'tables', ):
+                    self.tables[i[0]].set_property(i[1], i[2])
+                    self.tables[i[0]].resolved = False
             self.calc_tables()
 
-    def add_types(self, data):
+    def add_types(self, data, source=None, names=None):
         """Add types definitions to Database object.
 
         Each type is a list in the form of [name, inherit, length, decimals,
         inline properties only "name" is required, the last
         element can be a dict with inline properties
         :param data: dict containing type definitions
+        :param source: optional name of the file which defines the types
+        :param names: optional set of type names, if given only these types
+         are added
         """
         if data['type'] != 'types':
             raise Exception('Incorrect types script: %s' % data['type'])
         if not 'types' in data:
             return
         for tt in data['types']:
+            if names is not None and tt[0] not in names:
+                continue
             t = Type(tt[0])
+            t.source = source
             for i, v in enumerate(tt):
                 if type(v) is dict:
-                    t.properties = v
+                    t.properties = dict(v)
                     break
                 if i == 1:
                     t.inherit = v
@@ -150,46 +356,109 @@ class Database(PropContainer):
                     t.length = v
                 if i == 3:
                     t.properties['decimals'] = v
+            t.declare()
             self.types[t.name] = t
-        # if properties are defined, add them to the types
+        # if properties are defined, add them to the declared properties of
+        # the types, the types are calculated again
         for i in add_properties(data, 'types', ):
-            self.types[i[0]].properties[i[1]] = i[2]
+            if names is not None and i[0] not in names:
+                continue
+            t = self.types[i[0]]
+            if t.own is None:
+                t.declare()
+            length, fields, properties = t.own
+            properties = dict(properties)
+            properties[i[1]] = i[2]
+            t.own = (length, fields, properties)
+            t.resolved = False
 
     def calc_types(self):
         """ Calc types properties and SqlAlchemy base types
 
-        Recursively navigate into all types stored in self.types dictionary
-        until the root, assign SQLAlchemy type to root and to all derived types
-        and assign properties from root to derived types. This method can be
-        called from outside if types are added at runtime
+        Navigate into all types stored in self.types dictionary until the
+        root, assign SQLAlchemy type to root and to all derived types and
+        assign properties from root to derived types. Each inheritance chain
+        is walked once from the root, so the cost is linear in the number of
+        types, an exception is raised for cycles and missing parents.
+
+        This method can be called from outside if types are added at runtime,
+        only new types and types whose parent is changed are calculated, they
+        restart from their declared values, see Type.declare().
 
         :return: None
         """
-        for k, v in list(self.types.items()):
-            def _set_type(t, tb=None):
-                if t.fields:
-                    return
-                elif not tb:
-                    t.sa_type = base_types[t.name]
-                else:
-                    tb = self.types[tb]
-                    _set_type(tb, tb.inherit)
-                    t.sa_type = tb.sa_type
-                    if not t.length:
-                        t.length = tb.length
-                    if not t.fields:
-                        t.fields = tb.fields
-                    for k, v in list(tb.properties.items()):
-                        if not k in t.properties:
-                            t.properties[k] = v
-
-            v.calc_properties()
-            _set_type(v, v.inherit)
-
-    def add_table(self, data):
+        with STATS.phase('calc_types'):
+            checked = set()
+            fresh = set()
+            for name in self.types:
+                # walk the inheritance chain up to a checked type or to the root
+                chain = []
+                n = name
+                while n is not None and n not in checked:
+                    if n in chain:
+                        raise Exception('Cycle in types inheritance: %s' %
+                                        ' -> '.join(chain + [n]))
+                    if n not in self.types:
+                        raise Exception('Type "%s" inherited by "%s" not defined' %
+                                        (n, chain[-1]))
+                    chain.append(n)
+                    n = self.types[n].inherit
+                # and resolve it from the root down
+                for n in reversed(chain):
+                    t = self.types[n]
+                    tb = self.types[t.inherit] if t.inherit else None
+                    if not t.resolved or tb is not t.parent or \
+                            (tb is not None and tb.name in fresh):
+                        self._set_type(t, tb)
+                        fresh.add(n)
+                    checked.add(n)
+            for n in fresh:
+                self.types[n].attach(self.generation)
+            if self.get('intern_properties'):
+                for n in fresh:
+                    t = self.types[n]
+                    t.properties = self.intern_properties(t.properties)
+            self.invalidate_views()
+        STATS.count('types', len(fresh))
+
+    def _set_type(self, t, tb):
+        """Private method used to calc a single type from his parent
+
+        :param t: the type to calc
+        :param tb: the parent type, already calculated, or None for root types
+        :return: None
+        """
+        # values inherited from a previous parent are discarded
+        if t.own is None:
+            t.declare()
+        t.length, t.fields, t.properties = t.own
+        t.calc_properties()
+        t.parent = tb
+        t.resolved = True
+        if t.fields:
+            return
+        elif not tb:
+            if not t.name in base_types:
+                raise Exception('Root type "%s" is not a base type' % t.name)
+            t.sa_type = base_types[t.name]
+        else:
+            t.sa_type = tb.sa_type
+            if not t.length:
+                t.length = tb.length
+            if not t.fields:
+                t.fields = tb.fields
+            inherited = [(k, v) for k, v in tb.properties.items()
+                         if not k in t.properties]
+            if inherited:
+                properties = dict(t.properties)
+                properties.update(inherited)
+                t.properties = properties
+
+    def add_table(self, data, source=None):
         """Add a table to the list of tables of the database
 
         :param data: is the dict containing the Table definition
+        :param source: optional name of the file which defines the table
         :return: None
         """
         if data['type'] != 'table':
@@ -197,10 +466,13 @@ class Database(PropContainer):
         if not 'fields' in data:
             raise Exception('Fields are required in table script: %s' % data['name'])
         if 'inherit' in data:
-            t = copy.deepcopy(self.tables[data['inherit']])
-            t.set_names(self, data['name'], data.get('alias',''))
+            if not data['inherit'] in self.tables:
+                raise Exception('Table "%s" inherited by "%s" not defined' % (data['inherit'], data['name']))
+            t = self.tables[data['inherit']].derive(self, data['name'], data.get('alias',''))
         else:
             t = Table(self, data['name'], data.get('alias',''))
+        t.source = source
+        t.resolved = False
         t.calc_dict(data)
         self.tables[t.alias] = t
 
@@ -217,39 +489,179 @@ class Database(PropContainer):
         store "user variables" for each record of the main table.
 
         This method can be called more then once to recalc the database if
-        Tables are added at runtime.
+        Tables are added at runtime, only the tables not yet resolved are
+        processed. User fields tables already generated are kept, delete them
+        to force the generation.
+
+        :return: None
+        """
+        with STATS.phase('calc_tables'):
+            dirty = [v for v in self.tables.values() if not v.resolved]
+            # user fields generation
+            uf = []
+            for v in dirty:
+                if '%s%s' % (v.alias, USRFLD_SUFFIX) in self.tables:
+                    continue
+                if v.properties.get(USRFLD_KEY,False):
+                    d = {'type': 'table',
+                         'name': '%s_%s' % (v.name, USRFLD_KEY) ,
+                         'alias': '%s%s' % (v.alias, USRFLD_SUFFIX),
+                         'kind': 'child',
+                         'title': 'User fields for %s' % v.get('title'),
+                         'fields': [
+                             ['id', 'idint', 'User fields ID'],
+                             ['id_%s' % v.alias, '=%s' % v.alias, '%s' % v.get('title'), {'child': True}],
+                             ['name', 'idname', 'Variable name'],
+                             ['value', 'text', 'Variable value']
+                         ],
+                         'indexes': [
+                             ['id_%s' % v.alias, ['id_%s' % v.alias,'name'], 'Variable',
+                              {'unique': True}]
+                         ]
+                         }
+                    uf.append(d)
+            for t in uf:
+                self.add_table(t, self.tables[t['alias'][:-len(USRFLD_SUFFIX)]].source)
+                dirty.append(self.tables[t['alias']])
+            # resolve relations.
+            # at the moment primary keys uses only one column, maybe in the
+            # future we will add logic to handle multiple columns primary keys
+            with STATS.phase('resolve_relations'):
+                intern = self.get('intern_properties')
+                for v in dirty:
+                    for f in v.fields:
+                        if type(f.type) is str:
+                            if not f.type[1:] in self.tables:
+                                raise Exception('Table "%s" related by field "%s" of table "%s" not defined'
+                                                % (f.type[1:], f.name, v.alias))
+                            f.type = self.tables[f.type[1:]]
+                        if intern:
+                            f.properties = self.intern_properties(f.properties)
+                        f.attach(self.generation)
+                    for i in v.indexes:
+                        if intern:
+                            i.properties = self.intern_properties(i.properties)
+                        i.attach(self.generation)
+                    v.attach(self.generation)
+                    v.resolved = True
+            self.invalidate_views()
+        STATS.count('tables', len(dirty))
+        STATS.count('fields', sum(len(v.fields) for v in dirty))
+        STATS.count('expanded_fields', sum(len(g) for v in dirty for g in v.groups.values()))
+        STATS.count('packed_elements', sum(len(v.packed) for v in dirty))
+
+    def intern_properties(self, properties):
+        """Return a shared dict equal to the properties dict
+
+        Types, fields and indexes with equal properties share the same dict,
+        a FrozenProperties which can't be changed in place. The properties
+        are interned by calc_types() and calc_tables() only if the database
+        has the property "intern_properties: true", so that the properties
+        of large schemas take less memory, but they must be changed with
+        PropContainer.set_property() or by assigning a new dict.
+
+        :param properties: the properties dict
+        :return: the interned dict
+        """
+        try:
+            key = _freeze(properties)
+            hash(key)
+        except TypeError:
+            return properties
+        interned = self.interned.get(key)
+        if interned is None:
+            if not isinstance(properties, FrozenProperties):
+                properties = FrozenProperties(properties)
+            interned = self.interned[key] = properties
+        return interned
+
+    def memory_report(self):
+        """Return the memory used by the Database metadata
+
+        Shared objects such as interned properties are counted once, in the
+        first category which uses them.
+
+        :return: a dict {category: {'count': n, 'bytes': size}} for the
+         categories types, tables, fields, indexes, properties, views and
+         total
+        """
+        seen = set()
+        report = dict((k, {'count': 0, 'bytes': 0}) for k in
+                      ['types', 'tables', 'fields', 'indexes', 'properties',
+                       'views', 'total'])
+
+        def _add(category, obj):
+            n = _sizeof(obj, seen)
+            report[category]['bytes'] += n
+            if n:
+                report[category]['count'] += 1
+
+        def _add_object(category, obj, skip=()):
+            if id(obj) in seen:
+                return
+            seen.add(id(obj))
+            size = sys.getsizeof(obj)
+            for k, v in obj.instance_vars().items():
+                if k not in skip and not isinstance(v, (PropContainer, type)):
+                    size += _sizeof(v, seen)
+            report[category]['bytes'] += size
+            report[category]['count'] += 1
+            _add('properties', obj.properties)
+            if obj.view is not None:
+                _add('views', obj.view)
+
+        for t in self.types.values():
+            _add_object('types', t)
+        for t in self.tables.values():
+            _add_object('tables', t, ('fields', 'indexes', 'fnames', 'inames'))
+            for k in ('fields', 'indexes', 'fnames', 'inames'):
+                report['tables']['bytes'] += _sizeof(getattr(t, k), seen, False)
+            for f in t.fields:
+                _add_object('fields', f, ('type',))
+            for i in t.indexes:
+                _add_object('indexes', i)
+        report['total']['bytes'] = sum(v['bytes'] for k, v in report.items()
+                                       if k != 'total')
+        report['total']['count'] = sum(v['count'] for k, v in report.items()
+                                       if k != 'total')
+        return report
+
+    def invalidate_views(self):
+        """Clear the cached views of properties of all objects
+
+        Views are rebuilt on demand, the changes of properties invalidate
+        them, this method must be called after changing instance variables
+        at runtime and releases their memory. It is called by calc_types()
+        and calc_tables().
 
         :return: None
         """
-        # user fields generation
-        uf = []
-        for k,v in list(self.tables.items()):
-            if v.properties.get(USRFLD_KEY,False):
-                d = {'type': 'table',
-                     'name': '%s_%s' % (v.name, USRFLD_KEY) ,
-                     'alias': '%s%s' % (v.alias, USRFLD_SUFFIX),
-                     'kind': 'child',
-                     'title': 'User fields for %s' % v.get('title'),
-                     'fields': [
-                         ['id', 'idint', 'User fields ID'],
-                         ['id_%s' % v.alias, '=%s' % v.alias, '%s' % v.get('title'), {'child': True}],
-                         ['name', 'idname', 'Variable name'],
-                         ['value', 'text', 'Variable value']
-                     ],
-                     'indexes': [
-                         ['id_%s' % v.alias, ['id_%s' % v.alias,'name'], 'Variable']
-                     ]
-                     }
-                uf.append(d)
-        for t in uf:
-            self.add_table(t)
-        # resolve relations.
-        # at the moment primary keys uses only one column, maybe in the
-        # future we will add logic to handle multiple columns primary keys
-        for k,v in list(self.tables.items()):
-            for f in v.fields:
-                if type(f.type) is str:
-                    f.type = self.tables[f.type[1:]]
+        self.view = None
+        for t in self.types.values():
+            t.view = None
+        for t in self.tables.values():
+            t.view = None
+            for f in t.fields:
+                f.view = None
+            for i in t.indexes:
+                i.view = None
+
+    def build_views(self):
+        """Build the views of properties of all tables, fields and types
+
+        Views are built on demand by get(), this method builds them all at
+        once, ie. before forking worker processes.
+
+        :return: None
+        """
+        for t in self.types.values():
+            t.props()
+        for t in self.tables.values():
+            t.props()
+            for f in t.fields:
+                f.props()
+            for i in t.indexes:
+                i.props()
 
 
 class Type(PropContainer):
@@ -267,7 +679,14 @@ class Type(PropContainer):
     by the name of fields contained, ie: if the name of field is "add_" and
     the fields are ["street", "city", "zip"], the generated field are
     "add_street", "add_city" and "add_zip"
+    If the type or the field has the property "packed" the array or compound
+    value is stored into a single JSON column named as the field, the type of
+    the field is a PackedType, and the generated names are element accessors
+    of the orm class.
     """
+    __slots__ = ('sa_type', 'name', 'inherit', 'length', 'fields', 'source',
+                 'parent', 'resolved', 'own')
+
     def __init__(self, name):
         """Init the Type object
 
@@ -280,17 +699,65 @@ class Type(PropContainer):
         self.inherit = None
         self.length = 0
         self.fields = []
+        self.source = None
+        self.parent = None
+        self.resolved = False
+        self.own = None
+
+    def declare(self):
+        """Keep the declared length, fields and properties of the type
+
+        Database.calc_types() restores them before the type inherits from its
+        parent, call this method after changing them at runtime.
+
+        :return: None
+        """
+        self.own = (self.length, self.fields, self.properties)
+        self.resolved = False
 
     def calc_properties(self):
         """ transform known properties to fields """
         def _to_field(t, prop):
             if prop in t.properties:
                 setattr(t, prop, t.properties[prop])
-                del t.properties[prop]
+                properties = dict(t.properties)
+                del properties[prop]
+                t.properties = properties
         _to_field(self, 'length')
         _to_field(self, 'fields')
 
 
+class PackedType(Type):
+    """
+    Type of the JSON column of a packed array or compound field, built by
+    Table._add_field(). It has the properties of the packed type, which is
+    its parent.
+    """
+    __slots__ = ()
+
+    def __init__(self, type_):
+        """Init the packed type
+
+        :param type_: the array or compound Type
+        :return: None
+        """
+        Type.__init__(self, type_.name)
+        self.sa_type = sa.JSON
+        self.length = type_.length
+        self.fields = type_.fields
+        self.parent = type_
+        self.resolved = True
+
+    def calc_view(self):
+        """Calc the merged view of the packed type and of the type
+
+        :return: the merged dict
+        """
+        view = dict(self.parent.props())
+        view.update(Type.calc_view(self))
+        return view
+
+
 class Table(PropContainer):
     """
     This object contain a definition of a single table.
@@ -303,7 +770,19 @@ class Table(PropContainer):
       dictionaries, by default is the same of name
     key: is the reference of field used as primary key
     fnames and inames are dict used to find field and indexes by name
+    groups: dict of fields generated by array and compound types, the key is
+      the name of the declared field and the value the list of tuples
+      (index or member name, generated field name)
+    packed: dict of elements of array and compound fields with the "packed"
+      property, stored into one JSON column, the key is the element name and
+      the value the tuple (field name, index or member name, element Type)
+    source: name of the yaml file which defines the table, if known
+    uses: set of names of types used by the fields of the table
+    resolved: True when relations are resolved by Database.calc_tables()
     """
+    __slots__ = ('db', 'name', 'alias', 'key', 'fields', 'fnames', 'indexes',
+                 'inames', 'groups', 'packed', 'source', 'uses', 'resolved')
+
     def __init__(self, db, name, alias=''):
         """Init the Tablle object
 
@@ -319,6 +798,11 @@ class Table(PropContainer):
         self.fnames = {}
         self.indexes = []
         self.inames = {}
+        self.groups = {}
+        self.packed = {}
+        self.source = None
+        self.uses = set()
+        self.resolved = False
 
     def set_names(self, db, name, alias=''):
         """Set names for table, splitted from __initi__ to handle inheritance
@@ -334,6 +818,67 @@ class Table(PropContainer):
         if not alias:
             self.alias = name
 
+    def derive(self, db, name, alias=''):
+        """Build a new table which inherits from this table
+
+        Fields, indexes and their types are shared with this table and are
+        copied only when the derived table changes them (see _own_field and
+        _own_index), so the cost of inheritance is proportional to what the
+        derived table overrides. Shared fields and indexes keep the reference
+        to the table which defines them.
+
+        :param db: reference to container db
+        :param name: name of the new table
+        :param alias: optional alias for the new table name
+        :return: the new Table object
+        """
+        t = Table(db, name, alias)
+        t.properties = dict(self.properties)
+        t.key = self.key
+        t.fields = list(self.fields)
+        t.fnames = dict(self.fnames)
+        t.indexes = list(self.indexes)
+        t.inames = dict(self.inames)
+        t.groups = dict(self.groups)
+        t.packed = dict(self.packed)
+        t.uses = set(self.uses)
+        return t
+
+    def _own_field(self, name):
+        """Return a field of the table, copying it if is shared with the
+        parent table, so it can be changed.
+
+        :param name: name of the field
+        :return: the Field object
+        """
+        f = self.fnames[name]
+        if f.table is not self:
+            nf = copy.copy(f)
+            nf.table = self
+            nf.view = None
+            self.fields[self.fields.index(f)] = nf
+            self.fnames[name] = nf
+            if self.key is f:
+                self.key = nf
+            f = nf
+        return f
+
+    def _own_index(self, name):
+        """Return an index of the table, copying it if is shared with the
+        parent table, so it can be changed.
+
+        :param name: name of the index
+        :return: the Index object
+        """
+        i = self.inames[name]
+        if i.table is not self:
+            ni = copy.copy(i)
+            ni.table = self
+            ni.view = None
+            self.indexes[self.indexes.index(i)] = ni
+            self.inames[name] = ni
+            i = ni
+        return i
 
     def calc_dict(self, data):
         """Build the table values using a dict read from yaml file.
@@ -347,32 +892,35 @@ class Table(PropContainer):
                 continue
             self.properties[k] = v
 
-        # set kind of table
+        # set kind of table, inherited tables may have it already set
         self.properties.setdefault('kind','anag')
-        self.properties['kind'] = table_kinds.index(self.properties['kind'])
+        if not isinstance(self.properties['kind'], int):
+            self.properties['kind'] = table_kinds.index(self.properties['kind'])
 
         # add fields
         for f in data['fields']:
             self._add_field(f)
         for i in add_properties(data, 'fields', ):
-            self.fnames[i[0]].properties[i[1]] = i[2]
+            # properties may be shared with yaml data or other fields
+            self._own_field(i[0]).set_property(i[1], i[2])
 
         # if there are no indexes declared the primary key is the first field
-        if not 'indexes' in data:
-            data['indexes'] = []
+        # or the key of the parent table for inherited tables.
+        # the yaml data may be shared so it is never modified
+        indexes = list(data.get('indexes') or [])
         # one and only one primary key per table
         primary = 0
-        for i in data['indexes']:
+        for i in indexes:
             if i[0] == 'primary':
                 primary += 1
         if primary > 1:
             raise Exception('More then one primary key in "%s" table script' % data['name'])
-        if not primary:
-            data['indexes'].insert(0, ['primary', data['fields'][0][0], data['fields'][0][2]])
-        for i in data['indexes']:
+        if not primary and self.key is None:
+            indexes.insert(0, ['primary', data['fields'][0][0], data['fields'][0][2]])
+        for i in indexes:
             self._add_index(i)
         for i in add_properties(data, 'indexes', ):
-            self.inames[i[0]].properties[i[1]] = i[2]
+            self._own_index(i[0]).set_property(i[1], i[2])
 
     def _add_field(self, field, compound=False):
         """Private method used to add a single field to the table.
@@ -392,29 +940,54 @@ class Table(PropContainer):
         if field[1][0] == '=':
             ft = field[1]
         else:
+            self.uses.add(field[1])
             if not field[1] in self.db.types:
                 raise Exception('Type "%s" of field "%s" not defined in table "%s"' % (field[1], field[0], self.name))
             ft = self.db.types[field[1]]
-            if not compound:
+            fprops = field[3] if len(field) > 3 and isinstance(field[3], dict) else {}
+            if not compound and fprops.get('packed', ft.properties.get('packed')):
+                # packed array or compound: one column and element accessors
                 fname = field[0]
                 if 'array' in ft.properties:
-                    ff = copy.deepcopy(field)
+                    for i in range(ft.properties['array']):
+                        self.packed['%s%02d' % (fname, i + 1)] = (fname, i, ft)
+                for i in ft.fields or []:
+                    if not i[1] in self.db.types:
+                        raise Exception('Type "%s" of field "%s" not defined in table "%s"' % (i[1], i[0], self.name))
+                    self.uses.add(i[1])
+                    self.packed['%s%s' % (fname, i[0])] = (fname, i[0], self.db.types[i[1]])
+                ft = PackedType(ft)
+                ft.attach(self.db.generation)
+            elif not compound:
+                fname = field[0]
+                if 'array' in ft.properties:
+                    ff = list(field)
+                    self.groups[fname] = []
                     for i in range(ft.properties['array']):
                         ff[0] = '%s%02d' % (fname, i + 1)
                         self._add_field(ff, True)
+                        self.groups[fname].append((i, ff[0]))
                     ft = None
                 elif ft.fields:
+                    self.groups[fname] = []
                     for i in ft.fields:
-                        ff = copy.deepcopy(i)
+                        ff = list(i)
                         ff[0] = '%s%s' % (fname, i[0])
                         self._add_field(ff, True)
+                        self.groups[fname].append((i[0], ff[0]))
                     ft = None
         if ft:
             f = Field(self, field[0], ft)
             f.description = field[2]
             if len(field) > 3:
                 f.properties = field[3]
-            self.fields.append(f)
+            if f.name in self.fnames:
+                # redefinition of an inherited field
+                self.fields[self.fields.index(self.fnames[f.name])] = f
+                if self.key is self.fnames[f.name]:
+                    self.key = f
+            else:
+                self.fields.append(f)
             self.fnames[f.name] = f
 
     def _add_index(self, index):
@@ -433,7 +1006,11 @@ class Table(PropContainer):
         i.description = index[2]
         if len(index) > 3:
             i.properties = index[3]
-        self.indexes.append(i)
+        if i.name in self.inames:
+            # redefinition of an inherited index
+            self.indexes[self.indexes.index(self.inames[i.name])] = i
+        else:
+            self.indexes.append(i)
         self.inames[i.name] = i
         if i.name == 'primary':
             self.key = self.fnames[i.fields[0]]
@@ -446,7 +1023,14 @@ class Field(PropContainer):
     The field has his own properties, but inherit properties for his Type and
     if is a related field inherit properties form key field of the related
     table.
+
+    table is the table which defines the field: the fields inherited by a
+    derived table are shared with the parent table until the derived table
+    changes them, so their table is the parent one. Code which walks the
+    fields of a table must use that table, not field.table.
     """
+    __slots__ = ('table', 'name', 'type', 'description')
+
     def __init__(self, table, name, type_):
         """Init the Field object
 
@@ -461,21 +1045,20 @@ class Field(PropContainer):
         self.type = type_
         self.description = ''
 
-    def get(self, key, default=None):
-        """Get a property of a field.
+    def calc_view(self):
+        """Calc the merged view of properties of a field.
 
-        If not found return the property of the type of field, if is a related
-        field search also in the key of related table.
+        The properties of the type of field, or of the key of related table
+        if is a related field, are overridden by instance variables and by
+        properties of the field. Falsy values of the field such as
+        "nullable: False" are kept.
 
-        :param key: key to search
-        :param default: default value if not found
-        :return: the property value or default
+        :return: the merged dict
         """
-        v = PropContainer.get(self, key)
-        if v:
-            return v
         t = self.get_type()
-        return t.get(key, default)
+        view = dict(t.props()) if isinstance(t, PropContainer) else {}
+        view.update(PropContainer.calc_view(self))
+        return view
 
     def get_type(self):
         """Return the type of field and if is a related table return the
@@ -490,6 +1073,8 @@ class Index(PropContainer):
     """
     This object store optionals indexes of Tables.
     """
+    __slots__ = ('table', 'name', 'fields', 'description')
+
     def __init__(self, table, name, fields):
         """Init the index object
         :param table: reference to the Table objet
@@ -508,6 +1093,33 @@ class Index(PropContainer):
         self.properties = {}
 
 
+def _freeze(value):
+    """Return a hashable key for a properties value, types are part of the
+    key so True and 1 are different values"""
+    if isinstance(value, dict):
+        return ('dict',) + tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__,) + tuple(_freeze(v) for v in value)
+    return (type(value).__name__, value)
+
+
+def _sizeof(obj, seen, deep=True):
+    """Return the size of an object and of the containers it holds, objects
+    already seen and DynaQ objects are not counted"""
+    if id(obj) in seen or isinstance(obj, (PropContainer, type)):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += _sizeof(k, seen) + (_sizeof(v, seen) if deep else 0)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        if deep:
+            for v in obj:
+                size += _sizeof(v, seen)
+    return size
+
+
 def add_properties(data, key):
     """Generator function for properties of each yaml file
 
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# lookup.py
+#
+# Copyright (c) 2014
+# Author: Claudio Driussi <claudio.driussi@gmail.com>
+#
+import time
+import threading
+from .db import *
+
+
+class LookupCache(object):
+    """
+    In memory copy of the tables of kind "tab" of a WorkSpace.
+
+    The tables are small and rarely changed, so each table is read with one
+    query on first use and the lookups by primary key and by declared
+    indexes are served from dicts. The rows are dicts of field values.
+
+    The writes executed by the engine of the workspace, by the orm, the bulk
+    functions or Core statements, invalidate the table when executed and
+    again when committed, so the cache never keeps data older than the last
+    commit. The writes of other processes are seen after ttl seconds.
+
+    The options are read from the "lookup" property of the database, ie:
+    lookup: {ttl: 300, prefill: true}
+    ttl: seconds after which a table is read again, by default never
+    prefill: if true the sessions of WorkSpace.session() and
+      current_session() have the cached objects in the identity map
+
+    hits, misses: lookups served from memory and tables loads
+    invalidations: number of tables invalidated by writes
+    """
+    def __init__(self, ws, ttl=None, prefill=False):
+        """init the cache
+
+        :param ws: the WorkSpace
+        :param ttl: seconds after which a table is loaded again, None for ever
+        :param prefill: if True new sessions are prefilled, see prefill()
+        :return: None
+        """
+        self.ws = ws
+        self.ttl = ttl
+        self.prefill_sessions = prefill
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.names = (-1, {})
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def aliases(self):
+        """Return the list of aliases of the cached tables"""
+        return [alias for alias, t in self.ws.db.tables.items()
+                if t.get('kind') == TK_TAB]
+
+    def listen(self, engine):
+        """Invalidate the tables written through the engine
+
+        :param engine: SQLAlchemy engine
+        :return: None
+        """
+        sa.event.listen(engine, 'after_execute', self._on_execute)
+        sa.event.listen(engine, 'commit', self._on_commit)
+        sa.event.listen(engine, 'rollback', self._on_commit)
+
+    def unlisten(self, engine):
+        """Remove the listeners added by listen()
+
+        :param engine: SQLAlchemy engine
+        :return: None
+        """
+        for name, fn in (('after_execute', self._on_execute), ('commit', self._on_commit),
+                         ('rollback', self._on_commit)):
+            if sa.event.contains(engine, name, fn):
+                sa.event.remove(engine, name, fn)
+
+    def _on_execute(self, conn, clauseelement, multiparams, params, result):
+        if not isinstance(clauseelement, sa.sql.expression.UpdateBase):
+            return
+        alias = self._alias(clauseelement.table.name)
+        if alias is not None:
+            self._cache(conn).invalidate(alias)
+            conn.info.setdefault('dynaq_lookup', set()).add(alias)
+
+    def _on_commit(self, conn):
+        cache = self._cache(conn)
+        for alias in conn.info.pop('dynaq_lookup', ()):
+            cache.invalidate(alias)
+
+    def _cache(self, conn):
+        """Return the cache of the tenant of a connection, see tenant.Tenant"""
+        tenant = conn.get_execution_options().get('dynaq_tenant')
+        return self if tenant is None else tenant.lookup_cache
+
+    def _alias(self, tname):
+        """Return the alias of a cached table from its physical name"""
+        # the map is rebuilt when classes are generated
+        if self.names[0] != len(self.ws.tables):
+            self.names = (len(self.ws.tables), dict(
+                (self.ws.tables[alias].__table__.name, alias)
+                for alias in self.aliases() if alias in self.ws.tables))
+        return self.names[1].get(tname)
+
+    def entry(self, alias, conn=None):
+        """Return the cached data of a table, load it if needed
+
+        :param alias: alias name of the table
+        :param conn: SQLAlchemy connection used to load the table, by
+         default a new connection
+        :return: a dict with the keys "rows" {key: row}, "indexes"
+         {index name: {tuple of values: list of rows}} and "time"
+        """
+        with self.lock:
+            e = self.entries.get(alias)
+            if e is not None and (self.ttl is None or time.time() - e['time'] < self.ttl):
+                self.hits += 1
+                return e
+            self.misses += 1
+            e = self.entries[alias] = self._load(alias, conn)
+            return e
+
+    def _load(self, alias, conn=None):
+        """Read a whole table"""
+        table = self.ws.db.tables[alias]
+        if table.get('kind') != TK_TAB:
+            raise Exception('Table "%s" is not of kind "tab"' % alias)
+        sa_table = self.ws.map_table(alias).__table__
+        e = {'rows': {}, 'indexes': {}, 'time': time.time()}
+        if conn is None:
+            with self.ws.engine.connect() as conn:
+                return self._load(alias, conn)
+        result = conn.execute(sa.select([sa_table]))
+        keys = result.keys()
+        for r in result:
+            row = dict(zip(keys, r))
+            e['rows'][row[table.key.name]] = row
+        for i in table.indexes:
+            if i.name == 'primary':
+                continue
+            index = e['indexes'][i.name] = {}
+            for row in e['rows'].values():
+                index.setdefault(tuple(row[f] for f in i.fields), []).append(row)
+        return e
+
+    def get(self, alias, key):
+        """Return a row by primary key
+
+        :param alias: alias name of the table
+        :param key: value of the primary key
+        :return: the row dict or None
+        """
+        return self.entry(alias)['rows'].get(key)
+
+    def rows(self, alias):
+        """Return the list of all rows of a table"""
+        return list(self.entry(alias)['rows'].values())
+
+    def lookup(self, alias, index, *values):
+        """Return the rows by the values of a declared index
+
+        :param alias: alias name of the table
+        :param index: name of the index
+        :param values: values of the fields of the index
+        :return: the list of rows
+        """
+        indexes = self.entry(alias)['indexes']
+        if index not in indexes:
+            raise Exception('Index "%s" not defined in table "%s"' % (index, alias))
+        return list(indexes[index].get(tuple(values), []))
+
+    def invalidate(self, alias=None):
+        """Discard a table or all tables, they are loaded on next use
+
+        :param alias: alias name of the table, None for all tables
+        :return: None
+        """
+        with self.lock:
+            if alias is None:
+                self.names = (-1, {})
+                self.invalidations += len(self.entries)
+                self.entries.clear()
+            elif self.entries.pop(alias, None) is not None:
+                self.invalidations += 1
+
+    def load_all(self, conn=None):
+        """Load all cached tables, ie: at startup
+
+        :param conn: optional SQLAlchemy connection
+        :return: None
+        """
+        for alias in self.aliases():
+            self.entry(alias, conn)
+
+    def prefill(self, session):
+        """Put the objects of cached tables into the identity map of a session
+
+        The objects are merged without queries, so session.query(cls).get()
+        and the many to one relationships pointing to cached tables do not
+        execute queries until the objects are expired by a commit. The
+        objects are referenced by session.info so they are not discarded by
+        the weak identity map.
+
+        :param session: SQLAlchemy session
+        :return: None
+        """
+        objects = session.info.setdefault('dynaq_lookup', [])
+        for alias in self.aliases():
+            cls = self.ws.map_table(alias)
+            for row in self.rows(alias):
+                obj = cls(**row)
+                sa.orm.make_transient_to_detached(obj)
+                objects.append(session.merge(obj, load=False))
+
+    def as_dict(self):
+        """Return the statistics as a dict"""
+        return {'tables': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations}
+
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# planner.py
+#
+# Copyright (c) 2014
+# Author: Claudio Driussi <claudio.driussi@gmail.com>
+#
+from .db import *
+
+# actions of planned indexes
+IX_KEEP = 'keep'    # declared index, created
+IX_ADD = 'add'      # derived index, created
+IX_DROP = 'drop'    # declared index covered by another one, not created
+IX_SKIP = 'skip'    # derived index covered by another one, not created
+
+
+class PlannedIndex(object):
+    """
+    An index of the plan of a table.
+
+    name: name of the index, the declared name or, for derived indexes, the
+      names of the fields
+    fields: tuple of the indexed fields
+    unique: True for unique indexes, they are never dropped
+    descending: True for declared indexes with "ascending: false"
+    sources: why the index is needed, a list of "primary", "declared",
+      "relation" (foreign key of a "=table" field), "child" (foreign key of
+      a child field), "order_by" (order of a collection of the parent),
+      "usrfld" (lookups of user fields) and "ordering" (declared with the
+      "ascending" property)
+    action: one of IX_KEEP, IX_ADD, IX_DROP, IX_SKIP
+    covered_by: name of the index which makes the index redundant
+    """
+    def __init__(self, name, fields, unique=False, descending=False, source='declared'):
+        """init the index"""
+        self.name = name
+        self.fields = tuple(fields)
+        self.unique = unique
+        self.descending = descending
+        self.sources = [source]
+        self.action = IX_KEEP if source == 'declared' else IX_ADD
+        self.covered_by = None
+
+    def created(self):
+        """Return True if the index is created into the database"""
+        return self.action in (IX_KEEP, IX_ADD) and 'primary' not in self.sources
+
+    def __repr__(self):
+        return '<PlannedIndex %s %s %s>' % (self.action, self.name, list(self.fields))
+
+
+class IndexPlan(object):
+    """
+    Plan of the indexes of the tables of a Database, a dict {alias: list of
+    PlannedIndex objects}, the primary key first.
+    """
+    def __init__(self, db):
+        """build the plan of all tables"""
+        self.tables = dict((alias, plan_table(db, t)) for alias, t in db.tables.items())
+
+    def __iter__(self):
+        for alias in sorted(self.tables):
+            for i in self.tables[alias]:
+                yield alias, i
+
+    def count(self, action):
+        """Return the number of indexes with an action"""
+        return sum(1 for alias, i in self if i.action == action and 'primary' not in i.sources)
+
+    def report(self):
+        """Return the plan as text to be reviewed before it is applied
+
+        :return: a string, one line for each index but primary keys
+        """
+        lines = []
+        for alias, i in self:
+            if 'primary' in i.sources:
+                continue
+            note = ', '.join(i.sources)
+            if i.covered_by:
+                note += ' (covered by %s)' % i.covered_by
+            lines.append('%-5s %-12s %-20s %-30s %s' % (
+                i.action, alias, i.name,
+                ', '.join(i.fields) + (' desc' if i.descending else '') +
+                (' unique' if i.unique else ''), note))
+        lines.append('%d kept, %d added, %d dropped, %d skipped' % (
+            self.count(IX_KEEP), self.count(IX_ADD), self.count(IX_DROP), self.count(IX_SKIP)))
+        return '\n'.join(lines)
+
+
+def plan(db):
+    """Return the IndexPlan of a Database
+
+    :param db: the DynaQ Database
+    :return: the IndexPlan object
+    """
+    return IndexPlan(db)
+
+
+def plan_table(db, table):
+    """Plan the indexes of a table
+
+    The declared indexes are merged with the indexes derived from:
+    - the foreign keys of related fields, unless the field has the property
+      "index: false"
+    - the order of collections loaded by child and backref relationships,
+      the foreign key followed by the fields of the "order_by" property
+    Indexes with the same fields are merged, non unique indexes whose fields
+    are the first fields of another index are redundant.
+
+    :param db: the DynaQ Database
+    :param table: the DynaQ Table
+    :return: the list of PlannedIndex, the primary key first
+    """
+    ii = []
+    if table.key is not None:
+        ii.append(PlannedIndex('primary', [table.key.name], True, source='primary'))
+    usrfld = table.alias.endswith(USRFLD_SUFFIX) and \
+        table.alias[:-len(USRFLD_SUFFIX)] in db.tables
+    for i in table.indexes:
+        if i.name == 'primary':
+            continue
+        x = PlannedIndex(i.name, i.fields, bool(i.get('unique')),
+                         i.get('ascending', True) is False)
+        if usrfld:
+            x.sources.append('usrfld')
+        if 'ascending' in i.properties:
+            x.sources.append('ordering')
+        ii.append(x)
+    for f in table.fields:
+        if not isinstance(f.type, Table) or f.get('index', True) is False:
+            continue
+        _merge(ii, table, [f.name], 'child' if f.get('child') else 'relation')
+        if f.get('order_by') and (f.get('child') or f.get('backref')):
+            fields = [f.name] + [x for x in _order_fields(table, f.get('order_by'))
+                                 if x != f.name]
+            _merge(ii, table, fields, 'order_by')
+    # longer indexes first, so the covering index has its final action
+    for x in sorted(ii, key=lambda i: -len(i.fields)):
+        if x.unique:
+            continue
+        for y in ii:
+            if y is not x and y.descending == x.descending and \
+                    len(y.fields) > len(x.fields) and y.fields[:len(x.fields)] == x.fields and \
+                    y.action in (IX_KEEP, IX_ADD):
+                x.action = IX_DROP if x.action == IX_KEEP else IX_SKIP
+                x.covered_by = y.name
+                break
+    return ii
+
+
+def _merge(ii, table, fields, source):
+    """Add a derived index or add the source to an index with same fields"""
+    fields = tuple(fields)
+    for x in ii:
+        if x.fields == fields and not x.descending:
+            if source not in x.sources:
+                x.sources.append(source)
+            return
+    name = '_'.join(fields)
+    while name in table.inames or name in [x.name for x in ii]:
+        name += '_ix'
+    ii.append(PlannedIndex(name, fields, source=source))
+
+
+def _order_fields(table, order_by):
+    """Return the fields of an order_by property, an index name or a list"""
+    if isinstance(order_by, str):
+        if order_by in table.inames:
+            return list(table.inames[order_by].fields)
+        return [order_by]
+    return list(order_by)
+
+
+def table_indexes(db, table):
+    """Return the indexes created for a table
+
+    If the Database has the property "index_plan" the indexes are the ones
+    of the plan, see plan_table(), otherwise the declared indexes.
+
+    :param db: the DynaQ Database
+    :param table: the DynaQ Table
+    :return: list of tuples (name, fields, unique, descending), descending
+     is True for indexes with the property "ascending: false"
+    """
+    if db.get('index_plan'):
+        indexes = [(i.name, list(i.fields), i.unique, i.descending)
+                   for i in plan_table(db, table) if i.created()]
+    else:
+        indexes = [(i.name, i.fields, bool(i.get('unique')), i.get('ascending', True) is False)
+                   for i in table.indexes if i.name != 'primary']
+    for name, fields, unique, descending in indexes:
+        for x in fields:
+            if x in table.packed:
+                raise Exception('Index "%s" of table "%s" uses the packed element "%s", '
+                                'packed elements can not be indexed' % (name, table.name, x))
+    return indexes
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# query.py
+#
+# Copyright (c) 2014
+# Author: Claudio Driussi <claudio.driussi@gmail.com>
+#
+import threading
+import collections
+from .db import *
+from . import bulk
+
+# operators of where conditions
+OPERATORS = {
+    '=': lambda c, p: c == p,
+    '!=': lambda c, p: c != p,
+    '<': lambda c, p: c < p,
+    '<=': lambda c, p: c <= p,
+    '>': lambda c, p: c > p,
+    '>=': lambda c, p: c >= p,
+    'like': lambda c, p: c.like(p),
+    'in': lambda c, p: c.in_(p),
+}
+
+
+class Query(object):
+    """
+    Query built on DynaQ table aliases and field names.
+
+    Fields are paths of field names starting from the table, related fields
+    are followed with outer joins, ie: from the "row" table the path
+    "id_prd.description" is the description of the product of the row and
+    "id_ord.id_sbj.name" is the name of the customer of the order of the row.
+    Array and compound fields are expanded, elements of packed fields can be
+    used as fields.
+
+    The values of where conditions are passed when the query is executed,
+    so the statement is compiled once for each query shape and the compiled
+    statement is kept into the QueryCache of the WorkSpace.
+    Usage:
+         q = ws.query('row', ['n_order', 'id_prd.description'],
+                      [('id_ord', '='), ('qt', '>', 'min_qt')], ['n_order'])
+         rows = q.all(id_ord=1, min_qt=10)
+    """
+    def __init__(self, ws, alias, fields=None, where=None, order_by=None,
+                 limit=None):
+        """Init the query
+
+        :param ws: the WorkSpace
+        :param alias: alias name of the main table
+        :param fields: list of field paths, by default all fields of the table
+        :param where: list of conditions joined with "and", each condition is
+         a tuple (field path, operator, parameter name), see OPERATORS, the
+         operator is "=" and the parameter name is the path with "_" in place
+         of "." if omitted, the "in" operator takes a list of values
+        :param order_by: list of field paths, with a "-" prefix for
+         descending order
+        :param limit: max number of rows
+        :return: None
+        """
+        self.ws = ws
+        self.alias = alias
+        self.fields = tuple(fields or [f.name for f in ws.db.tables[alias].fields])
+        self.where = tuple(_condition(w) for w in where or [])
+        self.order_by = tuple(order_by or [])
+        self.limit = limit
+
+    def key(self):
+        """Return the shape of the query, the key of the compiled statement"""
+        return (self.alias, self.fields, self.where, self.order_by, self.limit)
+
+    def statement(self):
+        """Build the SQLAlchemy select statement
+
+        :return: the select statement
+        """
+        builder = _Builder(self.ws, self.alias)
+        columns = []
+        for path in self.fields:
+            columns.extend(builder.columns(path))
+        query = sa.select(columns)
+        for path, op, name in self.where:
+            if op not in OPERATORS:
+                raise Exception('Unknown operator "%s"' % op)
+            param = sa.bindparam(name, expanding=op == 'in')
+            query = query.where(OPERATORS[op](builder.column(path), param))
+        for path in self.order_by:
+            if path.startswith('-'):
+                query = query.order_by(builder.column(path[1:]).desc())
+            else:
+                query = query.order_by(builder.column(path))
+        if self.limit is not None:
+            query = query.limit(self.limit)
+        return query.select_from(builder.source)
+
+    def compiled(self):
+        """Return the compiled statement from the cache of the WorkSpace
+
+        :return: the SQLAlchemy Compiled object
+        """
+        return self.ws.query_cache.get(self)
+
+    def execute(self, conn=None, **params):
+        """Execute the query
+
+        :param conn: SQLAlchemy connection, by default the engine
+        :param params: values of the parameters of where conditions
+        :return: the SQLAlchemy result
+        """
+        return (conn or self.ws.engine).execute(self.compiled(), params)
+
+    def all(self, conn=None, **params):
+        """Execute the query and return all rows
+
+        :return: the list of dicts keyed by field paths
+        """
+        result = self.execute(conn, **params)
+        keys = result.keys()
+        return [dict(zip(keys, r)) for r in result.fetchall()]
+
+    def first(self, conn=None, **params):
+        """Execute the query and return the first row
+
+        :return: a dict keyed by field paths or None
+        """
+        result = self.execute(conn, **params)
+        keys = result.keys()
+        r = result.first()
+        return dict(zip(keys, r)) if r is not None else None
+
+
+class QueryCache(object):
+    """
+    Cache of compiled statements of a WorkSpace, keyed on the query shape.
+
+    size: max number of statements, the least recently used are discarded
+    hits, misses: number of queries found and compiled
+    evictions: number of discarded statements
+    schema_translate_map: schema map applied when statements are compiled
+    """
+    def __init__(self, size=500, schema_translate_map=None):
+        """init the cache
+
+        :param size: max number of compiled statements
+        :param schema_translate_map: optional dict {schema: schema}, the
+         compiled statements don't use the map of the connection
+        :return: None
+        """
+        self.size = size
+        self.schema_translate_map = schema_translate_map
+        self.lock = threading.Lock()
+        self.statements = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, query):
+        """Return the compiled statement of a query, compile it if needed
+
+        :param query: the Query object
+        :return: the SQLAlchemy Compiled object
+        """
+        key = query.key()
+        with self.lock:
+            compiled = self.statements.get(key)
+            if compiled is not None:
+                self.hits += 1
+                self.statements.move_to_end(key)
+                return compiled
+            self.misses += 1
+        if self.schema_translate_map:
+            compiled = query.statement().compile(
+                dialect=query.ws.engine.dialect,
+                schema_translate_map=self.schema_translate_map)
+        else:
+            compiled = query.statement().compile(dialect=query.ws.engine.dialect)
+        with self.lock:
+            self.statements[key] = compiled
+            while len(self.statements) > self.size:
+                self.statements.popitem(last=False)
+                self.evictions += 1
+        return compiled
+
+    def clear(self):
+        """Discard all compiled statements, the counters are kept"""
+        with self.lock:
+            self.statements.clear()
+
+    def as_dict(self):
+        """Return the statistics as a dict"""
+        return {'size': len(self.statements),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class _Builder(object):
+    """Resolve field paths into columns and joins of a select statement"""
+    def __init__(self, ws, alias):
+        self.ws = ws
+        self.table = ws.db.tables[alias]
+        self.source = ws.map_table(alias).__table__
+        # {path of related field: (DynaQ table, SQLAlchemy alias)}
+        self.joins = {'': (self.table, self.source)}
+
+    def _resolve(self, path):
+        """Return the DynaQ table, the SQLAlchemy table and the field name of
+        a path, joining the related tables"""
+        names = path.split('.')
+        prefix = ''
+        table, sa_table = self.joins['']
+        for name in names[:-1]:
+            f = table.fnames.get(name)
+            if f is None or not isinstance(f.type, Table):
+                raise Exception('Field "%s" of table "%s" is not related' % (name, table.alias))
+            prefix = '%s.%s' % (prefix, name) if prefix else name
+            if prefix not in self.joins:
+                rt = self.ws.map_table(f.type.alias).__table__.alias(
+                    't%d_%s' % (len(self.joins), f.type.alias))
+                self.source = self.source.outerjoin(
+                    rt, sa_table.c[name] == rt.c[f.type.key.name])
+                self.joins[prefix] = (f.type, rt)
+            table, sa_table = self.joins[prefix]
+        name = names[-1]
+        if name not in table.fnames and name not in table.packed and \
+                name not in table.groups:
+            raise Exception('Field "%s" not defined in table "%s"' % (name, table.alias))
+        return table, sa_table, name
+
+    def column(self, path):
+        """Return the column expression of a path, array and compound
+        fields can't be used into conditions and ordering"""
+        table, sa_table, name = self._resolve(path)
+        if name in table.groups and name not in table.fnames and name not in table.packed:
+            raise Exception('Field "%s" of table "%s" is an array or compound field, '
+                            'use one of its fields: %s' % (name, table.alias, ', '.join(
+                                n for i, n in table.groups[name])))
+        return bulk.column_expression(sa_table, table, name)
+
+    def columns(self, path):
+        """Return the labeled columns of a path, array and compound fields
+        are expanded"""
+        table, sa_table, name = self._resolve(path)
+        prefix = path[:-len(name)]
+        names = [n for i, n in table.groups[name]] if name in table.groups else [name]
+        return [bulk.column_expression(sa_table, table, n).label(prefix + n)
+                for n in names]
+
+
+def _condition(where):
+    """Return the tuple (path, operator, parameter name) of a condition"""
+    if isinstance(where, str):
+        where = (where,)
+    path = where[0]
+    op = where[1] if len(where) > 1 else '='
+    name = where[2] if len(where) > 2 else path.replace('.', '_')
+    return path, op, name
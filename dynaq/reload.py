@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# reload.py
+#
+# Copyright (c) 2014
+# Author: Claudio Driussi <claudio.driussi@gmail.com>
+#
+from .db import *
+from . import utils
+
+
+class ReloadReport(object):
+    """
+    Report of the changes applied by Reloader.reload().
+
+    files: list of changed files
+    full: True if the whole Database was rebuilt (the main file is changed or
+      an include resolves to another file)
+    types and tables: dicts with the keys "added", "changed", "removed" and
+      the sorted lists of the names of types or of the aliases of tables.
+      Changed tables include the tables rebuilt because they use a changed
+      type, inherit a changed table or are user fields tables of them.
+    """
+    def __init__(self):
+        """init the report"""
+        self.files = []
+        self.full = False
+        self.types = {'added': [], 'changed': [], 'removed': []}
+        self.tables = {'added': [], 'changed': [], 'removed': []}
+
+    def __bool__(self):
+        return any(self.types.values()) or any(self.tables.values())
+
+    def __repr__(self):
+        return '<ReloadReport files=%s types=%s tables=%s>' % \
+               (self.files, self.types, self.tables)
+
+
+class Reloader(object):
+    """
+    Load a Database from yaml files and keep it up to date.
+
+    The reloader remembers which yaml file produced each Type and Table,
+    when reload() is called only the changed files are parsed again and only
+    the affected types and tables are rebuilt: the changed types and their
+    descendants, the tables which use them, the inherited tables and the user
+    fields tables of rebuilt tables. Relations pointing to rebuilt tables are
+    resolved again.
+    Usage:
+         rl = Reloader('db.yml', ['yaml','yaml/core'])
+         db = rl.db
+         ... edit orders.yml ...
+         report = rl.reload()
+    """
+    def __init__(self, fname, paths=".", loader=None):
+        """Init the reloader and load the Database
+
+        :param fname: name of the main yaml file, searched along paths
+        :param paths: list of paths where search the main and included files
+        :param loader: loader class, by default utils.YamlLoader
+        :return: None
+        """
+        self.fname = fname
+        self.paths = paths
+        self.loader = loader or utils.YamlLoader
+        self.resolver = utils.IncludeResolver(paths)
+        self.db = None
+        self.load()
+
+    def load(self):
+        """Load the whole Database from yaml files
+
+        :return: the Database object
+        """
+        self.files = {}
+        # the documents of the previous load are replaced
+        self.resolver.forget()
+        self.data = utils.load_yaml(self.fname, self.paths, self.files,
+                                    self.loader, resolver=self.resolver)
+        self.root = self.files[self.fname]
+        self.sources = self.resolver.sources()
+        self.db = Database()
+        self.db.load_yaml(self.data, self.sources)
+        self.stamps = self._stamps()
+        return self.db
+
+    def _stamps(self):
+        """Return the dict {filename: mtime} of the loaded files"""
+        return dict((fn, self.resolver.mtime(fn)) for fn in self.files.values())
+
+    def changed_files(self):
+        """Return the list of files changed from the last load
+
+        :return: the list of file names
+        """
+        self.resolver.refresh()
+        changed = []
+        for name, filename in sorted(self.files.items()):
+            try:
+                if self.resolver.find(name) != filename or \
+                        self.resolver.mtime(filename) != self.stamps[filename]:
+                    changed.append(filename)
+            except Exception:
+                changed.append(filename)
+        return changed
+
+    def reload(self):
+        """Apply the changes of yaml files to the Database
+
+        If the main file is changed or some include resolves to another file
+        the whole Database is rebuilt, otherwise only the changed documents
+        are parsed and only affected types and tables are rebuilt.
+
+        :return: a ReloadReport object
+        """
+        report = ReloadReport()
+        report.files = self.changed_files()
+        if not report.files:
+            return report
+        old_types = self.data.get('types') or []
+        old_tables = self.data.get('tables') or []
+        if self._need_full(report.files):
+            self.load()
+            report.full = True
+            new_types = self.data.get('types') or []
+            new_tables = self.data.get('tables') or []
+            self._diff(report, old_types, new_types, old_tables, new_tables)
+            return report
+
+        new_types = [self._reload_doc(d) for d in old_types]
+        new_tables = [self._reload_doc(d) for d in old_tables]
+        affected_types, affected_tables = \
+            self._diff(report, old_types, new_types, old_tables, new_tables)
+        self.data = dict(self.data, types=new_types, tables=new_tables)
+        self.resolver.forget([o for o, n in zip(old_types + old_tables, new_types + new_tables)
+                              if o is not n])
+        self.sources = self.resolver.sources()
+        db = self.db
+
+        # rebuild types
+        for name in affected_types:
+            db.types.pop(name, None)
+        for doc in new_types:
+            names = set(_type_defs([doc])) & affected_types
+            if names:
+                db.add_types(doc, self.sources.get(id(doc)), names)
+        if affected_types:
+            db.calc_types()
+
+        # rebuild tables, the order of definitions is preserved because
+        # inherited tables must follow the parent tables
+        for alias in affected_tables:
+            db.tables.pop(alias, None)
+            db.tables.pop(alias + USRFLD_SUFFIX, None)
+        rebuilt = set()
+        for doc in new_tables:
+            alias = _alias(doc)
+            if alias in affected_tables:
+                db.add_table(doc, self.sources.get(id(doc)))
+                rebuilt.add(alias)
+        for i in add_properties(self.data, 'tables', ):
+            if i[0] in rebuilt:
+                db.tables[i[0]].set_property(i[1], i[2])
+        db.calc_tables()
+        for alias, t in list(db.tables.items()):
+            for f in t.fields:
+                if isinstance(f.type, Table) and \
+                        db.tables.get(f.type.alias) is not f.type:
+                    if f.type.alias not in db.tables:
+                        raise Exception('Table "%s" related by "%s.%s" has been removed'
+                                        % (f.type.alias, alias, f.name))
+                    f.type = db.tables[f.type.alias]
+        db.invalidate_views()
+        self.stamps = self._stamps()
+        return report
+
+    def _need_full(self, changed):
+        """Return True if changes require a full rebuild"""
+        if self.root in changed:
+            return True
+        for name, filename in self.files.items():
+            try:
+                if self.resolver.find(name) != filename:
+                    return True
+            except Exception:
+                return True
+        return False
+
+    def _reload_doc(self, doc):
+        """Return the document parsed again if its file is changed"""
+        filename = self.sources.get(id(doc))
+        if filename is None or filename == self.root:
+            return doc
+        return self.resolver.load(filename, self.loader, self.files)
+
+    def _diff(self, report, old_types, new_types, old_tables, new_tables):
+        """Fill the report and return the affected types and tables
+
+        :return: a tuple (set of type names, set of table aliases)
+        """
+        old_tdefs = _type_defs(old_types)
+        new_tdefs = _type_defs(new_types)
+        _compare(report.types, old_tdefs, new_tdefs)
+        changed = set(report.types['added'] + report.types['changed'] +
+                      report.types['removed'])
+        # descendants of changed types
+        children = {}
+        for name, d in new_tdefs.items():
+            children.setdefault(_type_parent(d[0]), []).append(name)
+        affected_types = set()
+        todo = list(changed)
+        while todo:
+            name = todo.pop()
+            if name in affected_types:
+                continue
+            affected_types.add(name)
+            todo.extend(children.get(name, []))
+
+        old_docs = dict((_alias(d), d) for d in old_tables)
+        new_docs = dict((_alias(d), d) for d in new_tables)
+        _compare(report.tables, old_docs, new_docs)
+        affected = set(report.tables['added'] + report.tables['changed'])
+        for alias, t in self.db.tables.items():
+            if alias in new_docs and t.uses & affected_types:
+                affected.add(alias)
+        # inherited tables
+        inherits = {}
+        for alias, d in new_docs.items():
+            if 'inherit' in d:
+                inherits.setdefault(d['inherit'], []).append(alias)
+        todo = list(affected)
+        while todo:
+            alias = todo.pop()
+            for a in inherits.get(alias, []):
+                if a not in affected:
+                    affected.add(a)
+                    todo.append(a)
+        affected |= set(report.tables['removed'])
+        # user fields tables of rebuilt tables or which use changed types
+        for alias, t in self.db.tables.items():
+            if alias.endswith(USRFLD_SUFFIX) and alias not in new_docs:
+                parent = alias[:-len(USRFLD_SUFFIX)]
+                if parent in affected or t.uses & affected_types:
+                    affected.add(alias)
+        report.tables['changed'] = list(affected - set(report.tables['added'])
+                                        - set(report.tables['removed']))
+        for k in report.types:
+            report.types[k] = sorted(report.types[k])
+            report.tables[k] = sorted(report.tables[k])
+        return affected_types, affected
+
+
+def _alias(doc):
+    """Return the alias of a table document"""
+    return doc.get('alias') or doc['name']
+
+
+def _type_parent(entry):
+    """Return the name of the parent type of a type definition"""
+    if len(entry) > 1 and type(entry[1]) is not dict:
+        return entry[1]
+    return None
+
+
+def _type_defs(docs):
+    """Return the dict {name: (definition, properties)} of types documents"""
+    defs = {}
+    for doc in docs:
+        for tt in doc.get('types') or []:
+            defs[tt[0]] = (tt, [])
+        for i in add_properties(doc, 'types', ):
+            if i[0] in defs:
+                defs[i[0]][1].append(i[1:])
+    return defs
+
+
+def _compare(result, old, new):
+    """Fill the result dict comparing old and new dicts of definitions"""
+    for k in new:
+        if k not in old:
+            result['added'].append(k)
+        elif old[k] != new[k]:
+            result['changed'].append(k)
+    for k in old:
+        if k not in new:
+            result['removed'].append(k)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# restructure.py
+#
+# Copyright (c) 2014
+# Author: Claudio Driussi <claudio.driussi@gmail.com>
+#
+from .db import *
+from . import workspace
+from .stats import STATS
+
+# suffix of the temporary tables built by rebuilds
+TMP_SUFFIX = '__dqnew'
+
+
+class TableChange(object):
+    """
+    Changes of a single table found by diff().
+
+    name: physical name of the table
+    action: "create", "drop", "alter" (columns added and indexes changed,
+      executed with ALTER TABLE and CREATE/DROP INDEX) or "rebuild" (the
+      table is built again with the new structure and the data are copied)
+    added, removed, changed: names of columns added, removed or with a
+      different type or primary key
+    add_indexes, drop_indexes: names of indexes to create and to drop
+    """
+    def __init__(self, name, action):
+        """init the change"""
+        self.name = name
+        self.action = action
+        self.added = []
+        self.removed = []
+        self.changed = []
+        self.add_indexes = []
+        self.drop_indexes = []
+
+    def __repr__(self):
+        return '<TableChange %s %s added=%s removed=%s changed=%s indexes=+%s-%s>' % \
+               (self.action, self.name, self.added, self.removed, self.changed,
+                self.add_indexes, self.drop_indexes)
+
+
+class Plan(object):
+    """
+    Restructure plan, the list of TableChange objects, one for each table to
+    change, and the old MetaData used to build it.
+    """
+    def __init__(self, old_metadata):
+        """init the plan"""
+        self.old_metadata = old_metadata
+        self.changes = []
+
+    def __bool__(self):
+        return bool(self.changes)
+
+    def __iter__(self):
+        return iter(self.changes)
+
+    def __repr__(self):
+        return '<Plan %s>' % self.changes
+
+
+def diff(ws, old=None):
+    """Compare the orm of a workspace with the database or with a Database
+
+    All changes of a table are grouped into one TableChange, new columns
+    that can be added with ALTER TABLE (nullable, without foreign keys) and
+    index changes don't require a rebuild. The changes are ordered by
+    foreign key dependency, the referenced tables are created first and
+    dropped last.
+
+    :param ws: the WorkSpace with the new structure, the orm is generated
+    :param old: the previous DynaQ Database, generated with the same options
+     of ws, if None the structure is read from the database
+    :return: the Plan object
+    """
+    ws.warm_up()
+    if old is None:
+        old_metadata = sa.MetaData()
+        old_metadata.reflect(bind=ws.engine)
+    else:
+        # the old orm is generated on a private engine, which is never
+        # connected, so no listener is added to the engine of ws, and it is
+        # not counted by the load statistics
+        engine = sa.create_engine('sqlite://')
+        enabled = STATS.enabled
+        STATS.enabled = False
+        try:
+            old_ws = workspace.WorkSpace(old, engine)
+            old_ws.generate_orm(*ws.options)
+        finally:
+            STATS.enabled = enabled
+        old_metadata = old_ws.metadata
+        engine.dispose()
+    dialect = ws.engine.dialect
+    plan = Plan(old_metadata)
+    for new in ws.metadata.sorted_tables:
+        name = new.name
+        if name not in old_metadata.tables:
+            plan.changes.append(TableChange(name, 'create'))
+            continue
+        cur = old_metadata.tables[name]
+        ch = TableChange(name, 'alter')
+        ch.added = [c.name for c in new.c if c.name not in cur.c]
+        ch.removed = [c.name for c in cur.c if c.name not in new.c]
+        ch.changed = [c.name for c in new.c if c.name in cur.c and
+                      (_type(c, dialect) != _type(cur.c[c.name], dialect) or
+                       c.primary_key != cur.c[c.name].primary_key)]
+        new_ix = dict((i.name, _index(i)) for i in new.indexes)
+        cur_ix = dict((i.name, _index(i)) for i in cur.indexes)
+        ch.add_indexes = sorted(k for k, v in new_ix.items() if cur_ix.get(k) != v)
+        ch.drop_indexes = sorted(k for k, v in cur_ix.items() if new_ix.get(k) != v)
+        if ch.removed or ch.changed or any(
+                not new.c[c].nullable or new.c[c].foreign_keys or new.c[c].primary_key
+                for c in ch.added):
+            ch.action = 'rebuild'
+        if ch.added or ch.removed or ch.changed or ch.add_indexes or ch.drop_indexes:
+            plan.changes.append(ch)
+    for cur in reversed(old_metadata.sorted_tables):
+        if cur.name not in ws.metadata.tables and not cur.name.endswith(TMP_SUFFIX):
+            plan.changes.append(TableChange(cur.name, 'drop'))
+    return plan
+
+
+def apply(ws, plan, chunk_size=10000, progress=None, drop=False):
+    """Apply a restructure plan to the database
+
+    Rebuilt tables are created with a temporary name, the data of common
+    columns are copied with INSERT ... SELECT in chunks of chunk_size rows
+    ordered by primary key, each chunk in its own transaction, then the old
+    table is dropped, the new one renamed and its indexes created. On sqlite
+    foreign keys are disabled during rebuilds, so the drop of the old table
+    does not cascade, on other databases the tables referenced by foreign
+    keys of other tables can't be rebuilt, an Exception is raised before
+    any change is applied.
+
+    :param ws: the WorkSpace with the new structure
+    :param plan: the Plan returned by diff()
+    :param chunk_size: max number of rows copied by each transaction
+    :param progress: optional function called as progress(table name,
+     copied rows, total rows) after each chunk
+    :param drop: if True the tables not defined into the workspace are
+     dropped
+    :return: None
+    """
+    if ws.engine.dialect.name != 'sqlite':
+        for ch in plan:
+            if ch.action != 'rebuild':
+                continue
+            refs = sorted(set(t.name for t in plan.old_metadata.tables.values()
+                              if t.name != ch.name and
+                              any(fk.column.table.name == ch.name for fk in t.foreign_keys)))
+            if refs:
+                raise Exception('Table "%s" is referenced by foreign keys of %s, it can be '
+                                'rebuilt only on sqlite' % (ch.name, ', '.join(refs)))
+    for ch in plan:
+        if ch.action == 'create':
+            ws.metadata.tables[ch.name].create(ws.engine)
+        elif ch.action == 'drop':
+            if drop:
+                plan.old_metadata.tables[ch.name].drop(ws.engine)
+        elif ch.action == 'alter':
+            _alter(ws, ch, plan.old_metadata.tables[ch.name])
+        else:
+            _rebuild(ws, ch, plan.old_metadata.tables[ch.name], chunk_size, progress)
+
+
+def _alter(ws, ch, old):
+    """Add columns and change indexes of a table"""
+    new = ws.metadata.tables[ch.name]
+    preparer = ws.engine.dialect.identifier_preparer
+    with ws.engine.begin() as conn:
+        for name in ch.drop_indexes:
+            [i for i in old.indexes if i.name == name][0].drop(conn)
+        for name in ch.added:
+            conn.execute('ALTER TABLE %s ADD COLUMN %s' % (
+                preparer.format_table(new),
+                sa.schema.CreateColumn(new.c[name]).compile(dialect=ws.engine.dialect)))
+        for name in ch.add_indexes:
+            [i for i in new.indexes if i.name == name][0].create(conn)
+
+
+def _rebuild(ws, ch, old, chunk_size, progress):
+    """Build a table again with the new structure and copy the data"""
+    new = ws.metadata.tables[ch.name]
+    meta = sa.MetaData()
+    # the foreign keys of the copy must find the referenced tables
+    for fk in new.foreign_keys:
+        if fk.column.table.name not in meta.tables:
+            fk.column.table.tometadata(meta)
+    tmp = new.tometadata(meta, name=ch.name + TMP_SUFFIX)
+    # indexes are created after the rename, their names are global on sqlite
+    tmp.indexes = set()
+    preparer = ws.engine.dialect.identifier_preparer
+    sqlite = ws.engine.dialect.name == 'sqlite'
+    with ws.engine.connect() as conn:
+        if sqlite:
+            fk = conn.execute('PRAGMA foreign_keys').scalar()
+            conn.execute('PRAGMA foreign_keys=OFF')
+        try:
+            tmp.drop(conn, checkfirst=True)
+            tmp.create(conn)
+            _copy(conn, old, tmp, [c.name for c in new.c if c.name in old.c],
+                  chunk_size, progress)
+            with conn.begin():
+                old.drop(conn)
+                conn.execute('ALTER TABLE %s RENAME TO %s' % (
+                    preparer.format_table(tmp), preparer.quote(ch.name)))
+                for i in new.indexes:
+                    i.create(conn)
+        finally:
+            if sqlite and fk:
+                conn.execute('PRAGMA foreign_keys=ON')
+
+
+def _copy(conn, old, tmp, columns, chunk_size, progress):
+    """Copy columns from old to tmp in chunks ordered by primary key"""
+    key = [c for c in old.primary_key.columns if c.name in tmp.c]
+    total = conn.execute(sa.select([sa.func.count()]).select_from(old)).scalar()
+    if not key:
+        # without primary key the data are copied in one transaction
+        with conn.begin():
+            conn.execute(tmp.insert().from_select(
+                columns, sa.select([old.c[c] for c in columns])))
+        if progress:
+            progress(old.name, total, total)
+        return
+    key = key[0]
+    copied = 0
+    last = None
+    while True:
+        keys = sa.select([key]).order_by(key).limit(chunk_size)
+        if last is not None:
+            keys = keys.where(key > last)
+        keys = keys.alias('chunk')
+        count, top = conn.execute(sa.select([sa.func.count(), sa.func.max(keys.c[key.name])])).first()
+        if not count:
+            break
+        query = sa.select([old.c[c] for c in columns]).where(key <= top)
+        if last is not None:
+            query = query.where(key > last)
+        with conn.begin():
+            conn.execute(tmp.insert().from_select(columns, query))
+        copied += count
+        last = top
+        if progress:
+            progress(old.name, copied, total)
+
+
+def _type(column, dialect):
+    """Return the comparable DDL type of a column"""
+    try:
+        return str(column.type.compile(dialect=dialect)).upper().replace(' ', '')
+    except Exception:
+        return repr(column.type)
+
+
+def _index(index):
+    """Return the comparable definition of an index"""
+    return (tuple(c.name for c in index.columns), bool(index.unique))
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# stats.py
+#
+# Copyright (c) 2014
+# Author: Claudio Driussi <claudio.driussi@gmail.com>
+#
+import time
+import bisect
+import threading
+import contextlib
+import sqlalchemy as sa
+
+# upper bounds in milliseconds of the buckets of queries latency histograms,
+# the last bucket counts the slower queries
+LATENCY_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class Stats(object):
+    """
+    Timings and counters of the phases of schema loading and orm generation.
+
+    phases: dict {name: {"count": calls, "seconds": total, "max": max
+      seconds}}, the phases are: yaml_load, include_lookup, add_types,
+      calc_types, add_tables, calc_tables, resolve_relations, generate_orm
+    counters: dict {name: value}, the counters are: files, yaml_parsed,
+      yaml_memoized, types, tables, fields, expanded_fields, packed_elements,
+      classes_mapped, relationships
+    hooks: functions called as hook(kind, name, value) on each event, kind
+      is "phase" with the seconds or "count" with the increment, they can
+      forward the events to a metrics system
+    enabled: if False nothing is collected
+    """
+    def __init__(self):
+        """init the stats"""
+        self.lock = threading.Lock()
+        self.hooks = []
+        self.enabled = True
+        self.reset()
+
+    def reset(self):
+        """Reset timings and counters, hooks are kept"""
+        with self.lock:
+            self.phases = {}
+            self.counters = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a phase, usage: with STATS.phase('calc_types'):"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        """Add the time of a phase"""
+        with self.lock:
+            p = self.phases.get(name)
+            if p is None:
+                p = self.phases[name] = {'count': 0, 'seconds': 0.0, 'max': 0.0}
+            p['count'] += 1
+            p['seconds'] += seconds
+            p['max'] = max(p['max'], seconds)
+        for hook in self.hooks:
+            hook('phase', name, seconds)
+
+    def count(self, name, n=1):
+        """Increment a counter"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        for hook in self.hooks:
+            hook('count', name, n)
+
+    def as_dict(self):
+        """Return the stats as a dict"""
+        with self.lock:
+            return {'phases': dict((k, dict(v)) for k, v in self.phases.items()),
+                    'counters': dict(self.counters)}
+
+    def merge(self, stats):
+        """Add the stats of another process, the hooks are called once for
+        each phase with the total seconds and for each counter
+
+        :param stats: the dict returned by as_dict()
+        :return: None
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            for name, v in stats['phases'].items():
+                p = self.phases.get(name)
+                if p is None:
+                    p = self.phases[name] = {'count': 0, 'seconds': 0.0, 'max': 0.0}
+                p['count'] += v['count']
+                p['seconds'] += v['seconds']
+                p['max'] = max(p['max'], v['max'])
+            for name, n in stats['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+        for hook in self.hooks:
+            for name, v in stats['phases'].items():
+                hook('phase', name, v['seconds'])
+            for name, n in stats['counters'].items():
+                hook('count', name, n)
+
+
+class QueryStats(object):
+    """
+    Number and latency of the queries executed by the engine of a WorkSpace
+    for each DynaQ table, collected by engine events.
+
+    tables: dict {alias: {"count", "seconds", "max", "kinds" {statement
+      kind: count}, "buckets" list of counts, see LATENCY_BUCKETS}}, the
+      queries are assigned to the main table of the statement, the queries
+      of other tables are keyed by the physical name and the textual queries
+      by "?"
+    hooks: functions called as hook("query", alias, seconds)
+    """
+    def __init__(self, ws):
+        """init the stats
+
+        :param ws: the WorkSpace
+        :return: None
+        """
+        self.ws = ws
+        self.lock = threading.Lock()
+        self.hooks = []
+        self.enabled = True
+        self.names = None
+        self.reset()
+
+    def reset(self):
+        """Reset the counters, hooks are kept"""
+        with self.lock:
+            self.tables = {}
+
+    def refresh(self):
+        """Forget the physical names of tables, called when the orm
+        classes are generated again"""
+        self.names = None
+
+    def listen(self, engine):
+        """Collect the statistics of the queries of the engine
+
+        :param engine: SQLAlchemy engine
+        :return: None
+        """
+        sa.event.listen(engine, 'before_cursor_execute', self._on_before)
+        sa.event.listen(engine, 'after_cursor_execute', self._on_after)
+
+    def unlisten(self, engine):
+        """Remove the listeners added by listen()
+
+        :param engine: SQLAlchemy engine
+        :return: None
+        """
+        for name, fn in (('before_cursor_execute', self._on_before),
+                         ('after_cursor_execute', self._on_after)):
+            if sa.event.contains(engine, name, fn):
+                sa.event.remove(engine, name, fn)
+
+    # the start time is kept by the execution context of the statement, so
+    # nothing is left behind by failed statements
+    def _on_before(self, conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._dynaq_start = time.perf_counter()
+
+    def _on_after(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, '_dynaq_start', None)
+        if self.enabled and start is not None:
+            seconds = time.perf_counter() - start
+            compiled = getattr(context, 'compiled', None)
+            alias = self._alias(getattr(compiled, 'statement', None))
+            self.add(alias, statement.split(None, 1)[0].lower() if statement else '?',
+                     seconds)
+
+    def add(self, alias, kind, seconds):
+        """Add a query of a table"""
+        with self.lock:
+            t = self.tables.get(alias)
+            if t is None:
+                t = self.tables[alias] = {'count': 0, 'seconds': 0.0, 'max': 0.0,
+                                          'kinds': {},
+                                          'buckets': [0] * (len(LATENCY_BUCKETS) + 1)}
+            t['count'] += 1
+            t['seconds'] += seconds
+            t['max'] = max(t['max'], seconds)
+            t['kinds'][kind] = t['kinds'].get(kind, 0) + 1
+            t['buckets'][bisect.bisect_left(LATENCY_BUCKETS, seconds * 1000)] += 1
+        for hook in self.hooks:
+            hook('query', alias, seconds)
+
+    def _alias(self, statement):
+        """Return the alias of the main table of a statement"""
+        table = _main_table(statement)
+        if table is None:
+            return '?'
+        # lazy workspaces map new classes while running
+        if self.names is None or self.names[0] != len(self.ws.tables):
+            self.names = (len(self.ws.tables), dict(
+                (cls.__table__.name, alias) for alias, cls in list(self.ws.tables.items())))
+        return self.names[1].get(table.name, table.name)
+
+    def as_dict(self):
+        """Return the stats as a dict"""
+        with self.lock:
+            return dict((k, dict(v, kinds=dict(v['kinds']), buckets=list(v['buckets'])))
+                        for k, v in self.tables.items())
+
+
+def _main_table(statement):
+    """Return the first table of a statement or None"""
+    if statement is None:
+        return None
+    table = getattr(statement, 'table', None)
+    if table is None:
+        froms = getattr(statement, 'froms', None)
+        if not froms:
+            return None
+        table = froms[0]
+    while not isinstance(table, sa.Table):
+        if isinstance(table, sa.sql.expression.Join):
+            table = table.left
+        elif hasattr(table, 'element'):
+            table = table.element
+        else:
+            return None
+    return table
+
+
+# stats of schema loading and orm generation of the process
+STATS = Stats()
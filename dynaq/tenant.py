@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# tenant.py
+#
+# Copyright (c) 2014
+# Author: Claudio Driussi <claudio.driussi@gmail.com>
+#
+import copy
+from .db import *
+from .workspace import WorkSpace, table_name
+from .query import QueryCache
+from .lookup import LookupCache
+
+# dialect classes with the tenant mixins
+_CLASSES = {}
+
+class Tenant(WorkSpace):
+    """
+    Workspace of a tenant which shares the Database and the orm classes of a
+    base WorkSpace.
+
+    The tenants run the same logical schema on the engine of the base
+    workspace, the tables of a tenant are selected by:
+    - schema: the tables are into a database schema of the tenant, the
+      statements are executed with a schema_translate_map
+    - prefix, pref_tabels: the tables have other names, as given by the same
+      options of generate_orm(), the statements are compiled by a copy of
+      the dialect of the base engine which renders the names of the tables
+      and of the indexes of the tenant
+    So a tenant costs an engine proxy, a dialect copy, a session factory and
+    a few small dicts, the orm classes are never generated again.
+    The pool and the query statistics are shared with the base workspace,
+    the query cache and the lookup cache are own of the tenant.
+    Usage:
+         ws = WorkSpace(db, 'postgresql://...')
+         ws.generate_orm()
+         acme = Tenant(ws, 'acme', prefix='acme_')
+         acme.create_all()
+         s = acme.session()
+    Only the Table objects are renamed, the textual statements executed on
+    the engine of a tenant must use the names of the tenant (see overlay).
+    """
+    def __init__(self, base, name, prefix=None, pref_tabels=None, schema=None,
+                 scopefunc=None):
+        """init the tenant
+
+        :param base: the WorkSpace with the generated orm, if lazy all
+         classes are generated
+        :param name: name of the tenant
+        :param prefix: prefix of table names of the tenant, by default the
+         prefix of the base workspace
+        :param pref_tabels: prefix bypass names of the tenant, see
+         generate_orm, by default the ones of the base workspace
+        :param schema: optional database schema of the tables of the tenant
+        :param scopefunc: function which return the scope of sessions
+         returned by current_session(), by default the current thread
+        :return: None
+        """
+        if isinstance(base, Tenant):
+            raise Exception('The base of tenant "%s" is a tenant' % name)
+        base.warm_up()
+        self.base = base
+        self.name = name
+        self.schema = schema
+        self.overlay = self._overlay(prefix, pref_tabels)
+        options = {'dynaq_tenant': self}
+        if schema is not None:
+            options['schema_translate_map'] = {None: schema}
+        self.db = base.db
+        self.pool_stats = base.pool_stats
+        # the proxy shares the pool and the listeners of the base engine
+        self.engine = base.engine.execution_options(**options)
+        if self.overlay:
+            self.engine.dialect = _dialect(base.engine.dialect, self.overlay)
+        self.session_factory = sa.orm.sessionmaker(bind=self.engine)
+        self.scoped_session = sa.orm.scoped_session(self.session_factory,
+                                                    scopefunc)
+        self.metadata = base.metadata
+        self.Base = base.Base
+        self.tables = base.tables
+        self.children = base.children
+        self.lazy = False
+        self.options = base.options
+        # the statements are compiled with the dialect of the tenant
+        self.query_cache = QueryCache(base.query_cache.size,
+                                      options.get('schema_translate_map'))
+        # invalidated by the listeners of the base workspace
+        self.lookup_cache = LookupCache(self, base.lookup_cache.ttl,
+                                        base.lookup_cache.prefill_sessions)
+        self.query_stats = base.query_stats
+
+    def _overlay(self, prefix, pref_tabels):
+        """Return the dict {base name: tenant name} of tables and indexes"""
+        base_prefix, base_pref = self.base.options[:2]
+        prefix = base_prefix if prefix is None else prefix
+        pref_tabels = base_pref if pref_tabels is None else pref_tabels
+        overlay = {}
+        for alias, cls in self.base.tables.items():
+            t = cls.__table__
+            tname = self.base.db.tables[alias].name
+            new = table_name(tname, prefix, pref_tabels)
+            if new == t.name:
+                continue
+            overlay[t.name] = new
+            for i in t.indexes:
+                overlay[i.name] = new[:len(new) - len(tname)] + i.name
+        return overlay
+
+    def create_all(self):
+        """Create the tables of the tenant into the database
+
+        :return: None
+        """
+        with self.engine.connect() as conn:
+            schema = conn.schema_for_object(self.metadata)
+            tables = [t for t in self.metadata.sorted_tables if not conn.dialect.has_table(
+                conn, self.overlay.get(t.name, t.name), schema=schema)]
+            self.metadata.create_all(conn, tables=tables, checkfirst=False)
+
+    def generate_orm(self, *args, **kwargs):
+        raise Exception('Tenant "%s" uses the orm of its base workspace' % self.name)
+
+    def use_module(self, module):
+        raise Exception('Tenant "%s" uses the orm of its base workspace' % self.name)
+
+    def _unlisten(self):
+        """The listeners belong to the base workspace"""
+
+    def restructure(self, *args, **kwargs):
+        raise Exception('Tenant "%s" must be restructured by a WorkSpace '
+                        'generated with its options' % self.name)
+
+    def __repr__(self):
+        return '<Tenant %s>' % self.name
+
+
+
+class _Preparer(object):
+    """Mixin of identifier preparers which renders the tenant names"""
+    overlay = {}
+
+    def format_table(self, table, use_schema=True, name=None):
+        if name is None and isinstance(table, sa.Table):
+            name = self.overlay.get(table.name)
+        return super(_Preparer, self).format_table(table, use_schema, name)
+
+    def format_index(self, index):
+        name = self.overlay.get(index.name)
+        if name is None:
+            return super(_Preparer, self).format_index(index)
+        return self.quote(name)
+
+
+class _Compiler(object):
+    """Mixin of statement compilers which renders the tenant names"""
+    def visit_table(self, table, asfrom=False, iscrud=False, ashint=False,
+                    fromhints=None, use_schema=True, **kwargs):
+        name = self.preparer.overlay.get(table.name)
+        if name is None or not (asfrom or ashint):
+            return super(_Compiler, self).visit_table(
+                table, asfrom=asfrom, iscrud=iscrud, ashint=ashint,
+                fromhints=fromhints, use_schema=use_schema, **kwargs)
+        ret = self.preparer.format_table(table, use_schema)
+        if fromhints and table in fromhints:
+            ret = self.format_from_hint_text(ret, table, fromhints[table], iscrud)
+        return ret
+
+    def visit_column(self, column, include_table=True, **kwargs):
+        table = column.table
+        name = None
+        if include_table and table is not None and table.named_with_column:
+            name = self.preparer.overlay.get(table.name)
+        if name is None:
+            return super(_Compiler, self).visit_column(
+                column, include_table=include_table, **kwargs)
+        # the result map keeps the column of the base table
+        ret = super(_Compiler, self).visit_column(column, include_table=False, **kwargs)
+        return self.preparer.format_table(table) + '.' + ret
+
+
+def _mixin(mixin, cls):
+    """Return the subclass of cls with a mixin, one for each class"""
+    key = (mixin, cls)
+    if key not in _CLASSES:
+        _CLASSES[key] = type(cls.__name__, (mixin, cls), {})
+    return _CLASSES[key]
+
+
+def _dialect(dialect, overlay):
+    """Return a copy of dialect which renders the names of overlay"""
+    dialect = copy.copy(dialect)
+    preparer = copy.copy(dialect.identifier_preparer)
+    preparer.__class__ = _mixin(_Preparer, preparer.__class__)
+    preparer.overlay = overlay
+    dialect.identifier_preparer = preparer
+    dialect.statement_compiler = _mixin(_Compiler, dialect.statement_compiler)
+    return dialect
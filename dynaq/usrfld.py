@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# usrfld.py
+#
+# Copyright (c) 2014
+# Author: Claudio Driussi <claudio.driussi@gmail.com>
+#
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from .db import *
+
+# max number of keys in each "IN" clause, some databases limit the number
+# of parameters of a statement
+CHUNK_SIZE = 500
+
+
+def uf_table(ws, alias):
+    """Return the SQLAlchemy table of the user fields of a table
+
+    :param ws: the WorkSpace
+    :param alias: alias name of the owner table
+    :return: a tuple (SQLAlchemy Table object, name of the foreign key)
+    """
+    uf = '%s%s' % (alias, USRFLD_SUFFIX)
+    if uf not in ws.db.tables:
+        raise Exception('Table "%s" has no user fields' % alias)
+    return ws.map_table(uf).__table__, 'id_%s' % alias
+
+
+def load(ws, alias, keys, conn=None):
+    """Load the user fields of many records with one query
+
+    Keys are read in chunks of CHUNK_SIZE, so a query is executed every
+    CHUNK_SIZE keys instead of a lazy load for each record.
+    Example:
+    #>>> uf = dq.usrfld.load(ws, 'sbj', [s.id for s in page])
+    #>>> uf[page[0].id].get('var1')
+
+    :param ws: the WorkSpace
+    :param alias: alias name of the owner table
+    :param keys: iterable of primary keys of the owner table
+    :param conn: SQLAlchemy connection, by default a new connection
+    :return: a dict {key: {name: value}}, each key has a dict even if the
+     record has no user fields
+    """
+    sa_table, fk = uf_table(ws, alias)
+    keys = list(dict.fromkeys(keys))
+    result = dict((k, {}) for k in keys)
+    if conn is None:
+        with ws.engine.connect() as conn:
+            return _load(conn, sa_table, fk, keys, result)
+    return _load(conn, sa_table, fk, keys, result)
+
+
+def _load(conn, sa_table, fk, keys, result):
+    """Fill result with the user fields of keys"""
+    c = sa_table.c
+    for i in range(0, len(keys), CHUNK_SIZE):
+        query = sa.select([c[fk], c.name, c.value]).where(
+            c[fk].in_(keys[i:i + CHUNK_SIZE]))
+        for key, name, value in conn.execute(query):
+            result[key][name] = value
+    return result
+
+
+def save(ws, alias, values, conn=None):
+    """Insert or update the user fields of many records
+
+    The records are upserted by (id_<alias>, name), the unique index of the
+    user fields table, with executemany of the upsert statement of the
+    dialect (INSERT ... ON CONFLICT on postgresql and sqlite, INSERT ... ON
+    DUPLICATE KEY UPDATE on mysql), so concurrent writers of the same
+    fields don't fail. On other databases the rows are inserted into a
+    savepoint and, if a row already exists, they are updated one by one.
+    A value of None deletes the user field. The counts are computed from
+    the rows read before the changes, with one query for each chunk of
+    keys.
+    Databases created before the index was unique must be restructured,
+    see WorkSpace.restructure(), the upserts need the unique index.
+    Example:
+    #>>> dq.usrfld.save(ws, 'sbj', {1: {'var1': 'a'}, 2: {'var1': 'b'}})
+
+    :param ws: the WorkSpace
+    :param alias: alias name of the owner table
+    :param values: dict {key: {name: value}}
+    :param conn: SQLAlchemy connection, by default the changes are applied
+     in a new transaction
+    :return: a tuple (inserted, updated, deleted) number of rows
+    """
+    sa_table, fk = uf_table(ws, alias)
+    if conn is None:
+        with ws.engine.begin() as conn:
+            return _save(conn, sa_table, fk, values)
+    return _save(conn, sa_table, fk, values)
+
+
+def _save(conn, sa_table, fk, values):
+    """Upsert values using the connection"""
+    c = sa_table.c
+    keys = list(values)
+    existing = set()
+    for i in range(0, len(keys), CHUNK_SIZE):
+        query = sa.select([c[fk], c.name]).where(
+            c[fk].in_(keys[i:i + CHUNK_SIZE]))
+        existing.update(tuple(r) for r in conn.execute(query))
+    inserted = updated = 0
+    rows, deletes = [], []
+    for key, fields in values.items():
+        for name, value in fields.items():
+            if value is None:
+                if (key, name) in existing:
+                    deletes.append({'_key': key, '_name': name})
+                continue
+            if (key, name) in existing:
+                updated += 1
+            else:
+                inserted += 1
+            rows.append({fk: key, 'name': name, 'value': value})
+    if deletes:
+        conn.execute(sa_table.delete().where(sa.and_(
+            c[fk] == sa.bindparam('_key'), c.name == sa.bindparam('_name'))), deletes)
+    if rows:
+        _upsert(conn, sa_table, fk, rows)
+    return inserted, updated, len(deletes)
+
+
+def _upsert(conn, sa_table, fk, rows):
+    """Insert or update rows by (fk, name) with the upsert of the dialect"""
+    dialect = conn.dialect.name
+    if dialect == 'mysql':
+        stmt = mysql.insert(sa_table)
+        stmt = stmt.on_duplicate_key_update(value=stmt.inserted.value)
+    elif dialect == 'postgresql' or (dialect == 'sqlite' and hasattr(sqlite, 'insert')):
+        stmt = (postgresql if dialect == 'postgresql' else sqlite).insert(sa_table)
+        stmt = stmt.on_conflict_do_update(index_elements=[fk, 'name'],
+                                          set_={'value': stmt.excluded.value})
+    elif dialect == 'sqlite':
+        # SQLAlchemy 1.3 has no sqlite upsert, the row is replaced
+        stmt = sa_table.insert().prefix_with('OR REPLACE')
+    else:
+        try:
+            with conn.begin_nested():
+                conn.execute(sa_table.insert(), rows)
+        except sa.exc.IntegrityError:
+            c = sa_table.c
+            update = sa_table.update().where(sa.and_(
+                c[fk] == sa.bindparam('_key'), c.name == sa.bindparam('_name')))
+            for row in rows:
+                if not conn.execute(update.values(value=row['value']),
+                                    _key=row[fk], _name=row['name']).rowcount:
+                    conn.execute(sa_table.insert(), row)
+        return
+    conn.execute(stmt, rows)
@@ -7,23 +7,289 @@
 #       Author: Claudio Driussi <claudio.driussi@gmail.com>
 #
 import os
+import copy
+import hashlib
+import concurrent.futures
 import yaml
+from .stats import STATS
 
 
-def load_yaml(fname, paths="."):
-    """ Load a yaml file with includes and list of path search.
+def find_file(fname, paths="."):
+    """ Search a file in a list of paths and return the first one found.
     Usage:
-         data = load_yaml('foo.yaml', ['yaml','yaml/core'])
-    paths is a list of paths where search files defined with !include role.
+         filename = find_file('foo.yaml', ['yaml','yaml/core'])
+    paths is a list of paths where search the file, the first match wins.
     """
     for p in paths:
         filename = os.path.join(p, fname)
         if os.path.isfile(filename):
-            with open(filename, 'r') as f:
-                return yaml.load(f, YamlLoader)
+            return filename
+    raise Exception('File %s not found!' % fname)
+
+
+def load_yaml(fname, paths=".", files=None, loader=None, workers=0,
+              resolver=None):
+    """ Load a yaml file with includes and list of path search.
+    Usage:
+         data = load_yaml('foo.yaml', ['yaml','yaml/core'])
+         or, with libyaml and includes parsed by 4 processes
+         data = load_yaml('foo.yaml', paths, loader=CYamlLoader, workers=4)
+    paths is a list of paths where search files defined with !include role.
+    files is an optional dict filled with the files touched by the loader.
+    loader is the loader class, by default YamlLoader.
+    workers if greater than 1 is the number of processes used to parse
+    concurrently the files included by the main file.
+    resolver is an optional IncludeResolver, it can be reused for more loads
+    of the same paths.
+    The time of the load and the number of files are recorded into
+    dynaq.stats.STATS.
+    """
+    loader = loader or YamlLoader
+    resolver = resolver or IncludeResolver(paths)
+    filename = resolver.find(fname)
+    if files is None:
+        files = {}
+    files[fname] = filename
+    with STATS.phase('yaml_load'), open(filename, 'r') as f:
+        ld = loader(f, paths, files, resolver)
+        try:
+            if workers and workers > 1:
+                return ld.get_parallel_data(workers)
+            return ld.get_data()
+        finally:
+            ld.dispose()
+            STATS.count('files', len(files))
+
+
+def files_key(files, paths="."):
+    """ Calc the content hash of a set of files loaded by YamlLoader.
+
+    files is the dict {name: filename} filled by the loader, each name is
+    searched again along paths, so the key changes if a file is modified or
+    if a file with the same name shadows it in a path with higher precedence.
+    Return None if some file is no more found.
+    """
+    resolver = IncludeResolver(paths)
+    h = hashlib.sha1()
+    for name in sorted(files):
+        try:
+            filename = resolver.find(name)
+        except Exception:
+            return None
+        if filename != files[name]:
+            return None
+        with open(filename, 'rb') as f:
+            h.update(name.encode('utf-8'))
+            h.update(hashlib.sha1(f.read()).digest())
+    return h.hexdigest()
+
+
+class IncludeResolver(object):
+    """
+    Resolve file names along a list of search paths.
+
+    Each directory of the paths is listed only once and the names are
+    resolved from this index, so there is no stat call for each path of each
+    include. Parsed documents are memoized by resolved file name and
+    modification time, so a file included many times is parsed only once
+    and, if the resolver is reused, unchanged files are not parsed again.
+    Each load returns a deep copy of the memoized document, so the loaded
+    data can be changed, the returned copies are tracked for sources()
+    until they are released by forget().
+    The resolver lives for a whole load, call refresh() to reuse it after
+    files are changed on disk.
+    Usage:
+         resolver = IncludeResolver(['yaml','yaml/core'])
+         filename = resolver.find('foo.yaml')
+    """
+    def __init__(self, paths=['.']):
+        self.paths = paths
+        self.docs = {}
+        self.returned = {}
+        self.refresh()
+
+    def refresh(self):
+        """Forget the directory index, memoized documents are kept and
+        will be reused only if the file modification time is unchanged"""
+        self.dirs = {}
+        self.mtimes = {}
+
+    def _listdir(self, path):
+        """Return the set of file names of a directory, cached"""
+        if path not in self.dirs:
+            names = set()
+            try:
+                for e in os.scandir(path):
+                    if e.is_file():
+                        names.add(e.name)
+            except OSError:
+                pass
+            self.dirs[path] = names
+        return self.dirs[path]
+
+    def find(self, fname):
+        """Search a file along the paths, the first match wins
+
+        :param fname: the file name, can have a relative directory
+        :return: the resolved file name
+        """
+        dname, bname = os.path.split(fname)
+        for p in self.paths:
+            if bname in self._listdir(os.path.join(p, dname)):
+                return os.path.join(p, fname)
         raise Exception('File %s not found!' % fname)
 
-class YamlLoader(yaml.Loader):
+    def mtime(self, filename):
+        """Return the modification time of a file, cached until refresh()"""
+        if filename not in self.mtimes:
+            self.mtimes[filename] = os.path.getmtime(filename)
+        return self.mtimes[filename]
+
+    def load(self, filename, loader, files):
+        """Parse a file or return the memoized document
+
+        The memoized document is valid while the modification time of the
+        file and of the files it includes are unchanged.
+
+        :param filename: resolved file name
+        :param loader: loader class used to parse the file
+        :param files: dict filled with the files included by the document
+        :return: the parsed document
+        """
+        doc = self.docs.get(filename)
+        if doc is None or doc[0] != self.mtime(filename) or \
+                any(self.mtime(fn) != mt for fn, mt in doc[3].items()):
+            STATS.count('yaml_parsed')
+            nested = {}
+            with open(filename, 'r') as f:
+                ld = loader(f, self.paths, nested, self)
+                try:
+                    data = ld.get_data()
+                finally:
+                    ld.dispose()
+            stamps = dict((fn, self.mtime(fn)) for fn in nested.values())
+            doc = self.docs[filename] = (self.mtime(filename), data, nested, stamps)
+        else:
+            STATS.count('yaml_memoized')
+        files.update(doc[2])
+        data = copy.deepcopy(doc[1])
+        self.returned[id(data)] = (filename, data)
+        return data
+
+    def sources(self):
+        """Return the dict {id(document): filename} of returned documents,
+        used by Database.load_yaml() to track the source of types and tables
+        """
+        return dict((k, v[0]) for k, v in self.returned.items())
+
+    def forget(self, docs=None):
+        """Release the returned documents, they are no more in sources()
+
+        :param docs: list of documents returned by load(), if None all
+        :return: None
+        """
+        if docs is None:
+            self.returned = {}
+        for d in docs or []:
+            self.returned.pop(id(d), None)
+
+
+def _parse_include(loader, filename, paths, enabled):
+    """Parse an included file, used by worker processes, the statistics of
+    the worker are returned to be merged into STATS of the main process"""
+    STATS.reset()
+    STATS.hooks = []
+    STATS.enabled = enabled
+    files = {}
+    data = IncludeResolver(paths).load(filename, loader, files)
+    return data, files, STATS.as_dict()
+
+
+class IncludeMixin(object):
+    """
+    Implements the !include constructor and the search path rules for the
+    DynaQ yaml loaders, it must precede the yaml loader class in the bases.
+
+    paths is a list of paths where search files defined with !include role.
+    files is an optional dict filled with {name: filename} of each included
+    file, it is shared with nested includes.
+    resolver is the IncludeResolver shared with nested includes.
+    """
+    def __init__(self, stream, paths=['.'], files=None, resolver=None):
+        self.paths = paths
+        self.files = {} if files is None else files
+        self.resolver = resolver or IncludeResolver(paths)
+        super(IncludeMixin, self).__init__(stream)
+        self.add_constructor('!include', type(self).include)
+
+    def include(self, node):
+        fname = self.construct_scalar(node)
+        try:
+            with STATS.phase('include_lookup'):
+                filename = self.resolver.find(fname)
+        except Exception:
+            raise Exception('Include file %s not found!' % fname)
+        self.files[fname] = filename
+        return self.resolver.load(filename, type(self), self.files)
+
+    def get_parallel_data(self, workers):
+        """Get the document parsing the included files concurrently
+
+        The main document is composed, all the !include nodes are collected
+        and parsed by a pool of worker processes, then the document is
+        constructed using the parsed includes, which are stored into the
+        resolver. Nested includes are parsed by the worker that handle the
+        including file. The statistics of the workers are merged into STATS.
+
+        :param workers: number of worker processes
+        :return: the loaded data
+        """
+        node = self.get_single_node()
+        if node is None:
+            return None
+        names = []
+        _collect_includes(node, names, set())
+        jobs = {}
+        for fname in names:
+            try:
+                jobs[fname] = self.resolver.find(fname)
+            except Exception:
+                raise Exception('Include file %s not found!' % fname)
+        if len(jobs) > 1:
+            with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+                futures = dict((pool.submit(_parse_include, type(self), filename,
+                                            self.paths, STATS.enabled), fname)
+                               for fname, filename in jobs.items())
+                for fut in concurrent.futures.as_completed(futures):
+                    filename = jobs[futures[fut]]
+                    data, files, stats = fut.result()
+                    STATS.merge(stats)
+                    # store in the resolver, the includes will find them
+                    stamps = dict((fn, self.resolver.mtime(fn))
+                                  for fn in files.values())
+                    self.resolver.docs[filename] = \
+                        (self.resolver.mtime(filename), data, files, stamps)
+        return self.construct_document(node)
+
+
+def _collect_includes(node, names, seen):
+    """Collect the names of !include nodes of a composed yaml document"""
+    if id(node) in seen:
+        return
+    seen.add(id(node))
+    if isinstance(node, yaml.ScalarNode):
+        if node.tag == '!include' and node.value not in names:
+            names.append(node.value)
+    elif isinstance(node, yaml.SequenceNode):
+        for n in node.value:
+            _collect_includes(n, names, seen)
+    elif isinstance(node, yaml.MappingNode):
+        for k, v in node.value:
+            _collect_includes(k, names, seen)
+            _collect_includes(v, names, seen)
+
+
+class YamlLoader(IncludeMixin, yaml.Loader):
     """
     Load a yaml file with includes and list of path search.
     Usage:
@@ -32,17 +298,18 @@ class YamlLoader(yaml.Loader):
          data = yaml.load(open('foo.yaml','r',['yaml','yaml/core']), YamlLoader)
 
     paths is a list of paths where search files defined with !include role.
+    files is an optional dict filled with {name: filename} of each included
+    file, it is shared with nested includes.
     """
-    def __init__(self, stream, paths=['.']):
-        self.paths = paths
-        super(YamlLoader, self).__init__(stream)
-        self.add_constructor('!include', YamlLoader.include)
 
-    def include(self, node):
-        for p in self.paths:
-            filename = os.path.join(p, self.construct_scalar(node))
-            if os.path.isfile(filename):
-                with open(filename, 'r') as f:
-                    return yaml.load(f, YamlLoader)
-        raise Exception('Include file %s not found!' % self.construct_scalar(node))
 
+# libyaml based loaders, available only if pyyaml is compiled with libyaml
+if hasattr(yaml, 'CLoader'):
+    class CYamlLoader(IncludeMixin, yaml.CLoader):
+        """Same of YamlLoader but use the libyaml C parser"""
+
+    class CSafeYamlLoader(IncludeMixin, yaml.CSafeLoader):
+        """Same of CYamlLoader but construct only standard yaml tags"""
+else:
+    CYamlLoader = None
+    CSafeYamlLoader = None
@@ -6,26 +6,81 @@
 #    Copyright (c) 2014
 #    Author: Claudio Driussi <claudio.driussi@gmail.com>
 #
+import time
+import decimal
+import threading
+import asyncio
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.hybrid import hybrid_property
 from .db import *
+from . import bulk
+from . import usrfld
+from .query import Query, QueryCache
+from .lookup import LookupCache
+from .stats import STATS, QueryStats
+from .planner import table_indexes
+from . import restructure as _restructure
+
+# keys of the "pool" database property and create_engine() arguments
+POOL_OPTIONS = {
+    'size': 'pool_size',
+    'max_overflow': 'max_overflow',
+    'timeout': 'pool_timeout',
+    'recycle': 'pool_recycle',
+    'pre_ping': 'pool_pre_ping',
+    'lifo': 'pool_use_lifo',
+}
+
+# loading strategies of relationships handled by the "lazy" properties
+LAZY_STRATEGIES = ('select', 'selectin', 'joined', 'subquery', 'raise', 'noload')
+
 
 class WorkSpace(object):
     """Encapsulate an whole SQLAlchemy orm from an DynaQ db definition object"""
 
-    def __init__(self, db, engine):
+    def __init__(self, db, engine, scopefunc=None):
         """init the workspace
 
+        If engine is a string the engine is created with the pool options
+        stored into the "pool" property of the database, ie:
+        pool: {size: 10, max_overflow: 20, timeout: 30, pre_ping: true}
+        an Engine object is used as is, the pool options are ignored.
+        The workspace adds its listeners to the engine, call dispose() to
+        remove them when the workspace is no more used and the engine is
+        shared with other workspaces.
+
         :param db: DynaQ db definition object
-        :param engine: SQLAlchemy engine string
+        :param engine: SQLAlchemy engine or engine string
+        :param scopefunc: function which return the scope of sessions
+         returned by current_session(), by default the current thread, use
+         task_scope for asyncio tasks
         :return: None
         """
         self.db = db
+        self.pool_stats = PoolStats()
+        if isinstance(engine, str):
+            engine = sa.create_engine(engine, **pool_options(db))
         self.engine = engine
+        self.pool_stats.listen(engine)
+        if engine.dialect.name == 'sqlite' and uses_cascade_deletes(db):
+            sa.event.listen(engine, 'connect', _sqlite_foreign_keys)
+        self.session_factory = sa.orm.sessionmaker(bind=self.engine)
+        self.scoped_session = sa.orm.scoped_session(self.session_factory,
+                                                    scopefunc)
         self.metadata = sa.MetaData()
         self.Base = declarative_base(self.engine, self.metadata)
         self.tables = {}
+        self.children = {}
+        self.lazy = False
+        self.options = ('', {}, {})
+        self.query_cache = QueryCache()
+        lookup = db.get('lookup') or {}
+        self.lookup_cache = LookupCache(self, lookup.get('ttl'), lookup.get('prefill', False))
+        self.lookup_cache.listen(engine)
+        self.query_stats = QueryStats(self)
+        self.query_stats.listen(engine)
 
-    def generate_orm(self, prefix='', pref_tabels={}, defaults={}):
+    def generate_orm(self, prefix='', pref_tabels={}, defaults={}, lazy=False):
         """Generate the SQLAlchemy orm objects
 
         the objects are stored in self.tables dictionary
@@ -36,19 +91,111 @@ class WorkSpace(object):
          singles names ie: if pref_tabels is {'zip_codes': ''} the name of
          zip table is "zip_codes" even if prefix is "data_"
         :param defaults: function for handle default values (not handled yet)
+        :param lazy: if True the classes are generated on first access to
+         the sa_obj() container, with the tables related by foreign keys and
+         child relations, see map_table()
         :return: an self.sa_obj() objet for convenient handle of orm classes
         """
-        # build objects
-        self.tables = {}
-        for table in list(self.db.tables.values()):
-            self.tables[table.alias] = \
-                type(table.name.capitalize(),(self.Base,),
-                     self._set_table(table, prefix, pref_tabels, defaults))
-        # build relations
-        for alias in self.tables:
-            self._set_retations(alias)
+        with STATS.phase('generate_orm'):
+            self.tables = {}
+            self.options = (prefix, pref_tabels, defaults)
+            self.lazy = lazy
+            self.query_cache.clear()
+            self.lookup_cache.invalidate()
+            self.query_stats.refresh()
+            self._calc_children()
+            if not lazy:
+                self.warm_up()
+        return self.sa_obj()
+
+    def _calc_children(self):
+        """Calc the dict of child tables of each table"""
+        self.children = {}
+        for table in self.db.tables.values():
+            for f in table.fields:
+                if f.get('child'):
+                    self.children.setdefault(f.type.alias, []).append(table.alias)
+
+    def warm_up(self):
+        """Generate the classes of all tables not yet generated
+
+        :return: None
+        """
+        for alias in self.db.tables:
+            self.map_table(alias)
+
+    def map_table(self, alias):
+        """Generate the SQLAlchemy class of a table if not yet generated
+
+        The tables pointed by foreign keys and the child tables are generated
+        too, so the class can be used and the relations are in place.
+
+        :param alias: alias of the table
+        :return: the class object
+        """
+        if alias in self.tables:
+            return self.tables[alias]
+        if alias not in self.db.tables:
+            raise AttributeError('Table "%s" not defined' % alias)
+        table = self.db.tables[alias]
+        prefix, pref_tabels, defaults = self.options
+        self.tables[alias] = \
+            type(class_name(table),(self.Base,),
+                 self._set_table(table, prefix, pref_tabels, defaults))
+        STATS.count('classes_mapped')
+        for f in table.fields:
+            if isinstance(f.type, Table):
+                self.map_table(f.type.alias)
+        self._set_retations(alias)
+        for child in self.children.get(alias, []):
+            self.map_table(child)
+        return self.tables[alias]
+
+    def use_module(self, module):
+        """Use the orm classes of a module generated by dynaq.codegen
+
+        The module replaces the dynamic generation of classes, the DynaQ
+        Database of the workspace is attached to the classes.
+
+        :param module: the imported generated module
+        :return: an self.sa_obj() objet for convenient handle of orm classes
+        """
+        module.attach(self.db)
+        self.metadata = module.metadata
+        self.Base = module.Base
+        self.tables = dict(module.tables)
+        self.options = (module.OPTIONS['prefix'], module.OPTIONS['pref_tabels'], {})
+        self.lazy = False
+        self.query_cache.clear()
+        self.lookup_cache.invalidate()
+        self.query_stats.refresh()
+        self._calc_children()
         return self.sa_obj()
 
+    def create_all(self):
+        """Generate all classes and create the tables into the database
+
+        :return: None
+        """
+        self.warm_up()
+        self.metadata.create_all(self.engine)
+
+    def restructure(self, old=None, chunk_size=10000, progress=None, drop=False):
+        """Change the database to the structure of the workspace, see
+        restructure.diff() and restructure.apply()
+
+        :param old: the previous DynaQ Database, if None the structure is
+         read from the database
+        :param chunk_size: max number of rows copied by each transaction
+        :param progress: optional function progress(table, copied, total)
+        :param drop: if True the tables not defined are dropped
+        :return: the applied Plan
+        """
+        plan = _restructure.diff(self, old)
+        _restructure.apply(self, plan, chunk_size, progress, drop)
+        self.lookup_cache.invalidate()
+        return plan
+
     def _set_table(self, table, prefix='', pref_tabels={}, defaults={}):
         """Create a SQLAlchemy class object
 
@@ -62,37 +209,31 @@ class WorkSpace(object):
         :param defaults: same of generate_orm
         :return: the class object for the table
         """
-        def get_name(tname):
-            s = tname.replace('_'+USRFLD_KEY,'')
-            pref = pref_tabels[s] if s in pref_tabels else prefix
-            return pref + tname
         table_data = {}
-        table_data['__tablename__'] = get_name(table.name)
+        table_data['__tablename__'] = table_name(table.name, prefix, pref_tabels)
         table_data['__dqt__'] = table
         for f in table.fields:
-            foreignkey = None
+            sa_type = column_type(f)
             if isinstance(f.type, Table):
-                foreignkey = "%s.%s" % (get_name(f.type.name), f.type.key.name)
-            db_type = f.get_type()
-            sa_type = db_type.sa_type
-            if db_type.length and sa_type in [sa.Numeric, sa.Float]:
-                sa_type = sa_type(db_type.length, f.get('decimals'))
-            if  db_type.length and sa_type in [sa.String, sa.String, sa.CHAR, sa.LargeBinary, sa.Text,]:
-                sa_type = sa_type(db_type.length)
-            if foreignkey:
-                c = sa.Column(sa_type, sa.ForeignKey(foreignkey))
+                foreignkey = "%s.%s" % (table_name(f.type.name, prefix, pref_tabels),
+                                        f.type.key.name)
+                ondelete = 'CASCADE' if cascade_deletes(self.db, f) else None
+                c = sa.Column(sa_type, sa.ForeignKey(foreignkey, ondelete=ondelete))
             else:
                 c = sa.Column(sa_type, primary_key=f == table.key)
             c.__dqf__ = f
             default = defaults.get(f.get('default'), None)
             if default:
-                c.ColumnDefault(default)
+                c.default = sa.ColumnDefault(default)
             table_data[f.name] = c
+        for name, (fname, key, t) in table.packed.items():
+            table_data[name] = packed_property(fname, key, packed_cast(t))
         ii = []
-        for i in table.indexes:
-            if i.name == 'primary':
-                continue
-            ii.append(sa.Index('idx_%s_%s' % (table.alias, i.name), *i.fields))
+        for name, fields, unique, descending in table_indexes(self.db, table):
+            if descending:
+                fields = [table_data[x].desc() for x in fields]
+            ii.append(sa.Index('idx_%s_%s' % (table.alias, name), *fields,
+                               unique=unique))
         # if needed add more table args
         if ii:
             table_data['__table_args__'] = tuple(ii)
@@ -102,21 +243,18 @@ class WorkSpace(object):
         """Create the orm relationships.
 
         This private method called from self.generate_orm method generate the
-        one to many relations for each related field of the table pointed by
-        alias parameter. It handle "cascade referential integrity" if the
-        related field has the property "child == True"
+        relations for each related field of the table pointed by alias
+        parameter, see relations(). It handle "cascade referential integrity"
+        if the related field has the property "child == True"
 
         :param alias: alias name of the table
         :return: None
         """
-        for field in self.db.tables[alias].fields:
-            if field.get('child'):
-                parent = self.tables[field.type.alias]
-                child = self.tables[alias]
-                setattr(parent, alias,
-                        sa.orm.relationship(child,
-                                backref=parent.__tablename__,
-                                cascade="all, delete, delete-orphan"))
+        prefix, pref_tabels = self.options[:2]
+        for owner, name, target, kwargs in relations(self.db, alias, prefix, pref_tabels):
+            setattr(self.tables[owner], name,
+                    sa.orm.relationship(self.tables[target], **kwargs))
+            STATS.count('relationships')
 
     def sa_obj(self):
         """Build a convenient object for accessing to SqlAlchemy ORM objects
@@ -128,14 +266,570 @@ class WorkSpace(object):
 
         now if in your definition is a table called users, you can do:
         user = o.users()
+        If the orm is generated in lazy mode, the classes are generated on
+        first access to the container attributes.
+
         :return: the container object
         """
         t = {}
         for k,v in list(self.tables.items()):
             t[k] = v
+        if self.lazy:
+            t['_ws'] = self
+            return _LazyWSO('WSO', (object,), t)
         return type('WSO', (object,), t)
 
+    def bulk_load(self, alias, rows, batch_size=1000, columns=None):
+        """Insert rows into a table and its children bypassing the orm,
+        see bulk.load()
+
+        :param alias: alias name of the table
+        :param rows: iterable of dicts or tuples
+        :param batch_size: number of rows inserted in each transaction
+        :param columns: names of the values of tuple rows
+        :return: the number of rows inserted into the table
+        """
+        return bulk.load(self, alias, rows, batch_size, columns)
+
+    def bulk_load_csv(self, alias, filename, batch_size=1000, **kwargs):
+        """Insert the rows of a csv file into a table, see bulk.load_csv()
+
+        :param alias: alias name of the table
+        :param filename: name of the csv file
+        :param batch_size: number of rows inserted in each transaction
+        :param kwargs: optional arguments for csv.DictReader
+        :return: the number of rows inserted
+        """
+        return bulk.load_csv(self, alias, filename, batch_size, **kwargs)
+
+    def stream(self, alias, fields=None, where=None, batch_size=1000,
+               related=None, prop=None, keyset=False):
+        """Read a whole table in batches of dicts without loading objects
+        into the session, see bulk.stream()
+
+        :param alias: alias name of the table
+        :param fields: list of field names, by default all fields
+        :param where: a dict {field name: value} or a SQLAlchemy clause
+        :param batch_size: number of rows for each batch
+        :param related: dict {related field name: list of related fields}
+        :param prop: if given, only the fields which have this property
+        :param keyset: if True use keyset pagination instead of a cursor
+        :return: a generator of lists of dicts
+        """
+        return bulk.stream(self, alias, fields, where, batch_size, related,
+                           prop, keyset)
+
+    def bulk_delete(self, alias, where=None, conn=None):
+        """Delete rows of a table and their children with set based
+        statements, see bulk.delete()
+
+        :param alias: alias name of the table
+        :param where: a dict {field name: value} or a SQLAlchemy clause
+        :param conn: optional SQLAlchemy connection
+        :return: the number of rows deleted from the table
+        """
+        return bulk.delete(self, alias, where, conn)
+
+    def query(self, alias, fields=None, where=None, order_by=None, limit=None):
+        """Build a query on table aliases and field paths, the compiled
+        statements are kept into self.query_cache, see query.Query
+
+        :param alias: alias name of the main table
+        :param fields: list of field paths, ie: "id_prd.description"
+        :param where: list of conditions (field path, operator, parameter)
+        :param order_by: list of field paths, "-" prefix for descending
+        :param limit: max number of rows
+        :return: the Query object
+        """
+        return Query(self, alias, fields, where, order_by, limit)
+
+    def load_usrfld(self, alias, keys, conn=None):
+        """Load the user fields of many records with one query, see
+        usrfld.load()
+
+        :param alias: alias name of the owner table
+        :param keys: iterable of primary keys of the owner table
+        :param conn: optional SQLAlchemy connection
+        :return: a dict {key: {name: value}}
+        """
+        return usrfld.load(self, alias, keys, conn)
+
+    def save_usrfld(self, alias, values, conn=None):
+        """Insert, update or delete the user fields of many records, see
+        usrfld.save()
+
+        :param alias: alias name of the owner table
+        :param values: dict {key: {name: value}}, None values are deleted
+        :param conn: optional SQLAlchemy connection
+        :return: a tuple (inserted, updated, deleted) number of rows
+        """
+        return usrfld.save(self, alias, values, conn)
+
+    def stats(self):
+        """Return the statistics of the workspace
+
+        :return: a dict with the keys "pool" (see PoolStats), "queries" (see
+         stats.QueryStats), "query_cache", "lookup_cache" and "load", the
+         timings and counters of the schema loading and orm generation of
+         the process, see stats.Stats
+        """
+        return {'pool': self.pool_stats.as_dict(),
+                'queries': self.query_stats.as_dict(),
+                'query_cache': self.query_cache.as_dict(),
+                'lookup_cache': self.lookup_cache.as_dict(),
+                'load': STATS.as_dict()}
+
     def session(self):
-        """Return a session instance for the workspace"""
-        return sa.orm.sessionmaker(bind=self.engine)()
+        """Return a new session instance for the workspace"""
+        s = self.session_factory()
+        if self.lookup_cache.prefill_sessions:
+            self.lookup_cache.prefill(s)
+        return s
+
+    def current_session(self):
+        """Return the session of the current scope, by default the current
+        thread, the same session is returned until remove_session() is called
+        """
+        watch_task(self.scoped_session)
+        s = self.scoped_session()
+        if self.lookup_cache.prefill_sessions and 'dynaq_lookup' not in s.info:
+            self.lookup_cache.prefill(s)
+        return s
+
+    def remove_session(self):
+        """Close and discard the session of the current scope"""
+        self.scoped_session.remove()
+
+    def dispose(self):
+        """Close the session of the current scope and remove the listeners
+        of the workspace from the engine, the engine is not disposed
+
+        The sqlite hook which enables the foreign keys is shared by the
+        workspaces of the engine and is kept.
+
+        :return: None
+        """
+        self.scoped_session.remove()
+        self._unlisten()
+
+    def _unlisten(self):
+        """Remove the listeners of the workspace from the engine"""
+        self.pool_stats.unlisten(self.engine)
+        self.lookup_cache.unlisten(self.engine)
+        self.query_stats.unlisten(self.engine)
+
+
+class PoolStats(object):
+    """
+    Statistics of the connection pool of a WorkSpace engine.
+
+    connects: new DBAPI connections
+    checkouts, checkins: connections taken from and returned to the pool
+    invalidations: connections invalidated
+    in_use, peak_in_use: connections checked out now and at most
+    waits, wait_time, max_wait: number of checkouts from a StatsQueuePool
+      and the total and max seconds spent waiting for them
+    """
+    def __init__(self):
+        """init the counters"""
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Reset all counters"""
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidations = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.pool = None
+
+    def listen(self, engine):
+        """Collect the statistics of the engine pool
+
+        :param engine: SQLAlchemy engine
+        :return: None
+        """
+        self.pool = engine.pool
+        if isinstance(engine.pool, StatsQueuePool):
+            engine.pool.stats = self
+        sa.event.listen(engine, 'connect', self._on_connect)
+        sa.event.listen(engine, 'checkout', self._on_checkout)
+        sa.event.listen(engine, 'checkin', self._on_checkin)
+        sa.event.listen(engine, 'invalidate', self._on_invalidate)
+
+    def unlisten(self, engine):
+        """Stop collecting the statistics of the engine pool
+
+        :param engine: SQLAlchemy engine
+        :return: None
+        """
+        if getattr(engine.pool, 'stats', None) is self:
+            engine.pool.stats = None
+        for name, fn in (('connect', self._on_connect), ('checkout', self._on_checkout),
+                         ('checkin', self._on_checkin), ('invalidate', self._on_invalidate)):
+            if sa.event.contains(engine, name, fn):
+                sa.event.remove(engine, name, fn)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self.lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.checkins += 1
+            self.in_use = max(self.in_use - 1, 0)
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self.lock:
+            self.invalidations += 1
+
+    def add_wait(self, seconds):
+        """Add the time spent waiting for a connection"""
+        with self.lock:
+            self.waits += 1
+            self.wait_time += seconds
+            self.max_wait = max(self.max_wait, seconds)
+
+    def as_dict(self):
+        """Return the statistics as a dict"""
+        return {'connects': self.connects,
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'invalidations': self.invalidations,
+                'in_use': self.in_use,
+                'peak_in_use': self.peak_in_use,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'max_wait': self.max_wait,
+                'status': self.pool.status() if self.pool is not None else ''}
+
+
+class StatsQueuePool(sa.pool.QueuePool):
+    """QueuePool which measures the time spent waiting for connections"""
+    stats = None
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(StatsQueuePool, self)._do_get()
+        finally:
+            if self.stats is not None:
+                self.stats.add_wait(time.time() - start)
+
+    def recreate(self):
+        pool = super(StatsQueuePool, self).recreate()
+        pool.stats = self.stats
+        return pool
+
+
+def pool_options(db):
+    """Return the create_engine() arguments from the "pool" property
+
+    :param db: the DynaQ Database
+    :return: a dict of keyword arguments, empty if there are no options
+    """
+    pool = db.get('pool') or {}
+    options = {}
+    for k, v in pool.items():
+        if k not in POOL_OPTIONS:
+            raise Exception('Unknown pool option: %s' % k)
+        options[POOL_OPTIONS[k]] = v
+    if options:
+        options['poolclass'] = StatsQueuePool
+    return options
+
+
+def task_scope():
+    """Scope function for WorkSpace sessions bound to the asyncio task, or
+    to the thread outside of tasks
+
+    The scope is the task object, so it can't be reused by another task
+    while the session is registered, the session is removed when the task
+    is done, see watch_task()."""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return task if task is not None else threading.get_ident()
+
+
+def watch_task(scoped_session):
+    """Remove the session of the current task when the task is done
+
+    Called before the session of a scoped_session with task_scope is
+    created, so the sessions of finished tasks are not kept forever.
+
+    :param scoped_session: the scoped_session or async_scoped_session
+    :return: None
+    """
+    registry = scoped_session.registry
+    if getattr(registry, 'scopefunc', None) is not task_scope or registry.has():
+        return
+    task = task_scope()
+    if isinstance(task, asyncio.Task):
+        task.add_done_callback(lambda t: _remove_task_session(registry, t))
+
+
+def _remove_task_session(registry, task):
+    """Close and discard the session of a finished task"""
+    session = registry.registry.pop(task, None)
+    if session is None:
+        return
+    closing = session.close()
+    # AsyncSession.close() is a coroutine
+    if asyncio.iscoroutine(closing):
+        task.get_loop().create_task(closing)
+
+
+def table_name(tname, prefix='', pref_tabels={}):
+    """Return the physical name of a table
+
+    :param tname: name of the DynaQ table
+    :param prefix: same of WorkSpace.generate_orm
+    :param pref_tabels: same of WorkSpace.generate_orm, the user fields
+     tables use the same prefix of the owner
+    :return: the name of the table into the database
+    """
+    s = tname.replace('_'+USRFLD_KEY,'')
+    pref = pref_tabels[s] if s in pref_tabels else prefix
+    return pref + tname
+
+
+def column_type(f):
+    """Return the SQLAlchemy type of a field
+
+    :param f: the DynaQ field
+    :return: the SQLAlchemy type class or instance
+    """
+    db_type = f.get_type()
+    sa_type = db_type.sa_type
+    if db_type.length and sa_type in [sa.Numeric, sa.Float]:
+        sa_type = sa_type(db_type.length, f.get('decimals'))
+    if  db_type.length and sa_type in [sa.String, sa.CHAR, sa.LargeBinary, sa.Text,]:
+        sa_type = sa_type(db_type.length)
+    return sa_type
+
+
+def packed_cast(t):
+    """Return the name of the JSON cast used to compare packed elements
+
+    :param t: the DynaQ type of the element
+    :return: "integer", "float", "string", "boolean" or None
+    """
+    sa_type = t.sa_type
+    try:
+        if isinstance(sa_type, type):
+            sa_type = sa_type()
+        python_type = sa_type.python_type
+    except (TypeError, NotImplementedError):
+        return None
+    if python_type is bool:
+        return 'boolean'
+    if issubclass(python_type, int):
+        return 'integer'
+    if python_type in (float, decimal.Decimal):
+        return 'float'
+    if issubclass(python_type, str):
+        return 'string'
+    return None
+
+
+def packed_expression(column, key, cast=None):
+    """Return the SQL expression of an element of a packed column
+
+    :param column: the JSON column or orm attribute
+    :param key: index of an array or member name of a compound
+    :param cast: see packed_cast()
+    :return: the SQLAlchemy expression
+    """
+    expr = column[key]
+    return getattr(expr, 'as_%s' % cast)() if cast else expr
+
+
+def packed_property(name, key, cast=None):
+    """Return the accessor of an element of a packed field
+
+    The accessor reads and writes the element of the JSON value of the field,
+    in queries is the JSON element of the column, so it can be used where the
+    database supports JSON functions, ie:
+    s.query(o.row).filter(o.row.discount01 > 5)
+
+    :param name: name of the packed field
+    :param key: index of an array or member name of a compound
+    :param cast: see packed_cast()
+    :return: the hybrid property
+    """
+    def fget(self):
+        value = getattr(self, name)
+        try:
+            return value[key]
+        except (TypeError, IndexError, KeyError):
+            return None
+
+    def fset(self, v):
+        # a new value is set so the change of the column is detected
+        value = getattr(self, name)
+        if isinstance(key, int):
+            value = list(value or [])
+            value.extend([None] * (key + 1 - len(value)))
+        else:
+            value = dict(value or {})
+        value[key] = v
+        setattr(self, name, value)
+
+    def expr(cls):
+        return packed_expression(getattr(cls, name), key, cast)
+
+    return hybrid_property(fget, fset, expr=expr)
+
+
+def relations(db, alias, prefix='', pref_tabels={}):
+    """Generator of the relationships of the related fields of a table
+
+    For each related field with the property "child == True" yield the one
+    to many relationship set into the parent class, which points to the
+    class of the table, with a backref named as the parent table.
+    For the other related fields a relationship is generated only if the
+    field has the property "relation", the name of the many to one
+    relationship set into the class of the table (or True to use the alias
+    of the related table). If the field has the property "backref" the one
+    to many relationship with this name is set into the related class too.
+
+    The loading strategy and the order of relationships are set by these
+    field properties:
+    - lazy: strategy of the relationship of the field, one of
+      LAZY_STRATEGIES
+    - backref_lazy: strategy of the backref of non child fields
+    - order_by: order of the collection, the name of an index of the table
+      or a list of fields, ie: "order_by: [id_ord, n_order]"
+
+    :param db: the DynaQ Database
+    :param alias: alias name of the table
+    :param prefix: same of WorkSpace.generate_orm
+    :param pref_tabels: same of WorkSpace.generate_orm
+    :return: tuples (alias of the class where the relationship is set,
+     relationship name, alias of the related class, keyword arguments)
+    """
+    table = db.tables[alias]
+    for field in table.fields:
+        if not isinstance(field.type, Table):
+            continue
+        parent = field.type
+        order_by = _order_by(table, field.get('order_by'))
+        if field.get('child'):
+            kwargs = {'backref': table_name(parent.name, prefix, pref_tabels),
+                      'cascade': "all, delete, delete-orphan"}
+            if sum(1 for f in table.fields if f.type is parent) > 1:
+                # other foreign keys point to the parent table
+                kwargs['foreign_keys'] = '[%s.%s]' % (class_name(table), field.name)
+            if cascade_deletes(db, field):
+                kwargs['passive_deletes'] = True
+            _set_lazy(kwargs, table, field, 'lazy')
+            if order_by:
+                kwargs['order_by'] = order_by
+            yield parent.alias, alias, alias, kwargs
+        elif field.get('relation'):
+            name = field.get('relation')
+            if name is True:
+                name = parent.alias
+            kwargs = {'foreign_keys': '[%s.%s]' % (class_name(table), field.name)}
+            _set_lazy(kwargs, table, field, 'lazy')
+            backref = field.get('backref')
+            if backref:
+                kwargs['back_populates'] = backref
+                bkwargs = {'foreign_keys': kwargs['foreign_keys'],
+                           'back_populates': name}
+                _set_lazy(bkwargs, table, field, 'backref_lazy')
+                if order_by:
+                    bkwargs['order_by'] = order_by
+                yield parent.alias, backref, alias, bkwargs
+            yield alias, name, parent.alias, kwargs
+
+
+def cascade_deletes(db, field):
+    """Check if the deletion of a parent row is cascaded by the database
+
+    Child fields with the property "passive_deletes", or all child fields if
+    the Database has this property, are foreign keys with "ON DELETE
+    CASCADE" and their relationships use passive deletes, so the orm does not
+    load the child rows to delete them.
+
+    :param db: the DynaQ Database
+    :param field: the related DynaQ field
+    :return: True if the field is a child field cascaded by the database
+    """
+    if not field.get('child'):
+        return False
+    return bool(field.get('passive_deletes', db.get('passive_deletes', False)))
+
+
+def uses_cascade_deletes(db):
+    """Return True if some child field is cascaded by the database"""
+    return any(cascade_deletes(db, f) for t in db.tables.values() for f in t.fields)
+
+
+def _sqlite_foreign_keys(dbapi_connection, connection_record):
+    """Enable foreign keys, and so ON DELETE CASCADE, on sqlite connections"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.close()
+
+
+def class_name(table):
+    """Return the name of the orm class of a table"""
+    return table.name.capitalize()
+
+
+def _set_lazy(kwargs, table, field, prop):
+    """Set the "lazy" relationship argument from a field property of a table,
+    field.table is the parent table for inherited fields"""
+    lazy = field.get(prop)
+    if lazy is None:
+        return
+    if lazy not in LAZY_STRATEGIES:
+        raise Exception('Unknown loading strategy "%s" for field "%s.%s"'
+                        % (lazy, table.alias, field.name))
+    kwargs['lazy'] = lazy
+
+
+def _order_by(table, order_by):
+    """Return the order_by relationship argument as a string evaluated
+    by the declarative class registry, ie: "[Ord_rows.id_ord, Ord_rows.n_order]"
+
+    :param table: the DynaQ table of the collection
+    :param order_by: name of an index of the table or list of fields
+    :return: the string or None
+    """
+    if not order_by:
+        return None
+    if isinstance(order_by, str):
+        if order_by in table.inames:
+            order_by = table.inames[order_by].fields
+        else:
+            order_by = [order_by]
+    for f in order_by:
+        if f not in table.fnames:
+            raise Exception('Field "%s" not defined in table "%s"' % (f, table.alias))
+    return '[%s]' % ', '.join('%s.%s' % (class_name(table), f) for f in order_by)
+
 
+class _LazyWSO(type):
+    """Metaclass of the lazy sa_obj() container, generate the classes on
+    first access"""
+    def __getattr__(cls, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        c = cls._ws.map_table(name)
+        setattr(cls, name, c)
+        return c
@@ -7,6 +7,13 @@
 #       Author: Claudio Driussi <claudio.driussi@gmail.com>
 
 import os
+import copy
+import types
+import asyncio
+import operator
+import importlib.util
+import shutil
+import tempfile
 import unittest
 import dynaq as dq
 import sqlalchemy as sa
@@ -16,6 +23,8 @@ import sqlalchemy as sa
 # files, so we can override standard yaml files with custom ones.
 YAML_DIR = "yaml"
 YPATH = [YAML_DIR, os.path.join(YAML_DIR, "custom"), os.path.join(YAML_DIR, "core")]
+# same files with the relationships options of ord_rows
+RPATH = [os.path.join(YAML_DIR, "relations")] + YPATH
 
 class LoadTest(unittest.TestCase):
 
@@ -32,6 +41,41 @@ class LoadTest(unittest.TestCase):
         # a table file has the key 'type' which identify the type of file
         self.failUnless('type' in self.yaml['tables'][0])
 
+    def test_resolver(self):
+        # names are resolved along the paths, the first match wins
+        r = dq.utils.IncludeResolver(YPATH)
+        self.failUnless(r.find('prd_list.yml') == os.path.join(YAML_DIR, 'prd_list.yml'))
+        self.failUnless(r.find('measures.yml') == os.path.join(YAML_DIR, 'custom', 'measures.yml'))
+        self.failUnless(r.find('core/types_base.yml') == os.path.join(YAML_DIR, 'core', 'types_base.yml'))
+        self.assertRaises(Exception, r.find, 'missing.yml')
+        # load_yaml searches all the paths
+        self.failUnless(dq.utils.load_yaml('measures.yml', YPATH)['alias'] == 'msr')
+        # the documents are parsed once per load
+        files = {}
+        filename = r.find('types_base.yml')
+        d1 = r.load(filename, dq.utils.YamlLoader, files)
+        d2 = r.load(filename, dq.utils.YamlLoader, files)
+        self.failUnless(len(r.docs) == 1)
+        # each load returns a copy
+        self.failUnless(d1 == d2 and d1 is not d2)
+        d1.clear()
+        self.failUnless(r.load(filename, dq.utils.YamlLoader, files) == d2)
+        self.failUnless(r.sources()[id(d2)] == filename)
+        r.forget([d1])
+        self.failUnless(id(d1) not in r.sources() and id(d2) in r.sources())
+
+    @unittest.skipIf(dq.utils.CYamlLoader is None, 'libyaml not available')
+    def test_c_loader(self):
+        # libyaml loader with includes parsed by a pool of processes
+        files = {}
+        dq.stats.STATS.reset()
+        data = dq.utils.load_yaml('db.yml', YPATH, files,
+                                  dq.utils.CYamlLoader, workers=2)
+        self.failUnless(data == self.yaml)
+        self.failUnless('types_base.yml' in files)
+        # the files parsed by the workers are counted
+        self.failUnless(dq.stats.STATS.counters['yaml_parsed'] == len(files) - 1)
+
     def test_db_yaml(self):
         # instantiate a Database class and load the yaml files
         db = dq.Database()
@@ -63,7 +107,18 @@ class LoadTest(unittest.TestCase):
         self.failUnless('discount01' in db.tables['prc'].fnames)
         self.failUnless('add_street' in db.tables['sbj'].fnames)
         self.failUnless('length' in db.tables['prd'].fnames['description'].properties)
+        # field properties override type properties, falsy values too
+        f = db.tables['prd'].fnames['description']
+        self.failUnless(f.get('length') == 128)
+        self.failUnless(f.get('nullable') is False)
+        self.failUnless(db.tables['sbj'].fnames['notes'].get('nullable', True) is True)
+        self.failUnless(db.tables['ord'].fnames['id_sbj'].get('sa_type') == sa.Integer)
+        self.assertRaises(TypeError, operator.setitem, f.props(), 'length', 1)
         self.failUnless('color' in db.tables['cst'].properties)
+        # inherited tables share fields and keep the parent key
+        self.failUnless(db.tables['cst'].fnames['name'] is db.tables['sbj'].fnames['name'])
+        self.failUnless(db.tables['cst'].key is db.tables['sbj'].key)
+        self.failUnless(db.tables['cst'].fnames['dgroup'].table is db.tables['cst'])
 
         # indexes in tables
         # some indexes assertions
@@ -79,14 +134,101 @@ class LoadTest(unittest.TestCase):
         self.failUnless('prd_uf' in db.tables)
         self.failUnless(isinstance(db.tables['sbj_uf'].fnames['id_sbj'].type, dq.Table))
 
+    def test_memory(self):
+        db = dq.Database()
+        db.properties['intern_properties'] = True
+        db.load_yaml(self.yaml)
+        # compact objects with shared properties dicts
+        self.failIf(hasattr(db.tables['sbj'].fnames['name'], '__dict__'))
+        self.failUnless(db.types['company'].properties is db.types['name'].properties)
+        self.failUnless(db.tables['prc'].fnames['discount01'].properties is
+                        db.tables['prc'].fnames['discount02'].properties)
+        # shared dicts are read only, the writers change a copy
+        f = db.tables['prc'].fnames['discount01']
+        self.assertRaises(TypeError, operator.setitem, f.properties, 'width', 5)
+        f.set_property('width', 5)
+        self.failUnless(f.get('width') == 5)
+        self.failIf('width' in db.tables['prc'].fnames['discount02'].properties)
+        db.add_types({'type': 'types', 'types': [],
+                      'properties': {'types': [['company', 'width', 40]]}})
+        db.calc_types()
+        self.failUnless(db.types['company'].get('width') == 40)
+        self.failIf('width' in db.types['name'].properties)
+        r = db.memory_report()
+        self.failUnless(r['fields']['count'] == sum(len(t.fields) for t in db.tables.values()
+                                                   if t.alias != 'cst') + 3)
+        self.failUnless(r['total']['bytes'] == sum(v['bytes'] for k, v in r.items() if k != 'total'))
+
+    def test_calc(self):
+        db = dq.Database()
+        db.load_yaml(self.yaml)
+        # runtime types and tables are calculated incrementally
+        t = dq.Type('mytype')
+        t.inherit = 'price'
+        db.types['mytype'] = t
+        db.calc_types()
+        self.failUnless(t.sa_type == sa.Numeric and t.get('decimals') == 4)
+        # a replaced parent is inherited again from the declared values
+        t = dq.Type('description')
+        t.inherit = 'char'
+        t.length = 99
+        t.properties = {'width': 10}
+        db.types['description'] = t
+        db.calc_types()
+        company = db.types['company']
+        self.failUnless(company.length == 99 and company.sa_type == sa.CHAR)
+        self.failUnless(company.get('width') == 10 and 'nullable' not in company.properties)
+        # cached views follow the changes of properties
+        db.properties['passive_deletes'] = True
+        self.failUnless(db.get('passive_deletes'))
+        del db.properties['passive_deletes']
+        self.failIf(db.get('passive_deletes'))
+        f = db.tables['ord'].fnames['id']
+        f.get('nullable')
+        f.properties = dict(f.properties, nullable=True)
+        self.failUnless(f.get('nullable') is True and f.props()['nullable'] is True)
+        # the views are invalidated by the changes of their own database only
+        view, generation = f.view, db.generation[0]
+        other = dq.Database()
+        other.load_yaml(self.yaml)
+        other.tables['ord'].fnames['id'].properties['nullable'] = False
+        dq.Type('other').properties['width'] = 1
+        self.failUnless(db.generation[0] == generation)
+        self.failUnless(f.get('nullable') is True and f.view is view)
+        # properties are not shared by default, they can be changed in place
+        for f in db.tables['ord'].fields:
+            f.properties['width'] = 7
+        self.failUnless(all(f.get('width') == 7 for f in db.tables['ord'].fields))
+        self.failIf('width' in db.tables['row'].fnames['id'].properties)
+        db.add_table({'type': 'table', 'name': 'notes', 'usrfld': True,
+                      'fields': [['id', 'idint', 'ID'], ['id_ord', '=ord', 'Order']]})
+        self.failIf(db.tables['notes'].resolved)
+        db.calc_tables()
+        self.failUnless(db.tables['notes'].fnames['id_ord'].type is db.tables['ord'])
+        self.failUnless('notes_uf' in db.tables)
+
+        # errors on cycles and missing parents
+        t = dq.Type('loop1')
+        t.inherit = 'loop2'
+        db.types['loop1'] = t
+        t = dq.Type('loop2')
+        t.inherit = 'loop1'
+        db.types['loop2'] = t
+        self.assertRaises(Exception, db.calc_types)
+        t.inherit = 'missing'
+        self.assertRaises(Exception, db.calc_types)
+        db.add_table({'type': 'table', 'name': 'bad',
+                      'fields': [['id', 'idint', 'ID'], ['id_x', '=missing', 'X']]})
+        self.assertRaises(Exception, db.calc_tables)
+
 
 class WSTest(unittest.TestCase):
 
     def __init__(self, *args, **kwargs):
         super(WSTest, self).__init__(*args, **kwargs)
-        yaml = dq.utils.YamlLoader(open(os.path.join(YAML_DIR, "db.yml"),'r'),YPATH).get_data()
+        self.yaml = dq.utils.YamlLoader(open(os.path.join(YAML_DIR, "db.yml"),'r'),YPATH).get_data()
         self.db = dq.Database()
-        self.db.load_yaml(yaml)
+        self.db.load_yaml(self.yaml)
         if os.path.isfile('test.db'):
             os.remove('test.db')
 
@@ -122,6 +264,678 @@ class WSTest(unittest.TestCase):
         self.failUnless(s.query(o.sbj).count() == 0)
         self.failUnless(s.query(o.sbj_uf).filter_by(id_sbj=x.id).count() == 0)
 
+    def test_lazy(self):
+        engine = sa.create_engine('sqlite://', echo=False)
+        ws = dq.WorkSpace(self.db, engine)
+        o = ws.generate_orm('data_', {'products': ''}, lazy=True)
+        self.failIf(ws.tables)
+        # the first access generates the class and the related ones
+        self.failUnless(o.ord.__tablename__ == 'data_orders')
+        self.failUnless('row' in ws.tables and 'sbj_uf' in ws.tables)
+        self.failIf('cst' in ws.tables)
+        ws.create_all()
+        self.failUnless('cst' in ws.tables)
+        s = ws.session()
+        x = o.ord(n_doc=1)
+        x.row.append(o.row(n_order=1))
+        s.add(x)
+        s.commit()
+        self.failUnless(s.query(o.row).filter_by(id_ord=x.id).count() == 1)
+
+    def test_codegen(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            files = {}
+            db = dq.Database()
+            db.load_yaml(dq.utils.load_yaml('db.yml', RPATH, files))
+            filename = os.path.join(tmp, 'orders_orm.py')
+            dq.codegen.write_module(filename, db, 'data_', {'products': ''}, files, RPATH)
+            spec = importlib.util.spec_from_file_location('orders_orm', filename)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            self.failIf(dq.codegen.is_stale(module, RPATH, 'data_'))
+            self.failUnless(dq.codegen.is_stale(module, RPATH, 'other_'))
+
+            ws = dq.WorkSpace(db, sa.create_engine('sqlite://'))
+            o = ws.use_module(module)
+            ws.create_all()
+            self.failUnless(o.sbj.__dqt__ is db.tables['sbj'])
+            self.failUnless(o.prd.__tablename__ == 'products')
+            self.failUnless(o.sbj.__table__.c.name.__dqf__ is db.tables['sbj'].fnames['name'])
+            s = ws.session()
+            x = o.sbj(name='John')
+            x.sbj_uf.append(o.sbj_uf(name='var1', value=1))
+            s.add(x)
+            s.commit()
+            self.failUnless(s.query(o.sbj_uf).filter_by(id_sbj=x.id).count() == 1)
+            self.failUnless(o.ord.row.property.lazy == 'selectin')
+            self.failUnless(o.row.product.property.mapper.class_ is o.prd)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_sessions(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.db.properties['pool'] = {'size': 2, 'max_overflow': 1, 'pre_ping': True}
+        ws = dq.WorkSpace(self.db, 'sqlite:///%s' % os.path.join(tmp, 'pool.db'))
+        self.failUnless(isinstance(ws.engine.pool, dq.workspace.StatsQueuePool))
+        ws.generate_orm()
+        ws.create_all()
+        # one session per thread
+        s = ws.current_session()
+        self.failUnless(s is ws.current_session())
+        s.query(ws.tables['sbj']).count()
+        ws.remove_session()
+        self.failIf(s is ws.current_session())
+        stats = ws.pool_stats.as_dict()
+        self.failUnless(stats['checkouts'] >= 1 and stats['waits'] == stats['checkouts'])
+        self.failUnless(stats['peak_in_use'] >= 1)
+        # one session per task, removed when the task is done
+        ws = dq.WorkSpace(self.db, sa.create_engine('sqlite://'), dq.task_scope)
+        ws.generate_orm()
+        async def task():
+            s = ws.current_session()
+            await asyncio.sleep(0)
+            return s is ws.current_session()
+        async def run():
+            done = await asyncio.gather(task(), task())
+            await asyncio.sleep(0)
+            return done
+        self.failUnless(asyncio.run(run()) == [True, True])
+        self.failIf(ws.scoped_session.registry.registry)
+        # the listeners of disposed workspaces are removed from the engine
+        dispatch = ws.engine.dispatch
+        listeners = len(dispatch.before_cursor_execute), len(dispatch.after_execute)
+        for i in range(3):
+            dq.WorkSpace(self.db, ws.engine).dispose()
+        self.failUnless((len(dispatch.before_cursor_execute), len(dispatch.after_execute)) ==
+                        listeners)
+        ws.dispose()
+        self.failIf(len(dispatch.before_cursor_execute) or len(dispatch.after_execute))
+
+    def test_bulk(self):
+        ws = dq.WorkSpace(self.db, sa.create_engine('sqlite://'))
+        o = ws.generate_orm()
+        ws.create_all()
+        # parents with children, compound and user fields in one pass
+        n = ws.bulk_load('sbj', ({'name': 'Sbj %d' % i,
+                                  'add_': {'city': 'Udine', 'zip': '33100'},
+                                  'usrfld': {'var1': i, 'var2': 'x'}}
+                                 for i in range(25)), batch_size=10)
+        self.failUnless(n == 25)
+        s = ws.session()
+        self.failUnless(s.query(o.sbj).filter_by(add_city='Udine').count() == 25)
+        self.failUnless(s.query(o.sbj_uf).count() == 50)
+        # tuples, arrays and child tables
+        ws.bulk_load('prd', [('P1', 'Product 1'), ('P2', 'Product 2')], columns=['id', 'description'])
+        ws.bulk_load('ord', [{'id': 1, 'n_doc': 1,
+                              'row': [{'n_order': 1, 'id_prd': 'P1', 'discount': [10, 5]},
+                                      {'n_order': 2, 'id_prd': 'P2'}]}])
+        r = s.query(o.row).filter_by(id_ord=1, n_order=1).one()
+        self.failUnless(r.discount01 == 10 and r.discount02 == 5 and r.discount03 is None)
+        self.failUnless(s.query(o.row).filter_by(id_ord=1).count() == 2)
+        self.assertRaises(Exception, ws.bulk_load, 'prd', [{'missing': 1}])
+
+        # csv files
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        filename = os.path.join(tmp, 'orders.csv')
+        with open(filename, 'w') as f:
+            f.write('id,n_doc,d_doc\n2,2,2014-09-03T10:00:00\n3,3,\n')
+        self.failUnless(ws.bulk_load_csv('ord', filename) == 2)
+        self.failUnless(s.query(o.ord).get(2).d_doc.year == 2014)
+
+    def test_stream(self):
+        ws = dq.WorkSpace(self.db, sa.create_engine('sqlite://'))
+        ws.generate_orm()
+        ws.create_all()
+        ws.bulk_load('prd', [('P1', 'Product 1'), ('P2', 'Product 2')], columns=['id', 'description'])
+        ws.bulk_load('ord', [{'id': 1, 'row': [{'n_order': i, 'id_prd': 'P%d' % (i % 2 + 1),
+                                                 'discount': [i]} for i in range(25)]}])
+        for keyset in (False, True):
+            batches = list(ws.stream('row', ['n_order', 'discount'], {'id_ord': 1}, 10,
+                                     {'id_prd': ['description']}, keyset=keyset))
+            self.failUnless([len(b) for b in batches] == [10, 10, 5])
+            r = batches[0][1]
+            self.failUnless(sorted(r) == ['discount01', 'discount02', 'discount03', 'discount04',
+                                          'discount05', 'id', 'id_prd.description', 'n_order'])
+            self.failUnless(r['id_prd.description'] == 'Product 2' and r['discount01'] == 1)
+        # fields selected by property
+        self.failUnless(sorted(list(ws.stream('prd', prop='list'))[0][0]) == ['dgroup', 'id'])
+
+    def test_usrfld(self):
+        ws = dq.WorkSpace(self.db, sa.create_engine('sqlite://'))
+        ws.generate_orm()
+        ws.create_all()
+        self.failUnless(next(iter(ws.tables['sbj_uf'].__table__.indexes)).unique)
+        ws.bulk_load('sbj', [{'id': i, 'name': 'S%d' % i, 'usrfld': {'var1': i}} for i in range(1, 4)])
+        uf = ws.load_usrfld('sbj', [1, 2, 3, 4])
+        self.failUnless(uf == {1: {'var1': '1'}, 2: {'var1': '2'}, 3: {'var1': '3'}, 4: {}})
+        r = ws.save_usrfld('sbj', {1: {'var1': 'a', 'var2': 'b'}, 2: {'var1': None}, 4: {'var1': 'd'}})
+        self.failUnless(r == (2, 1, 1))
+        uf = ws.load_usrfld('sbj', [1, 2, 4])
+        self.failUnless(uf == {1: {'var1': 'a', 'var2': 'b'}, 2: {}, 4: {'var1': 'd'}})
+        # rows written by another writer after the read are updated
+        sa_table, fk = dq.usrfld.uf_table(ws, 'sbj')
+        with ws.engine.begin() as conn:
+            dq.usrfld._upsert(conn, sa_table, fk, [{fk: 1, 'name': 'var1', 'value': 'z'}])
+        with ws.engine.connect() as conn:
+            self.failUnless(conn.execute(sa.select([sa_table.c.value]).where(
+                sa_table.c[fk] == 1)).fetchall() in ([('z',), ('b',)], [('b',), ('z',)]))
+        # databases with the old non unique index are restructured
+        ix = next(iter(sa_table.indexes))
+        with ws.engine.begin() as conn:
+            ix.drop(conn)
+            conn.execute('CREATE INDEX %s ON %s (id_sbj, name)' % (ix.name, sa_table.name))
+        changes = dict((ch.name, ch) for ch in dq.restructure.diff(ws).changes)
+        self.failUnless(changes[sa_table.name].add_indexes == [ix.name])
+        ws.restructure()
+        self.failIf(sa_table.name in [ch.name for ch in dq.restructure.diff(ws).changes])
+        self.failUnless(ws.save_usrfld('sbj', {1: {'var1': 'y'}}) == (0, 1, 0))
+
+    def test_relations(self):
+        self.db = dq.Database()
+        self.db.load_yaml(dq.utils.load_yaml('db.yml', RPATH))
+        ws = dq.WorkSpace(self.db, sa.create_engine('sqlite://'))
+        o = ws.generate_orm()
+        ws.create_all()
+        rel = o.ord.row.property
+        self.failUnless(rel.lazy == 'selectin')
+        self.failUnless([c.name for c in rel.order_by] == ['id_ord', 'n_order'])
+        self.failUnless(o.row.product.property.lazy == 'select')
+        self.failUnless(o.prd.rows.property.lazy == 'noload')
+        s = ws.session()
+        p = o.prd(id='P1', description='Product 1')
+        s.add(o.ord(id=1, row=[o.row(n_order=2, product=p), o.row(n_order=1, product=p)]))
+        s.commit()
+        s.expunge_all()
+        x = s.query(o.ord).one()
+        self.failUnless([r.n_order for r in x.row] == [1, 2])
+        self.failUnless(x.row[0].product.description == 'Product 1')
+        self.failUnless(s.query(o.prd).one().rows == [])
+        # unknown strategy
+        self.db.tables['row'].fnames['id_ord'].properties = {'child': True, 'lazy': 'eager'}
+        self.db.invalidate_views()
+        self.failUnlessRaises(Exception, list, dq.workspace.relations(self.db, 'row'))
+        # inherited fields are shared, errors report the walked table
+        self.db.add_table({'type': 'table', 'name': 'rows2', 'alias': 'rw2', 'inherit': 'row',
+                           'fields': [['note', 'text', 'Note']]})
+        self.db.calc_tables()
+        self.failUnless(self.db.tables['rw2'].fnames['id_ord'].table is self.db.tables['row'])
+        self.assertRaisesRegex(Exception, 'rw2.id_ord', list, dq.workspace.relations(self.db, 'rw2'))
+
+    def test_delete(self):
+        rows = [{'id': i, 'id_sbj': 1, 'n_doc': i, 'row': [{'n_order': 1}, {'n_order': 2}]}
+                for i in range(1, 5)]
+        # children deleted by the database
+        self.db.properties['passive_deletes'] = True
+        ws = dq.WorkSpace(self.db, sa.create_engine('sqlite://'))
+        o = ws.generate_orm()
+        ws.create_all()
+        self.failUnless(o.ord.row.property.passive_deletes)
+        fk = list(ws.tables['row'].__table__.c.id_ord.foreign_keys)[0]
+        self.failUnless(fk.ondelete == 'CASCADE')
+        ws.bulk_load('sbj', [{'id': 1, 'name': 'John'}])
+        ws.bulk_load('ord', rows)
+        self.failUnless(ws.bulk_delete('ord', o.ord.n_doc < 3) == 2)
+        with ws.engine.connect() as conn:
+            self.failUnless(conn.execute('select count(*) from ord_rows').scalar() == 4)
+        s = ws.session()
+        s.delete(s.query(o.ord).get(3))
+        s.commit()
+        self.failUnless(s.query(o.row).count() == 2)
+        # children deleted with set based statements
+        db = dq.Database()
+        db.load_yaml(self.yaml)
+        ws = dq.WorkSpace(db, sa.create_engine('sqlite://'))
+        o = ws.generate_orm()
+        ws.create_all()
+        self.failIf(o.ord.row.property.passive_deletes)
+        fk = list(ws.tables['row'].__table__.c.id_ord.foreign_keys)[0]
+        self.failUnless(fk.ondelete is None)
+        ws.bulk_load('sbj', [{'id': 1, 'name': 'John', 'usrfld': {'var1': 1}}])
+        ws.bulk_load('ord', rows)
+        ws.query_stats.reset()
+        self.failUnless(ws.bulk_delete('ord', {'id_sbj': 1}) == 4)
+        stats = ws.query_stats.as_dict()
+        self.failUnless(stats['row']['kinds'] == {'delete': 1})
+        self.failUnless(stats['ord']['kinds'] == {'delete': 1})
+        self.failUnless(ws.bulk_delete('sbj') == 1)
+        self.failUnless(ws.query_stats.as_dict()['sbj_uf']['kinds'] == {'delete': 1})
+        s = ws.session()
+        self.failUnless(s.query(o.row).count() == 0 and s.query(o.sbj_uf).count() == 0)
+
+    def test_packed(self):
+        self.db.add_table({'type': 'table', 'name': 'packed', 'fields': [
+            ['id', 'idint', 'ID'],
+            ['discount', 'discount', 'Discounts', {'packed': True}],
+            ['add_', 'address', 'Address', {'packed': True}]]})
+        self.db.calc_tables()
+        t = self.db.tables['packed']
+        self.failUnless([f.name for f in t.fields] == ['id', 'discount', 'add_'])
+        self.failUnless(t.packed['discount02'] == ('discount', 1, self.db.types['discount']))
+        f = t.fnames['discount']
+        self.failUnless(f.type.sa_type is sa.JSON and f.type.parent is self.db.types['discount'])
+        self.failUnless(f.get('array') == self.db.types['discount'].get('array'))
+        ws = dq.WorkSpace(self.db, sa.create_engine('sqlite://'))
+        o = ws.generate_orm()
+        ws.create_all()
+        self.failUnless(len(o.packed.__table__.c) == 3)
+        ws.bulk_load('packed', [{'id': 1, 'discount': [1, 2], 'add_': {'city': 'Boston'}},
+                                {'id': 2, 'discount02': 7, 'add_city': 'Rome'}])
+        s = ws.session()
+        x = s.query(o.packed).get(1)
+        self.failUnless(x.discount02 == 2 and x.discount03 is None and x.add_city == 'Boston')
+        x.discount03 = 5
+        s.commit()
+        self.failUnless(s.query(o.packed).get(1).discount == [1, 2, 5])
+        self.failUnless([r.id for r in s.query(o.packed).filter(o.packed.discount02 > 5)] == [2])
+        self.failUnless(s.query(o.packed).filter(o.packed.add_city == 'Rome').one().id == 2)
+        rows = list(ws.stream('packed', ['id', 'discount02', 'add_city']))[0]
+        self.failUnless(rows == [{'id': 1, 'discount02': 2, 'add_city': 'Boston'},
+                                 {'id': 2, 'discount02': 7, 'add_city': 'Rome'}])
+        src = dq.codegen.generate_module(self.db)
+        self.failUnless("    discount02 = packed_property('discount', 1, 'float')" in src)
+        compile(src, 'packed_orm', 'exec')
+        # the elements are not columns
+        self.db.add_table({'type': 'table', 'name': 'packed_ix', 'fields': [
+            ['id', 'idint', 'ID'],
+            ['discount', 'discount', 'Discounts', {'packed': True}]], 'indexes': [
+            ['primary', 'id', 'ID'],
+            ['disc', 'discount02', 'Discount', {'ascending': False}]]})
+        self.db.calc_tables()
+        self.failUnlessRaises(Exception, dq.WorkSpace(self.db, sa.create_engine('sqlite://')).generate_orm)
+        self.failUnlessRaises(Exception, dq.codegen.generate_module, self.db)
+
+    def test_query(self):
+        ws = dq.WorkSpace(self.db, sa.create_engine('sqlite://'))
+        ws.generate_orm()
+        ws.create_all()
+        ws.bulk_load('sbj', [{'id': 1, 'name': 'John'}])
+        ws.bulk_load('prd', [('P1', 'Product 1'), ('P2', 'Product 2')], columns=['id', 'description'])
+        ws.bulk_load('ord', [{'id': i, 'id_sbj': 1, 'row': [
+            {'n_order': n, 'id_prd': 'P%d' % n, 'qt': n * 10} for n in (1, 2)]} for i in (1, 2)])
+        fields = ['n_order', 'id_prd.description', 'id_ord.id_sbj.name']
+        for i in (1, 2):
+            rows = ws.query('row', fields, [('id_ord', '='), ('qt', '>', 'min_qt')], ['-n_order']).all(
+                id_ord=i, min_qt=5)
+            self.failUnless(rows == [
+                {'n_order': 2, 'id_prd.description': 'Product 2', 'id_ord.id_sbj.name': 'John'},
+                {'n_order': 1, 'id_prd.description': 'Product 1', 'id_ord.id_sbj.name': 'John'}])
+        self.failUnless(ws.query_cache.as_dict() == {'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0})
+        q = ws.query('row', ['id', 'discount'], [('id_prd', 'in', 'prds')], limit=1)
+        r = q.first(prds=['P2'])
+        self.failUnless(r['id'] == 2 and 'discount05' in r)
+        self.failUnless(len(q.all(prds=['P1', 'P2'])) == 1)
+        self.failUnless(ws.query_cache.misses == 2)
+        self.failUnlessRaises(Exception, ws.query('row', ['id_prd.unknown']).all)
+        # array fields are expanded by the selected fields only
+        self.assertRaisesRegex(Exception, 'discount01', ws.query('row', ['id'], ['discount']).all,
+                               discount=0)
+        self.assertRaisesRegex(Exception, 'array or compound', ws.query('row', ['id'], [],
+                                                                         ['discount']).all)
+
+    def test_lookup(self):
+        self.db.properties['lookup'] = {'prefill': True}
+        ws = dq.WorkSpace(self.db, sa.create_engine('sqlite://'))
+        o = ws.generate_orm()
+        ws.create_all()
+        lc = ws.lookup_cache
+        self.failUnless(sorted(lc.aliases()) == ['lst', 'tax'])
+        ws.bulk_load('tax', [('T1', 'Tax 1', 10), ('T2', 'Tax 2', 20)],
+                     columns=['id', 'description', 'rate'])
+        self.failUnless(lc.get('tax', 'T2')['description'] == 'Tax 2')
+        self.failUnless(lc.get('tax', 'T3') is None)
+        self.failUnless(lc.as_dict() == {'tables': 1, 'hits': 1, 'misses': 1, 'invalidations': 0})
+        # identity map prefilled
+        s = ws.session()
+        queries = []
+        sa.event.listen(ws.engine, 'before_cursor_execute', lambda *args: queries.append(args[2]))
+        self.failUnless(s.query(o.tax).get('T1').description == 'Tax 1')
+        self.failUnless(queries == [])
+        # writes of the workspace invalidate the table
+        t = s.query(o.tax).get('T1')
+        t.description = 'Changed'
+        s.commit()
+        self.failUnless(lc.get('tax', 'T1')['description'] == 'Changed')
+        ws.bulk_delete('tax', {'id': 'T2'})
+        self.failUnless(lc.get('tax', 'T2') is None)
+        self.failUnless(lc.invalidations == 2)
+        # external writes are seen after ttl seconds
+        ws.engine.execute("update taxes set description='External'")
+        self.failUnless(lc.get('tax', 'T1')['description'] == 'Changed')
+        lc.ttl = 0
+        self.failUnless(lc.get('tax', 'T1')['description'] == 'External')
+        self.failUnlessRaises(Exception, lc.get, 'sbj', 1)
+
+    def test_stats(self):
+        stats = dq.stats.STATS
+        stats.reset()
+        events = []
+        stats.hooks.append(lambda *args: events.append(args))
+        try:
+            db = dq.Database()
+            db.load_yaml(dq.utils.load_yaml('db.yml', RPATH))
+            ws = dq.WorkSpace(db, sa.create_engine('sqlite://'))
+            o = ws.generate_orm()
+        finally:
+            stats.hooks.pop()
+        load = ws.stats()['load']
+        for k in ['yaml_load', 'include_lookup', 'add_types', 'calc_types', 'add_tables',
+                  'calc_tables', 'resolve_relations', 'generate_orm']:
+            self.failUnless(load['phases'][k]['count'] >= 1)
+        counters = load['counters']
+        self.failUnless(counters['files'] > 1)
+        self.failUnless(counters['types'] == len(db.types))
+        self.failUnless(counters['tables'] == len(db.tables))
+        self.failUnless(counters['classes_mapped'] == len(db.tables))
+        self.failUnless(counters['expanded_fields'] > 0)
+        self.failUnless(('count', 'classes_mapped', 1) in events)
+        self.failUnless([e for e in events if e[:2] == ('phase', 'generate_orm')])
+        # queries of each table
+        ws.create_all()
+        ws.query_stats.reset()
+        events = []
+        ws.query_stats.hooks.append(lambda *args: events.append(args))
+        ws.bulk_load('ord', [{'id': 1, 'row': [{'n_order': i} for i in range(5)]}])
+        ws.query('row', ['n_order'], ['id_ord']).all(id_ord=1)
+        s = ws.session()
+        s.query(o.ord).get(1)
+        ws.engine.execute('select 1')
+        queries = ws.stats()['queries']
+        self.failUnless(queries['ord']['kinds'] == {'insert': 1, 'select': 1})
+        # the rows of the order are loaded by "selectin"
+        self.failUnless(queries['row']['kinds'] == {'insert': 1, 'select': 2})
+        self.failUnless(queries['?']['count'] == 1)
+        self.failUnless(sum(queries['row']['buckets']) == queries['row']['count'])
+        self.failUnless(len(events) == sum(q['count'] for q in queries.values()))
+        self.failUnless(events[0][0] == 'query')
+        # failed statements are not counted
+        with ws.engine.connect() as conn:
+            self.assertRaises(sa.exc.DBAPIError, conn.execute, 'select * from missing')
+            conn.execute('select 2')
+            self.failIf(conn.info)
+        self.failUnless(ws.stats()['queries']['?']['count'] == 2)
+
+    def test_tenant(self):
+        ws = dq.WorkSpace(self.db, sa.create_engine('sqlite://'))
+        o = ws.generate_orm()
+        ws.create_all()
+        a = dq.tenant.Tenant(ws, 'a', prefix='a_')
+        b = dq.tenant.Tenant(ws, 'b', prefix='b_')
+        self.failUnless(a.tables is ws.tables and a.overlay['orders'] == 'a_orders')
+        self.failUnless(a.overlay['idx_ord_date'] == 'a_idx_ord_date')
+        a.create_all()
+        b.create_all()
+        names = sa.inspect(ws.engine).get_table_names()
+        self.failUnless('orders' in names and 'a_orders' in names and 'b_ord_rows' in names)
+        # same classes and keys, different tables
+        a.bulk_load('ord', [{'id': 1, 'row': [{'n_order': i} for i in range(3)]}])
+        s = b.session()
+        s.add(o.ord(id=1))
+        s.commit()
+        self.failUnless(len(a.query('row', ['n_order'], ['id_ord']).all(id_ord=1)) == 3)
+        self.failUnless(len(b.query('row', ['n_order'], ['id_ord']).all(id_ord=1)) == 0)
+        self.failUnless(ws.engine.execute('select count(*) from a_ord_rows').scalar() == 3)
+        self.failUnless(ws.engine.execute('select count(*) from ord_rows').scalar() == 0)
+        self.failUnless(len(a.session().query(o.ord).get(1).row) == 3)
+        self.failUnless(a.query_cache is not ws.query_cache)
+        # only the tables are renamed, not the literals and the parameters
+        self.failUnless(a.engine.execute("select 'orders'").scalar() == 'orders')
+        a.bulk_load('tax', [('T2', 'orders', 5)], columns=['id', 'description', 'rate'])
+        tax = o.tax.__table__
+        self.failUnless(a.engine.execute(sa.select([tax.c.id]).where(
+            tax.c.description == sa.literal_column("'orders'"))).scalar() == 'T2')
+        a.bulk_delete('tax', {'id': 'T2'})
+        # lookup caches of tenants
+        a.bulk_load('tax', [('T1', 'Tax 1', 10)], columns=['id', 'description', 'rate'])
+        self.failUnless(a.lookup_cache.get('tax', 'T1')['rate'] == 10)
+        self.failUnless(ws.lookup_cache.get('tax', 'T1') is None)
+        a.bulk_delete('tax', {'id': 'T1'})
+        self.failUnless(a.lookup_cache.get('tax', 'T1') is None)
+        self.failUnlessRaises(Exception, a.generate_orm)
+        # tenants into schemas
+        engine = sa.create_engine('sqlite://')
+        sa.event.listen(engine, 'connect', lambda c, r: c.execute("attach ':memory:' as s1"))
+        ws = dq.WorkSpace(self.db, engine)
+        ws.generate_orm()
+        ws.create_all()
+        t = dq.tenant.Tenant(ws, 's1', schema='s1')
+        t.create_all()
+        t.bulk_load('ord', [{'id': 1, 'row': [{'n_order': i} for i in range(3)]}])
+        self.failUnless(len(t.query('row', ['n_order'], ['id_ord']).all(id_ord=1)) == 3)
+        self.failUnless(len(ws.query('row', ['n_order'], ['id_ord']).all(id_ord=1)) == 0)
+        self.failUnless(engine.execute('select count(*) from s1.ord_rows').scalar() == 3)
+
+    @unittest.skipIf(dq.aio.AsyncSession is None or importlib.util.find_spec('aiosqlite') is None,
+                     'requires SQLAlchemy 1.4 and aiosqlite')
+    def test_async(self):
+        async def run():
+            ws = dq.aio.AsyncWorkSpace(self.db, 'sqlite+aiosqlite://')
+            try:
+                o = ws.generate_orm()
+                await ws.create_all()
+                await ws.bulk_load('ord', [{'id': 1, 'row': [{'n_order': i} for i in range(5)]}])
+                batches = [b async for b in ws.stream('row', ['n_order'], batch_size=2)]
+                self.failUnless([len(b) for b in batches] == [2, 2, 1])
+                async with ws.session() as s:
+                    x = await ws.get(s, 'ord', 1, ['row'])
+                    self.failUnless(len(x.row) == 5)
+                rows = await ws.fetch(ws.query('row', ['n_order'], ['id_ord']), id_ord=1)
+                self.failUnless(len(rows) == 5)
+                self.failUnless(await ws.bulk_delete('ord') == 1)
+            finally:
+                # the aiosqlite threads keep the process alive
+                await ws.dispose()
+        asyncio.run(run())
+
+    def test_restructure(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        url = 'sqlite:///%s' % os.path.join(tmp, 'restructure.db')
+        ws = dq.WorkSpace(self.db, url)
+        ws.generate_orm()
+        ws.create_all()
+        self.failIf(dq.restructure.diff(ws))
+        ws.bulk_load('ord', [{'id': 1, 'row': [{'n_order': i, 'qt': i} for i in range(25)]}])
+        ws.bulk_load('lst', [(1, 'List 1')])
+
+        # new structure: a field added to lst, a field removed from row
+        data = dq.utils.load_yaml('db.yml', YPATH)
+        for doc in data['tables']:
+            if doc['name'] == 'prd_list':
+                doc['fields'] = doc['fields'] + [['note', 'text', 'Note']]
+            if doc['name'] == 'ord_rows':
+                doc['fields'] = [f for f in doc['fields'] if f[0] != 'qt']
+        db = dq.Database()
+        db.load_yaml(data)
+        ws2 = dq.WorkSpace(db, url)
+        ws2.generate_orm()
+        plan = dq.restructure.diff(ws2)
+        changes = dict((ch.name, ch) for ch in plan)
+        self.failUnless(sorted(changes) == ['ord_rows', 'prd_list'])
+        self.failUnless(changes['prd_list'].action == 'alter' and changes['prd_list'].added == ['note'])
+        self.failUnless(changes['ord_rows'].action == 'rebuild' and changes['ord_rows'].removed == ['qt'])
+        listeners = len(ws2.engine.dispatch.before_cursor_execute)
+        counters = dq.stats.STATS.as_dict()['counters']
+        self.failUnless(sorted(ch.name for ch in dq.restructure.diff(ws2, self.db)) ==
+                        ['ord_rows', 'prd_list'])
+        self.failUnless(len(ws2.engine.dispatch.before_cursor_execute) == listeners)
+        self.failUnless(dq.stats.STATS.as_dict()['counters'] == counters)
+        # referenced tables are created first, they are rebuilt only on sqlite
+        ws3 = dq.WorkSpace(db, sa.create_engine('sqlite://'))
+        ws3.generate_orm()
+        creates = [ch.name for ch in dq.restructure.diff(ws3)]
+        self.failUnless(creates.index('orders') < creates.index('ord_rows') and
+                        creates.index('subjects') < creates.index('orders'))
+        rebuild = dq.restructure.Plan(ws.metadata)
+        rebuild.changes.append(dq.restructure.TableChange('orders', 'rebuild'))
+        pg = ws2.engine.execution_options()
+        pg.dialect = copy.copy(pg.dialect)
+        pg.dialect.name = 'postgresql'
+        self.assertRaisesRegex(Exception, '"orders" is referenced by foreign keys of ord_rows',
+                               dq.restructure.apply, types.SimpleNamespace(engine=pg), rebuild)
+        steps = []
+        ws2.restructure(chunk_size=10, progress=lambda *args: steps.append(args))
+        self.failUnless(steps == [('ord_rows', 10, 25), ('ord_rows', 20, 25), ('ord_rows', 25, 25)])
+        self.failIf(dq.restructure.diff(ws2))
+        s = ws2.session()
+        self.failUnless(s.query(ws2.tables['row']).count() == 25)
+        self.failUnless(s.query(ws2.tables['lst']).one().note is None)
+
+
+    def test_planner(self):
+        self.db = dq.Database()
+        self.db.load_yaml(dq.utils.load_yaml('db.yml', RPATH))
+        self.db.add_table({'type': 'table', 'name': 'notes', 'alias': 'nte', 'fields': [
+            ['id', 'idint', 'ID'],
+            ['id_ord', '=ord', 'Order', {'child': True, 'order_by': ['id_ord', 'n_note']}],
+            ['n_note', 'integer', 'Number'],
+            ['id_prd', '=prd', 'Product', {'index': False}],
+            ['id_tax', '=tax', 'Tax']],
+            'indexes': [['primary', 'id', 'ID'],
+                        ['tax', 'id_tax', 'Tax'],
+                        ['taxord', ['id_tax', 'id_ord'], 'Tax and order'],
+                        ['recent', ['id_ord', 'n_note'], 'Recent', {'ascending': False}]]})
+        self.db.calc_tables()
+        plan = dq.planner.plan(self.db)
+        ii = dict((i.name, i) for i in plan.tables['nte'])
+        self.failUnless(sorted(ii) == ['id_ord', 'id_ord_n_note', 'primary', 'recent', 'tax',
+                                       'taxord'])
+        self.failUnless(ii['recent'].descending and ii['recent'].action == 'keep')
+        # the foreign key index is the declared one, covered by another index
+        self.failUnless(ii['tax'].action == 'drop' and ii['tax'].covered_by == 'taxord')
+        self.failUnless(ii['tax'].sources == ['declared', 'relation'])
+        self.failUnless(ii['id_ord'].action == 'skip' and ii['id_ord'].covered_by == 'id_ord_n_note')
+        self.failUnless(ii['id_ord_n_note'].action == 'add')
+        rows = dict((i.name, i) for i in plan.tables['row'])
+        self.failUnless(rows['id_ord'].sources == ['declared', 'order_by'])
+        self.failUnless(rows['id_prd'].action == 'add' and rows['id_tax'].action == 'add')
+        self.failUnless(dict((i.name, i) for i in plan.tables['prd_uf'])['id_prd'].sources ==
+                        ['declared', 'usrfld'])
+        report = plan.report()
+        self.failUnless('drop  nte          tax' in report)
+        self.failUnless(report.endswith('16 kept, 4 added, 1 dropped, 9 skipped'))
+        # the plan is written into the metadata and into generated modules
+        self.db.properties['index_plan'] = True
+        ws = dq.WorkSpace(self.db, sa.create_engine('sqlite://'))
+        ws.generate_orm()
+        ws.create_all()
+        self.failUnless(sorted(i.name for i in ws.metadata.tables['notes'].indexes) ==
+                        ['idx_nte_id_ord_n_note', 'idx_nte_recent', 'idx_nte_taxord'])
+        ddl = [str(sa.schema.CreateIndex(i).compile(ws.engine))
+               for i in sorted(ws.metadata.tables['notes'].indexes, key=lambda i: i.name)]
+        self.failUnless(ddl[0].endswith('(id_ord, n_note)') and
+                        ddl[1].endswith('(id_ord DESC, n_note DESC)'))
+        self.failUnless(sorted(i.name for i in ws.metadata.tables['ord_rows'].indexes) ==
+                        ['idx_row_id_ord', 'idx_row_id_prd', 'idx_row_id_tax'])
+        source = dq.codegen.generate_module(self.db)
+        self.failUnless("'idx_row_id_prd', 'id_prd'" in source)
+        self.failUnless("'idx_nte_recent', id_ord.desc(), n_note.desc()" in source)
+        # the declared indexes without plan keep their direction too
+        del self.db.properties['index_plan']
+        ws = dq.WorkSpace(self.db, sa.create_engine('sqlite://'))
+        ws.generate_orm()
+        i = [i for i in ws.metadata.tables['notes'].indexes if i.name == 'idx_nte_recent'][0]
+        self.failUnless(str(sa.schema.CreateIndex(i).compile(ws.engine)).endswith(
+            '(id_ord DESC, n_note DESC)'))
+        self.failUnless([c.name for c in i.columns] == ['id_ord', 'n_note'])
+
+class BenchTest(unittest.TestCase):
+
+    def test_synth(self):
+        spec = importlib.util.spec_from_file_location(
+            'synth', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench', 'synth.py'))
+        synth = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(synth)
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        main = synth.generate(tmp, synth.Options(types=40, depth=5, tables=12, inherit=0.3, usrfld=0.3))
+        db = dq.Database()
+        db.load_yaml(dq.utils.load_yaml(main, [tmp]))
+        self.failUnless(len(db.tables) > 12 and len(db.types) == 75)
+        self.failUnless(any(t.get('inherit') for t in db.tables.values()))
+        ws = dq.WorkSpace(db, sa.create_engine('sqlite://'))
+        ws.generate_orm()
+        sa.orm.configure_mappers()
+        ws.create_all()
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.tmp, 'db.cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_cache(self):
+        # first load build the cache, second load read it
+        db = dq.cache.load_database('db.yml', YPATH, self.cache_file)
+        self.failUnless(os.path.isfile(self.cache_file))
+        self.failUnless(dq.cache.load_cache(self.cache_file, YPATH) is not None)
+        db2 = dq.cache.load_database('db.yml', YPATH, self.cache_file)
+        self.failUnless(sorted(db2.tables) == sorted(db.tables))
+        self.failUnless(db2.tables['ord'].fnames['id_sbj'].type is db2.tables['sbj'])
+        self.failUnless(db2.types['currency'].sa_type == sa.Numeric)
+
+        # a file which shadows an included one invalidates the cache
+        with open(os.path.join(self.tmp, 'taxes.yml'), 'w') as f:
+            f.write(open(os.path.join(YAML_DIR, 'taxes.yml')).read())
+        self.failUnless(dq.cache.load_cache(self.cache_file, [self.tmp] + YPATH) is None)
+
+
+class ReloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        shutil.copytree(YAML_DIR, os.path.join(self.tmp, 'yaml'))
+        ydir = os.path.join(self.tmp, 'yaml')
+        self.ypath = [ydir, os.path.join(ydir, 'custom'), os.path.join(ydir, 'core')]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _edit(self, fname, old, new):
+        filename = os.path.join(self.tmp, 'yaml', fname)
+        text = open(filename).read()
+        with open(filename, 'w') as f:
+            f.write(text.replace(old, new))
+        st = os.stat(filename)
+        os.utime(filename, (st.st_atime, st.st_mtime + 10))
+
+    def test_reload(self):
+        rl = dq.reload.Reloader('db.yml', self.ypath)
+        db = rl.db
+        self.failUnless(db.tables['ord'].source.endswith('orders.yml'))
+        self.failUnless(db.types['idint'].source.endswith('types_base.yml'))
+        self.failIf(rl.reload())
+
+        # change a table, only it is rebuilt
+        sbj = db.tables['sbj']
+        self._edit('orders.yml', ' - [n_doc,  integer,   Number]',
+                   ' - [n_doc,  integer,   Number]\n - [notes, text, Notes]')
+        r = rl.reload()
+        self.failUnless(r.tables['changed'] == ['ord'])
+        self.failUnless('notes' in db.tables['ord'].fnames)
+        self.failUnless(db.tables['sbj'] is sbj)
+        self.failUnless(db.tables['row'].fnames['id_ord'].type is db.tables['ord'])
+
+        # change a parent table, inherited and user fields tables follow
+        self._edit('subjects.yml', 'Memo notes', 'Notes')
+        r = rl.reload()
+        self.failUnless(r.tables['changed'] == ['cst', 'cst_uf', 'sbj', 'sbj_uf'])
+        self.failUnless(db.tables['ord'].fnames['id_sbj'].type is db.tables['sbj'])
+        self.failUnless(db.tables['sbj_uf'].fnames['id_sbj'].type is db.tables['sbj'])
+
+        # change a type, the tables using it are rebuilt
+        self._edit('core/types_base.yml', '[percent, numeric, 3, 2]', '[percent, numeric, 5, 2]')
+        r = rl.reload()
+        self.failUnless(r.types['changed'] == ['percent'])
+        self.failUnless(db.types['discount'].length == 5)
+        self.failUnless(r.tables['changed'] == ['prc', 'row', 'tax'])
+
 
 def main():
     unittest.main()